@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Throughput of client-side video frame encoding.
+
+Compares the old path (a new mp.Pool per video, frames pickled as PIL images, PNG) with the
+long-lived shared-memory EncoderPool in PNG, JPEG and WebP, on frames sampled from `--video`
+or on synthetic frames.
+
+    python benchmark_encoder.py --frames 64 --size 1344x756 --processes 8
+    python benchmark_encoder.py --video demo.mp4 --fps 3 --quality 85
+"""
+import argparse
+import base64
+import io
+import multiprocessing as mp
+import time
+
+import numpy as np
+from PIL import Image
+
+import frame_encoder
+
+
+def synthetic_frames(num_frames, width, height, seed=0):
+    """Smooth gradients with some noise and a moving block, so compression sees video-like content."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    frames = []
+    for i in range(num_frames):
+        channels = [(x + y + 4 * i) % 256, (x * 0.5 + y * 0 + 2 * i) % 256, (x * 0 + y * 0.7 + i) % 256]
+        base = np.stack(channels, axis=-1)
+        base = base + rng.normal(0, 6, base.shape)
+        left = (i * 17) % max(1, width - width // 4)
+        base[height // 3: height // 3 + height // 4, left: left + width // 4] = (220, 40, 40)
+        frames.append(np.clip(base, 0, 255).astype(np.uint8))
+    return frames
+
+
+def video_frames(path, fps):
+    import frame_sampler
+    return list(frame_sampler.sample_video(path, fps).frames)
+
+
+def _legacy_encode(image):
+    buffered = io.BytesIO()
+    image.save(buffered, format="png")
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+def legacy_encode(frames, processes):
+    """What encode_images_parallel did before: PIL frames pickled to a pool created for this video."""
+    images = [Image.fromarray(f) for f in frames]
+    with mp.Pool(processes=processes) as pool:
+        return pool.map(_legacy_encode, images)
+
+
+def run(name, encode, frames, repeat):
+    encode(frames)  # warm up, and for the pools: workers already running as in the client
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encoded = encode(frames)
+        best = min(best, time.perf_counter() - start)
+    payload = sum(len(b64) for b64 in encoded)
+    print(f"{name:<24} {best * 1000:>10.1f} {len(frames) / best:>10.1f} {payload / 1024 ** 2:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark client-side video frame encoding')
+    parser.add_argument('--video', type=str, default=None,
+                        help='Sample frames from this video (needs decord) instead of synthetic frames')
+    parser.add_argument('--fps', type=int, default=3,
+                        help='Sampling fps for --video')
+    parser.add_argument('--frames', type=int, default=64,
+                        help='Number of synthetic frames')
+    parser.add_argument('--size', type=str, default='1344x756',
+                        help='Synthetic frame size, WIDTHxHEIGHT')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Worker processes (default: CPU count, at most 16)')
+    parser.add_argument('--quality', type=int, default=frame_encoder.DEFAULT_QUALITY,
+                        help='JPEG/WebP quality')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per method, the best one is reported')
+    args = parser.parse_args()
+
+    if args.video:
+        frames = video_frames(args.video, args.fps)
+    else:
+        width, height = map(int, args.size.lower().split('x'))
+        frames = synthetic_frames(args.frames, width, height)
+    processes = args.processes or min(mp.cpu_count(), 16)
+    h, w = frames[0].shape[:2]
+    print(f"{len(frames)} frames of {w}x{h}, {processes} processes, quality {args.quality}\n")
+    print(f"{'method':<24} {'ms/video':>10} {'frames/s':>10} {'payload MiB':>12}")
+
+    run('per-video pool, png', lambda f: legacy_encode(f, processes), frames, args.repeat)
+    for fmt in frame_encoder.FORMATS:
+        pool = frame_encoder.EncoderPool(processes, fmt, args.quality).start()
+        try:
+            run(f'shared-memory pool, {fmt}', pool.encode, frames, args.repeat)
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Base64 encoding of sampled video frames for the gradio clients.
+
+- one long-lived process pool per client instead of a new mp.Pool for every video
+- frames are copied once into a shared-memory uint8 block and workers encode views of it,
+  so full-resolution frames are never pickled
+- frames go out as PNG (lossless, what the clients always sent) or JPEG / WebP with a quality knob
+"""
+import atexit
+import base64
+import io
+import math
+import multiprocessing as mp
+import os
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from PIL import Image
+
+FORMATS = ('png', 'jpeg', 'webp')
+DEFAULT_QUALITY = 90
+# same limit as encode_image in the clients
+MAX_SIZE = 448 * 16
+# below this many frames the pool round trip costs more than it saves
+MIN_PARALLEL_FRAMES = 3
+# tasks per worker: small enough to balance, large enough to attach the block only a few times
+CHUNKS_PER_PROCESS = 2
+
+
+def _resize(image, max_size):
+    if max(image.size) <= max_size:
+        return image
+    w, h = image.size
+    if w > h:
+        new_w, new_h = max_size, int(h * max_size / w)
+    else:
+        new_w, new_h = int(w * max_size / h), max_size
+    return image.resize((new_w, new_h), resample=Image.BICUBIC)
+
+
+def encode_array(array, fmt='png', quality=DEFAULT_QUALITY, max_size=MAX_SIZE):
+    """Base64 string of an HxWx3 uint8 frame in `fmt`."""
+    image = _resize(Image.fromarray(array), max_size)
+    buffered = io.BytesIO()
+    if fmt == 'png':
+        image.save(buffered, format='png')
+    else:
+        image.save(buffered, format=fmt, quality=quality)
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+def _encode_range(shm_name, shape, start, stop, fmt, quality, max_size):
+    """Worker side: encode frames [start, stop) of the shared block without copying them out."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        encoded = [encode_array(frames[i], fmt, quality, max_size) for i in range(start, stop)]
+        # the view must go before close(), it holds an export of shm.buf
+        del frames
+        return encoded
+    finally:
+        shm.close()
+
+
+def _as_array(frame):
+    array = np.asarray(frame.convert('RGB') if isinstance(frame, Image.Image) else frame)
+    if array.dtype != np.uint8 or array.ndim != 3 or array.shape[2] != 3:
+        raise ValueError(f"expected HxWx3 uint8 frames, got {array.dtype} {array.shape}")
+    return array
+
+
+class EncoderPool:
+    """
+    Long-lived worker pool for frame encoding. Start it before the UI spins up its threads, so
+    the workers are forked once from a quiet process; encode() is safe to call from any thread.
+    """
+
+    def __init__(self, processes=None, fmt='png', quality=DEFAULT_QUALITY, max_size=MAX_SIZE):
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown frame format {fmt!r}, expected one of {FORMATS}")
+        self.processes = processes or min(mp.cpu_count(), 16)
+        self.fmt = fmt
+        self.quality = quality
+        self.max_size = max_size
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._pool is None and self.processes > 1:
+                if os.name == 'posix':
+                    # workers must share this process's resource tracker: one they started themselves
+                    # would "clean up" every block they attached to when they exit
+                    resource_tracker.ensure_running()
+                self._pool = mp.Pool(processes=self.processes)
+                atexit.register(self.close)
+        return self
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+    def encode_serial(self, frames):
+        return [encode_array(_as_array(f), self.fmt, self.quality, self.max_size) for f in frames]
+
+    def encode(self, frames):
+        """Base64 strings of `frames` (PIL images or HxWx3 uint8 arrays), in order."""
+        arrays = [_as_array(f) for f in frames]
+        if len(arrays) < MIN_PARALLEL_FRAMES or self.processes <= 1 or len({a.shape for a in arrays}) > 1:
+            # mixed sizes don't fit one block; frames sampled from a video always share a size
+            return self.encode_serial(arrays)
+        self.start()
+
+        shape = (len(arrays),) + arrays[0].shape
+        shm = shared_memory.SharedMemory(create=True, size=math.prod(shape))
+        try:
+            block = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+            for i, array in enumerate(arrays):
+                block[i] = array
+            del block
+
+            step = math.ceil(len(arrays) / (self.processes * CHUNKS_PER_PROCESS))
+            tasks = [(shm.name, shape, start, min(start + step, len(arrays)), self.fmt, self.quality, self.max_size)
+                     for start in range(0, len(arrays), step)]
+            encoded = []
+            for chunk in self._pool.starmap(_encode_range, tasks):
+                encoded.extend(chunk)
+            return encoded
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def encode_contents(self, frames):
+        """`frames` as image contents for the /api request."""
+        return [{"type": "image", "pairs": b64} for b64 in self.encode(frames)]
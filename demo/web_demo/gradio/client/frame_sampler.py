@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Video frame sampling shared by the gradio clients.
+
+- frames are decoded by decord at reduced resolution instead of full resolution + resize
+- sample points are snapped to nearby keyframes when that doesn't change the timeline much
+- sampled frame sets are kept in an LRU cache keyed by (video hash, fps, packing plan),
+  so regenerate / follow-up turns on the same video skip decoding
+- open_video() decodes in fixed-size chunks, so peak memory does not grow with the clip length
+"""
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from decord import VideoReader, cpu
+from scipy.spatial import cKDTree
+
+DOUBLE_FRAME_DURATION = 30
+MAX_NUM_FRAMES = 180
+MAX_NUM_PACKING = 3
+TIME_SCALE = 0.1
+# Video frames are sent with max_slice_nums=1, so the model sees roughly 448x448 per frame;
+# decoding beyond 4x that side only costs memory and encode time.
+VIDEO_MAX_SIDE = 448 * 4
+KEYFRAME_TOLERANCE = 0.25  # seconds a sample point may move to land on a keyframe
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+# frames per decord get_batch call when decoding in chunks
+FRAME_CHUNK = 16
+# sampled videos bigger than this stream through open_video() without being cached
+CACHE_MAX_ENTRY_BYTES = 512 * 1024 ** 2
+
+
+def map_to_nearest_scale(values, scale):
+    tree = cKDTree(np.asarray(scale)[:, None])
+    _, indices = tree.query(np.asarray(values)[:, None])
+    return np.asarray(scale)[indices]
+
+
+def group_array(arr, size):
+    return [arr[i:i+size] for i in range(0, len(arr), size)]
+
+
+def uniform_sample(l, n):
+    gap = len(l) / n
+    idxs = [int(i * gap + gap / 2) for i in range(n)]
+    return [l[i] for i in idxs]
+
+
+def packing_plan(num_frames, fps, choose_fps=None):
+    """MiniCPM-V 4.5 plan: sample at `choose_fps` (doubled for short clips) and pack up to MAX_NUM_PACKING frames."""
+    video_duration = num_frames / fps
+    effective_fps = choose_fps if choose_fps else 1
+
+    if video_duration < DOUBLE_FRAME_DURATION and effective_fps <= 5:
+        effective_fps = effective_fps * 2
+        packing_nums = 2
+        choose_frames = round(min(effective_fps, round(fps)) * min(MAX_NUM_FRAMES, video_duration))
+    elif effective_fps * int(video_duration) <= MAX_NUM_FRAMES:
+        packing_nums = 1
+        choose_frames = round(min(effective_fps, round(fps)) * min(MAX_NUM_FRAMES, video_duration))
+    else:
+        packing_size = math.ceil(video_duration * effective_fps / MAX_NUM_FRAMES)
+        if packing_size <= MAX_NUM_PACKING:
+            choose_frames = round(video_duration * effective_fps)
+            packing_nums = packing_size
+        else:
+            choose_frames = round(MAX_NUM_FRAMES * MAX_NUM_PACKING)
+            packing_nums = MAX_NUM_PACKING
+
+    frame_idx = np.array(uniform_sample(list(range(num_frames)), choose_frames))
+    return frame_idx, packing_nums
+
+
+def one_fps_plan(num_frames, fps, choose_fps=None, max_num_frames=64):
+    """Plan used by the MiniCPM-o 4.5 / MiniCPM-V 4.0 demos: 1 fps, at most `max_num_frames` - 1 frames."""
+    sample_fps = round(fps / 1)
+    frame_idx = list(range(0, num_frames, sample_fps))
+    if len(frame_idx) >= max_num_frames:
+        frame_idx = uniform_sample(frame_idx, max_num_frames - 1)
+    return np.array(frame_idx), 1
+
+
+def video_digest(path, block_size=1 << 20, num_blocks=16):
+    """Content hash from the file size plus evenly spaced blocks, cheap even for multi-GB files."""
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        if size <= block_size * num_blocks:
+            h.update(f.read())
+        else:
+            step = (size - block_size) // (num_blocks - 1)
+            for i in range(num_blocks):
+                f.seek(i * step)
+                h.update(f.read(block_size))
+    return h.hexdigest()
+
+
+def decode_size(width, height, max_side):
+    """Target (width, height) for decord, or (-1, -1) to keep the native size."""
+    if max(width, height) <= max_side:
+        return -1, -1
+    scale = max_side / max(width, height)
+    return max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+
+
+def snap_to_keyframes(frame_idx, key_indices, tolerance):
+    """Move each sample to the nearest keyframe within `tolerance` frames, keeping samples distinct."""
+    if len(key_indices) == 0 or tolerance < 1:
+        return frame_idx
+    keys = np.asarray(key_indices)
+    pos = np.clip(np.searchsorted(keys, frame_idx), 1, len(keys) - 1)
+    left, right = keys[pos - 1], keys[pos]
+    nearest = np.where(frame_idx - left <= right - frame_idx, left, right)
+    snapped = np.where(np.abs(nearest - frame_idx) <= tolerance, nearest, frame_idx)
+    # two samples landing on the same keyframe would duplicate a frame; keep the originals then
+    if len(np.unique(snapped)) != len(snapped):
+        return frame_idx
+    return snapped
+
+
+class SampledVideo:
+    def __init__(self, frames, temporal_ids, packing_nums, fps, duration):
+        self.frames = frames  # (N, H, W, 3) uint8
+        self.temporal_ids = temporal_ids  # grouped per packing window
+        self.packing_nums = packing_nums
+        self.fps = fps
+        self.duration = duration
+
+    def __len__(self):
+        return len(self.frames)
+
+    def chunks(self, chunk_size=FRAME_CHUNK):
+        for start in range(0, len(self.frames), chunk_size):
+            yield self.frames[start:start + chunk_size]
+
+
+class VideoStream:
+    """
+    A planned sample of a video that is decoded on demand. chunks() yields `chunk_size` frames per
+    decord call, already at the reduced decode size; when the whole sample is small enough it is
+    collected on the way and put in the cache.
+    """
+
+    def __init__(self, video_path, frame_idx, size, temporal_ids, packing_nums, fps, duration,
+                 cache=None, cache_key=None):
+        self.video_path = video_path
+        self.frame_idx = frame_idx
+        self.size = size  # decord (width, height), (-1, -1) for the native size
+        self.temporal_ids = temporal_ids
+        self.packing_nums = packing_nums
+        self.fps = fps
+        self.duration = duration
+        self.cache = cache
+        self.cache_key = cache_key
+
+    def __len__(self):
+        return len(self.frame_idx)
+
+    def chunks(self, chunk_size=FRAME_CHUNK):
+        width, height = self.size
+        # decord scales inside the decoder, so full-resolution frames never reach numpy
+        vr = VideoReader(self.video_path, ctx=cpu(0), width=width, height=height)
+        keep = None
+        for start in range(0, len(self.frame_idx), chunk_size):
+            chunk = vr.get_batch(self.frame_idx[start:start + chunk_size].tolist()).asnumpy()
+            if start == 0:
+                nbytes = len(self.frame_idx) * chunk[0].nbytes
+                if self.cache is not None and nbytes <= min(CACHE_MAX_ENTRY_BYTES, self.cache.max_bytes):
+                    keep = np.empty((len(self.frame_idx),) + chunk.shape[1:], dtype=np.uint8)
+                print(f"[frame_sampler] decoding {len(self.frame_idx)} frames at {chunk.shape[2]}x{chunk.shape[1]} "
+                      f"in chunks of {chunk_size}, packing {self.packing_nums}")
+            if keep is not None:
+                keep[start:start + len(chunk)] = chunk
+            yield chunk
+        if keep is not None:
+            self.cache.put(self.cache_key, self.collected(keep))
+
+    def collected(self, frames):
+        return SampledVideo(frames, self.temporal_ids, self.packing_nums, self.fps, self.duration)
+
+    def decode(self):
+        """All frames at once, as a SampledVideo."""
+        return self.collected(np.concatenate(list(self.chunks())))
+
+
+def prefetch(iterator):
+    """Yield from `iterator` while a background thread already produces the next item."""
+    end = object()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(next, iterator, end)
+        while True:
+            item = future.result()
+            if item is end:
+                return
+            future = executor.submit(next, iterator, end)
+            yield item
+
+
+class FrameCache:
+    """Thread-safe LRU of sampled videos bounded by total frame bytes."""
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def put(self, key, item):
+        size = item.frames.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._items.pop(key).frames.nbytes
+            self._items[key] = item
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.bytes -= evicted.frames.nbytes
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._items), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+frame_cache = FrameCache()
+
+
+def _plan_key(plan):
+    if hasattr(plan, 'func'):  # functools.partial
+        return (plan.func.__name__, plan.args, tuple(sorted(plan.keywords.items())))
+    return plan.__name__
+
+
+def open_video(video_path, choose_fps=None, plan=packing_plan, max_side=VIDEO_MAX_SIDE,
+               use_keyframes=True, cache=frame_cache):
+    """
+    The cached SampledVideo, or a VideoStream to decode chunk by chunk. Either way iterate
+    `.chunks()` for (n, H, W, 3) uint8 frames; only the container is opened here.
+    """
+    key = (video_digest(video_path), choose_fps, _plan_key(plan), max_side, use_keyframes)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            print(f"[frame_sampler] cache hit for {os.path.basename(video_path)}, {len(cached.frames)} frames")
+            return cached
+
+    vr = VideoReader(video_path, ctx=cpu(0))
+    fps = vr.get_avg_fps()
+    num_frames = len(vr)
+    height, width = vr[0].shape[:2]
+    frame_idx, packing_nums = plan(num_frames, fps, choose_fps)
+    if use_keyframes:
+        frame_idx = snap_to_keyframes(frame_idx, vr.get_key_indices(), KEYFRAME_TOLERANCE * fps)
+    del vr
+
+    duration = num_frames / fps
+    frame_ts_id = map_to_nearest_scale(frame_idx / fps, np.arange(0, duration, TIME_SCALE)) / TIME_SCALE
+    temporal_ids = group_array(frame_ts_id.astype(np.int32).tolist(), packing_nums)
+    return VideoStream(video_path, np.asarray(frame_idx), decode_size(width, height, max_side),
+                       temporal_ids, packing_nums, fps, duration, cache=cache, cache_key=key)
+
+
+def sample_video(video_path, choose_fps=None, plan=packing_plan, max_side=VIDEO_MAX_SIDE,
+                 use_keyframes=True, cache=frame_cache):
+    """All sampled frames in memory at once; the clients stream open_video() instead."""
+    video = open_video(video_path, choose_fps, plan, max_side, use_keyframes, cache)
+    return video if isinstance(video, SampledVideo) else video.decode()
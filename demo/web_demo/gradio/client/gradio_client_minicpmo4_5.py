@@ -3,7 +3,7 @@
 import argparse
 import gradio as gr
 from PIL import Image
-from decord import VideoReader, cpu
+from functools import partial
 import io
 import os
 import copy
@@ -15,6 +15,10 @@ import re
 import modelscope_studio as mgr
 import time
 import uuid
+import frame_sampler
+import image_refs
+import session_turns
+import video_upload
 
 ERROR_MSG = "Error, please retry"
 model_name = 'MiniCPM-o 4.5'
@@ -24,6 +28,8 @@ IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
 VIDEO_EXTENSIONS = {'.mp4', '.mkv', '.mov',
                     '.avi', '.flv', '.wmv', '.webm', '.m4v'}
 server_url = 'http://127.0.0.1:9999/api' 
+# upload videos to /api/video and let the server sample frames, instead of sending every frame as PNG
+SERVER_VIDEO_DECODING = True
 
 
 def get_file_extension(filename):
@@ -133,6 +139,19 @@ def check_and_handle_stop(_app_cfg, context="unknown"):
     return False
 
 
+def cancel_request(request_id):
+    """
+    Ask the server to stop generating for a request
+    """
+    if not request_id:
+        return
+    try:
+        res = requests.post(server_url + '/cancel', json={"request_id": request_id}, timeout=2)
+        print(f"[cancel_request] {request_id} cancelled: {res.json().get('cancelled')}")
+    except Exception as e:
+        print(f"[cancel_request] Failed to cancel {request_id}: {e}")
+
+
 def stop_button_clicked(_app_cfg):
     """
     Handle stop button click
@@ -144,6 +163,7 @@ def stop_button_clicked(_app_cfg):
     _app_cfg['stop_streaming'] = True
     _app_cfg['is_streaming'] = False
     print(f"[stop_button_clicked] Set stop_streaming = True, is_streaming = False")
+    cancel_request(_app_cfg.get('request_id'))
     
     return _app_cfg, gr.update(visible=False)
 
@@ -176,12 +196,11 @@ def chat(img_b64, msgs, ctx, params=None, vision_hidden_states=None, session_id=
         if session_id:
             request_data["session_id"] = session_id
         
-        res = requests.post(server_url,
+        res = session_turns.post(server_url, request_data, msgs,
                             headers={
                                 "X-Model-Best-Model": "luca-v-online",
                                 "X-Model-Best-Trace-ID": "web_demo",
-                            },
-                            json=request_data)
+                            })
         if res.status_code != 200:
             print(res.status_code, res.text)
             return -1, ERROR_MSG, None, None
@@ -231,18 +250,22 @@ def chat_stream(img_b64, msgs, ctx, params=None, vision_hidden_states=None, sess
             request_data["session_id"] = session_id
         
 
-        response = requests.post(
-            stream_url,
+        response = session_turns.post(
+            stream_url, request_data, msgs,
             headers={
                 "X-Model-Best-Model": "luca-v-online",
                 "X-Model-Best-Trace-ID": "web_demo",
                 "Accept": "text/event-stream",
                 "Cache-Control": "no-cache",
             },
-            json=request_data,
             stream=True
         )
         
+        if response.status_code in (429, 503):
+            # the server is shedding load, a non-stream retry would only queue up again
+            print(f"Server busy: {response.status_code}, retry after {response.headers.get('Retry-After')}s")
+            return -1, ERROR_MSG, None, None
+
         if response.status_code != 200:
             print(f"Stream request failed: {response.status_code}, falling back to non-stream mode")
 
@@ -262,11 +285,17 @@ def chat_stream(img_b64, msgs, ctx, params=None, vision_hidden_states=None, sess
                         print(f"Stream error: {data['error']}")
                         return -1, ERROR_MSG, None, None
                     
-                    if data.get('finished', False):
-                        full_response = data.get('full_response', full_response)
-                        break
+                    if 'delta' in data:
+                        # v2 stream format: only the new text is sent
+                        full_response += data['delta']
                     else:
                         full_response = data.get('full_response', full_response)
+
+                    if data.get('finished', False):
+                        session_turns.finished(response, data)
+                        if 'usage' in data:
+                            print(f"Stream usage: {data['usage']}")
+                        break
                 
                 except json.JSONDecodeError:
                     continue
@@ -333,11 +362,6 @@ def encode_image(image):
 
 def encode_video(video):
     """Simple video encoding function"""
-    def uniform_sample(l, n):
-        gap = len(l) / n
-        idxs = [int(i * gap + gap / 2) for i in range(n)]
-        return [l[i] for i in idxs]
-
     if hasattr(video, 'path'):
         video_path = video.path
     elif hasattr(video, 'file') and hasattr(video.file, 'path'):
@@ -346,16 +370,20 @@ def encode_video(video):
         video_path = video.name
     else:
         video_path = getattr(video, 'url', getattr(video, 'orig_name', str(video)))
-    
-    vr = VideoReader(video_path, ctx=cpu(0))
-    sample_fps = round(vr.get_avg_fps() / 1)  # FPS
-    frame_idx = [i for i in range(0, len(vr), sample_fps)]
-    if len(frame_idx) >= MAX_NUM_FRAMES:
-        frame_idx = uniform_sample(frame_idx, MAX_NUM_FRAMES - 1)
-    
-    video_frames = vr.get_batch(frame_idx).asnumpy()
-    video_frames = [Image.fromarray(v.astype('uint8')) for v in video_frames]
-    video_frames = [encode_image(v)[0] for v in video_frames]
+
+    if SERVER_VIDEO_DECODING:
+        try:
+            contents, _ = video_upload.upload(server_url, video_path)
+            return contents
+        except requests.RequestException as e:
+            print(f"[video_upload] upload failed ({e}), decoding locally")
+
+    video = frame_sampler.open_video(
+        video_path, plan=partial(frame_sampler.one_fps_plan, max_num_frames=MAX_NUM_FRAMES))
+    # decode in chunks, so only a few frames are held at a time
+    video_frames = []
+    for chunk in frame_sampler.prefetch(video.chunks()):
+        video_frames.extend(encode_image(Image.fromarray(v))[0] for v in chunk)
     return video_frames
 
 
@@ -747,6 +775,7 @@ def chat_stream_character_generator(img_b64, msgs, ctx, params=None, vision_hidd
     print(f"[chat_stream_character_generator] Starting character-level streaming")
     print(f"[chat_stream_character_generator] stop_control: {stop_control}")
     
+    response = None
     try:
         stream_url = server_url.replace('/api', '/api/stream')
         print(f"[chat_stream_character_generator] Stream URL: {stream_url}")
@@ -762,15 +791,20 @@ def chat_stream_character_generator(img_b64, msgs, ctx, params=None, vision_hidd
             request_data["session_id"] = session_id
         
 
-        response = requests.post(
-            stream_url,
+        # lets the stop button cancel generation on the server
+        request_id = uuid.uuid4().hex
+        request_data["request_id"] = request_id
+        if stop_control is not None:
+            stop_control['request_id'] = request_id
+
+        response = session_turns.post(
+            stream_url, request_data, msgs,
             headers={
                 "X-Model-Best-Model": "luca-v-online",
                 "X-Model-Best-Trace-ID": "web_demo",
                 "Accept": "text/event-stream",
                 "Cache-Control": "no-cache",
             },
-            json=request_data,
             stream=True
         )
         
@@ -780,6 +814,7 @@ def chat_stream_character_generator(img_b64, msgs, ctx, params=None, vision_hidd
             return
         
         last_length = 0
+        current_response = ''
         char_count = 0
         
         for line in response.iter_lines(decode_unicode=True):
@@ -793,13 +828,19 @@ def chat_stream_character_generator(img_b64, msgs, ctx, params=None, vision_hidd
                     data = json.loads(data_str)
                     
                     if 'error' in data:
+                        image_refs.forget(data.get('missing_images', []))
                         for char in f"Error: {data['error']}":
                             yield char
                         return
                     
-                    current_response = data.get('full_response', '')
+                    if 'delta' in data:
+                        # v2 stream format: only the new text is sent
+                        current_response += data['delta']
+                    else:
+                        current_response = data.get('full_response', current_response)
                     
                     if data.get('finished', False):
+                        session_turns.finished(response, data)
                         if len(current_response) > last_length:
                             remaining = current_response[last_length:]
                             clean_remaining = re.sub(r'(<box>.*</box>)', '', remaining)
@@ -844,6 +885,10 @@ def chat_stream_character_generator(img_b64, msgs, ctx, params=None, vision_hidd
         print(f"[chat_stream_character_generator] Exception: {e}")
         for char in f"Stream error: {str(e)}":
             yield char
+    finally:
+        # closing the connection also makes the server cancel the request
+        if response is not None:
+            response.close()
 
 
 def fewshot_add_demonstration(_image, _user_message, _assistant_message, _chat_bot, _app_cfg):
@@ -1536,9 +1581,15 @@ if __name__ == "__main__":
                         help='Port to run the web demo on')
     parser.add_argument('--server', type=str, default=server_url,
                         help='Server URL to connect to')
+    parser.add_argument('--client-video-decoding', action='store_true',
+                        help='Decode videos here and send frames as images instead of uploading them to /api/video')
+    parser.add_argument('--stateless', action='store_true',
+                        help='Send the whole conversation with every request instead of only the new turns')
     args = parser.parse_args()
     port = args.port
     server_url = args.server
+    SERVER_VIDEO_DECODING = not args.client_video_decoding
+    session_turns.ENABLED = not args.stateless
     
     demo.launch(share=False, debug=True, show_api=False,
                 server_port=port, server_name="0.0.0.0")
@@ -4,7 +4,7 @@ import sys
 import argparse
 import gradio as gr
 from PIL import Image
-from decord import VideoReader, cpu
+from functools import partial
 import io
 import os
 import copy
@@ -14,6 +14,7 @@ import json
 import traceback
 import re
 import modelscope_studio as mgr
+import frame_sampler
 
 
 ERROR_MSG = "Error, please retry"
@@ -138,23 +139,17 @@ def encode_image(image):
 
 
 def encode_video(video):
-    def uniform_sample(l, n):
-        gap = len(l) / n
-        idxs = [int(i * gap + gap / 2) for i in range(n)]
-        return [l[i] for i in idxs]
-
     if hasattr(video, 'path'):
-        vr = VideoReader(video.path, ctx=cpu(0))
+        video_path = video.path
     else:
-        vr = VideoReader(video.file.path, ctx=cpu(0))
-    sample_fps = round(vr.get_avg_fps() / 1)  # FPS
-    frame_idx = [i for i in range(0, len(vr), sample_fps)]
-    if len(frame_idx) >= MAX_NUM_FRAMES:
-        frame_idx = uniform_sample(frame_idx, MAX_NUM_FRAMES - 1)
-    video = vr.get_batch(frame_idx).asnumpy()
-    video = [Image.fromarray(v.astype('uint8')) for v in video]
-    video = [encode_image(v)[0] for v in video]
-    return video
+        video_path = video.file.path
+    # 1 fps plan, decoded at reduced size and in chunks instead of one native-resolution batch
+    video = frame_sampler.open_video(
+        video_path, plan=partial(frame_sampler.one_fps_plan, max_num_frames=MAX_NUM_FRAMES))
+    video_frames = []
+    for chunk in frame_sampler.prefetch(video.chunks()):
+        video_frames.extend(encode_image(Image.fromarray(v))[0] for v in chunk)
+    return video_frames
 
 
 def check_mm_type(mm_file):
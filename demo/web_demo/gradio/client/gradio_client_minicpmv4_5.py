@@ -3,9 +3,6 @@
 import argparse
 import gradio as gr
 from PIL import Image
-from decord import VideoReader, cpu
-from scipy.spatial import cKDTree
-import numpy as np
 import io
 import os
 import copy
@@ -14,19 +11,19 @@ import base64
 import json
 import traceback
 import re
-import math
 import modelscope_studio as mgr
 import multiprocessing as mp
 import time
 import uuid
+import frame_encoder
+import frame_sampler
+import image_refs
+import session_turns
+import video_upload
 
 ERROR_MSG = "Error, please retry"
 model_name = 'MiniCPM-V 4.5'
 disable_text_only = True
-DOUBLE_FRAME_DURATION = 30
-MAX_NUM_FRAMES = 180
-MAX_NUM_PACKING = 3
-TIME_SCALE = 0.1
 IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
 VIDEO_EXTENSIONS = {'.mp4', '.mkv', '.mov',
                     '.avi', '.flv', '.wmv', '.webm', '.m4v'}
@@ -34,6 +31,14 @@ server_url = 'http://127.0.0.1:9999/api'
 
 ENABLE_PARALLEL_ENCODING = True
 PARALLEL_PROCESSES = None
+# format of client-encoded video frames: png is lossless, jpeg/webp are smaller and faster at FRAME_QUALITY
+FRAME_FORMAT = 'png'
+FRAME_QUALITY = frame_encoder.DEFAULT_QUALITY
+ENCODER = None
+# upload videos to /api/video and let the server sample frames, instead of sending every frame as PNG
+SERVER_VIDEO_DECODING = True
+# tokens the model may spend inside <think> before it has to answer, None is unlimited
+THINKING_BUDGET = None
 
 
 def get_file_extension(filename):
@@ -48,16 +53,6 @@ def is_video(filename):
     return get_file_extension(filename) in VIDEO_EXTENSIONS
 
 
-def map_to_nearest_scale(values, scale):
-    tree = cKDTree(np.asarray(scale)[:, None])
-    _, indices = tree.query(np.asarray(values)[:, None])
-    return np.asarray(scale)[indices]
-
-
-def group_array(arr, size):
-    return [arr[i:i+size] for i in range(0, len(arr), size)]
-
-
 form_radio = {
     'choices': ['Beam Search', 'Sampling'],
     'value': 'Sampling',
@@ -162,6 +157,19 @@ def check_and_handle_stop(_app_cfg, context="unknown"):
     return False
 
 
+def cancel_request(request_id):
+    """
+    Ask the server to stop generating for a request
+    """
+    if not request_id:
+        return
+    try:
+        res = requests.post(server_url + '/cancel', json={"request_id": request_id}, timeout=2)
+        print(f"[cancel_request] {request_id} cancelled: {res.json().get('cancelled')}")
+    except Exception as e:
+        print(f"[cancel_request] Failed to cancel {request_id}: {e}")
+
+
 def stop_button_clicked(_app_cfg):
     """
     Handle stop button click
@@ -173,6 +181,7 @@ def stop_button_clicked(_app_cfg):
     _app_cfg['stop_streaming'] = True
     _app_cfg['is_streaming'] = False
     print(f"[stop_button_clicked] Set stop_streaming = True, is_streaming = False")
+    cancel_request(_app_cfg.get('request_id'))
     
     return _app_cfg, gr.update(visible=False)
 
@@ -208,12 +217,11 @@ def chat(img_b64, msgs, ctx, params=None, vision_hidden_states=None, temporal_id
         if session_id:
             request_data["session_id"] = session_id
         
-        res = requests.post(server_url,
+        res = session_turns.post(server_url, request_data, msgs,
                             headers={
                                 "X-Model-Best-Model": "luca-v-online",
                                 "X-Model-Best-Trace-ID": "web_demo",
-                            },
-                            json=request_data)
+                            })
         if res.status_code != 200:
             print(res.status_code, res.text)
             return -1, ERROR_MSG, None, None
@@ -266,18 +274,22 @@ def chat_stream(img_b64, msgs, ctx, params=None, vision_hidden_states=None, temp
             request_data["session_id"] = session_id
         
 
-        response = requests.post(
-            stream_url,
+        response = session_turns.post(
+            stream_url, request_data, msgs,
             headers={
                 "X-Model-Best-Model": "luca-v-online",
                 "X-Model-Best-Trace-ID": "web_demo",
                 "Accept": "text/event-stream",
                 "Cache-Control": "no-cache",
             },
-            json=request_data,
             stream=True
         )
         
+        if response.status_code in (429, 503):
+            # the server is shedding load, a non-stream retry would only queue up again
+            print(f"Server busy: {response.status_code}, retry after {response.headers.get('Retry-After')}s")
+            return -1, ERROR_MSG, None, None
+
         if response.status_code != 200:
             print(f"Stream request failed: {response.status_code}, falling back to non-stream mode")
 
@@ -297,11 +309,17 @@ def chat_stream(img_b64, msgs, ctx, params=None, vision_hidden_states=None, temp
                         print(f"Stream error: {data['error']}")
                         return -1, ERROR_MSG, None, None
                     
-                    if data.get('finished', False):
-                        full_response = data.get('full_response', full_response)
-                        break
+                    if 'delta' in data:
+                        # v2 stream format: only the new text is sent
+                        full_response += data['delta']
                     else:
                         full_response = data.get('full_response', full_response)
+
+                    if data.get('finished', False):
+                        session_turns.finished(response, data)
+                        if 'usage' in data:
+                            print(f"Stream usage: {data['usage']}")
+                        break
                 
                 except json.JSONDecodeError:
                     continue
@@ -366,103 +384,35 @@ def encode_image(image):
     return [{"type": "image", "pairs": im_b64}]
 
 
-def encode_image_parallel(image_data):
-    """
-    Parallel image encoding wrapper function
-    Args:
-        image_data: Can be PIL image object or file path
-    Returns:
-        Encoded image data
-    """
-    try:
-        return encode_image(image_data)
-    except Exception as e:
-        print(f"[Parallel encoding error] Image encoding failed: {e}")
-        return None
+def get_encoder():
+    """The client's frame encoder; started in __main__ before gradio creates its threads."""
+    global ENCODER
+    if ENCODER is None:
+        processes = (PARALLEL_PROCESSES or None) if ENABLE_PARALLEL_ENCODING else 1
+        ENCODER = frame_encoder.EncoderPool(processes, FRAME_FORMAT, FRAME_QUALITY)
+    return ENCODER
 
 
-def encode_images_parallel(frames, num_processes=None):
+def encode_images_parallel(frames):
     """
-    Multi-process parallel image encoding (high performance version)
-    Args:
-        frames: List of images
-        num_processes: Number of processes, defaults to using more CPU cores
-    Returns:
-        List of encoded images
+    Encode sampled video frames as image contents. Frames are handed to the long-lived worker pool
+    through one shared-memory block instead of pickling them to a new pool per video.
     """
-
-    if not ENABLE_PARALLEL_ENCODING:
-        print(f"[Parallel encoding] Parallel encoding disabled, using serial processing")
-        encoded_frames = []
-        for frame in frames:
-            encoded = encode_image(frame)
-            if encoded:
-                encoded_frames.extend(encoded)
-        return encoded_frames
-    
-
-    if num_processes is None:
-        cpu_cores = mp.cpu_count()
-
-        if PARALLEL_PROCESSES:
-            num_processes = PARALLEL_PROCESSES
-        else:
-
-            if len(frames) >= 50:
-                num_processes = min(cpu_cores, len(frames), 32)
-            elif len(frames) >= 20:
-                num_processes = min(cpu_cores, len(frames), 16)
-            else:
-                num_processes = min(cpu_cores, len(frames), 8)
-    
-    print(f"[Parallel encoding] Starting parallel encoding of {len(frames)} frame images, using {num_processes} processes")
-    
-
-    if len(frames) <= 2:
-        print(f"[Parallel encoding] Few images ({len(frames)} frames), using serial processing")
-        encoded_frames = []
-        for i, frame in enumerate(frames):
-            encoded = encode_image(frame)
-            if encoded:
-                encoded_frames.extend(encoded)
-        return encoded_frames
-    
-
     start_time = time.time()
+    encoder = get_encoder()
     try:
-        with mp.Pool(processes=num_processes) as pool:
-
-            results = pool.map(encode_image_parallel, frames)
-            
-
-            encoded_frames = []
-            for result in results:
-                if result:
-                    encoded_frames.extend(result)
-            
-            total_time = time.time() - start_time
-            print(f"[Parallel encoding] Parallel encoding completed, total time: {total_time:.3f}s, encoded {len(encoded_frames)} images")
-            
-            return encoded_frames
-            
+        encoded_frames = encoder.encode_contents(frames)
     except Exception as e:
         print(f"[Parallel encoding] Parallel processing failed, falling back to serial processing: {e}")
-
-        encoded_frames = []
-        for frame in frames:
-            encoded = encode_image(frame)
-            if encoded:
-                encoded_frames.extend(encoded)
-        return encoded_frames
+        encoded_frames = [{"type": "image", "pairs": b64} for b64 in encoder.encode_serial(frames)]
+    total_time = time.time() - start_time
+    print(f"[Parallel encoding] Encoded {len(encoded_frames)} frames as {encoder.fmt} "
+          f"with {encoder.processes} processes in {total_time:.3f}s")
+    return encoded_frames
 
 
 def encode_video(video, choose_fps=None):
     """Improved video encoding function with timestamp support and smart packing, supports custom FPS"""
-    def uniform_sample(l, n):
-        gap = len(l) / n
-        idxs = [int(i * gap + gap / 2) for i in range(n)]
-        return [l[i] for i in idxs]
-
     if hasattr(video, 'path'):
         video_path = video.path
     elif hasattr(video, 'file') and hasattr(video.file, 'path'):
@@ -471,64 +421,23 @@ def encode_video(video, choose_fps=None):
         video_path = video.name
     else:
         video_path = getattr(video, 'url', getattr(video, 'orig_name', str(video)))
-    
-    vr = VideoReader(video_path, ctx=cpu(0))
-    fps = vr.get_avg_fps()
-    video_duration = len(vr) / fps
-
-    frame_idx = [i for i in range(0, len(vr))]
-    
-    effective_fps = choose_fps if choose_fps else 1
-    
-
-    if video_duration < DOUBLE_FRAME_DURATION and effective_fps <= 5:
-        effective_fps = effective_fps * 2
-        packing_nums = 2
-        choose_frames = round(min(effective_fps, round(fps)) * min(MAX_NUM_FRAMES, video_duration))
-    elif effective_fps * int(video_duration) <= MAX_NUM_FRAMES:
-        packing_nums = 1
-        choose_frames = round(min(effective_fps, round(fps)) * min(MAX_NUM_FRAMES, video_duration))
-    else:
-        packing_size = math.ceil(video_duration * effective_fps / MAX_NUM_FRAMES)
-        if packing_size <= MAX_NUM_PACKING:
-            choose_frames = round(video_duration * effective_fps)
-            packing_nums = packing_size
-        else:
-            choose_frames = round(MAX_NUM_FRAMES * MAX_NUM_PACKING)
-            packing_nums = MAX_NUM_PACKING
-    
-    choose_idx = choose_frames
-    
-    frame_idx = np.array(uniform_sample(frame_idx, choose_idx))
-    frames = vr.get_batch(frame_idx).asnumpy()
 
-    frame_idx_ts = frame_idx / fps
-    scale = np.arange(0, video_duration, TIME_SCALE)
+    if SERVER_VIDEO_DECODING:
+        try:
+            return video_upload.upload(server_url, video_path, choose_fps)
+        except requests.RequestException as e:
+            print(f"[video_upload] upload failed ({e}), decoding locally")
 
-    frame_ts_id = map_to_nearest_scale(frame_idx_ts, scale) / TIME_SCALE
-    frame_ts_id = frame_ts_id.astype(np.int32)
+    # decoding, keyframe snapping and the decoded-frame cache live in frame_sampler
+    video = frame_sampler.open_video(video_path, choose_fps)
+    print(f"[Performance] Starting image encoding, total {len(video)} frames")
+    encoded_frames = []
+    # frames are decoded a chunk at a time and each chunk is encoded while the next one decodes,
+    # so client memory stays bounded however long the clip is
+    for chunk in frame_sampler.prefetch(video.chunks()):
+        encoded_frames.extend(encode_images_parallel(chunk))
 
-    assert len(frames) == len(frame_ts_id)
-
-    frames = [Image.fromarray(v.astype('uint8')).convert('RGB') for v in frames]
-    frame_ts_id_group = group_array(frame_ts_id.tolist(), packing_nums)
-    
-
-    print(f"[Performance] Starting image encoding, total {len(frames)} frames")
-    
-
-    if ENABLE_PARALLEL_ENCODING:
-        print(f"[Image encoding] Using multi-process parallel encoding, CPU cores: {mp.cpu_count()}")
-        encoded_frames = encode_images_parallel(frames, PARALLEL_PROCESSES)
-    else:
-        print("[Warning] Parallel encoding disabled, using serial processing")
-        encoded_frames = []
-        for frame in frames:
-            encoded = encode_image(frame)
-            if encoded:
-                encoded_frames.extend(encoded)
-    
-    return encoded_frames, frame_ts_id_group
+    return encoded_frames, video.temporal_ids
 
 
 def parse_thinking_response(response_text):
@@ -762,6 +671,8 @@ def respond_stream(_question, _chat_bot, _app_cfg, params_form, thinking_mode, s
             "enable_thinking": thinking_mode,
             "stream": streaming_mode
         }
+    if thinking_mode and THINKING_BUDGET is not None:
+        params["thinking_budget_tokens"] = THINKING_BUDGET
 
     if files_cnts[1] + videos_cnt > 0:
         params["max_inp_length"] = 2048 * 10  # 与test_video.py保持一致：20480
@@ -896,6 +807,8 @@ def respond(_question, _chat_bot, _app_cfg, params_form, thinking_mode, streamin
             "enable_thinking": thinking_mode,
             "stream": False  # 非流式模式
         }
+    if thinking_mode and THINKING_BUDGET is not None:
+        params["thinking_budget_tokens"] = THINKING_BUDGET
 
     if files_cnts[1] + videos_cnt > 0:
         params["max_inp_length"] = 2048 * 10  # 与test_video.py保持一致：20480
@@ -964,6 +877,7 @@ def chat_stream_character_generator(img_b64, msgs, ctx, params=None, vision_hidd
     print(f"[chat_stream_character_generator] Starting character-level streaming")
     print(f"[chat_stream_character_generator] stop_control: {stop_control}")
     
+    response = None
     try:
         stream_url = server_url.replace('/api', '/api/stream')
         print(f"[chat_stream_character_generator] Stream URL: {stream_url}")
@@ -982,15 +896,20 @@ def chat_stream_character_generator(img_b64, msgs, ctx, params=None, vision_hidd
             request_data["session_id"] = session_id
         
 
-        response = requests.post(
-            stream_url,
+        # lets the stop button cancel generation on the server
+        request_id = uuid.uuid4().hex
+        request_data["request_id"] = request_id
+        if stop_control is not None:
+            stop_control['request_id'] = request_id
+
+        response = session_turns.post(
+            stream_url, request_data, msgs,
             headers={
                 "X-Model-Best-Model": "luca-v-online",
                 "X-Model-Best-Trace-ID": "web_demo",
                 "Accept": "text/event-stream",
                 "Cache-Control": "no-cache",
             },
-            json=request_data,
             stream=True
         )
         
@@ -1000,6 +919,7 @@ def chat_stream_character_generator(img_b64, msgs, ctx, params=None, vision_hidd
             return
         
         last_length = 0
+        current_response = ''
         char_count = 0  # 添加字符计数器
         
         for line in response.iter_lines(decode_unicode=True):
@@ -1014,13 +934,19 @@ def chat_stream_character_generator(img_b64, msgs, ctx, params=None, vision_hidd
                     data = json.loads(data_str)
                     
                     if 'error' in data:
+                        image_refs.forget(data.get('missing_images', []))
                         for char in f"Error: {data['error']}":
                             yield char
                         return
                     
-                    current_response = data.get('full_response', '')
+                    if 'delta' in data:
+                        # v2 stream format: only the new text is sent
+                        current_response += data['delta']
+                    else:
+                        current_response = data.get('full_response', current_response)
                     
                     if data.get('finished', False):
+                        session_turns.finished(response, data)
                         # 最终处理：yield剩余的字符
                         if len(current_response) > last_length:
                             remaining = current_response[last_length:]
@@ -1073,6 +999,10 @@ def chat_stream_character_generator(img_b64, msgs, ctx, params=None, vision_hidd
         print(f"[chat_stream_character_generator] 异常: {e}")
         for char in f"Stream error: {str(e)}":
             yield char
+    finally:
+        # closing the connection also makes the server cancel the request
+        if response is not None:
+            response.close()
 
 
 def fewshot_add_demonstration(_image, _user_message, _assistant_message, _chat_bot, _app_cfg):
@@ -1165,6 +1095,8 @@ def fewshot_respond(_image, _user_message, _chat_bot, _app_cfg, params_form, thi
             "enable_thinking": thinking_mode,
             "stream": streaming_mode  # 使用UI控制的流式模式
         }
+    if thinking_mode and THINKING_BUDGET is not None:
+        params["thinking_budget_tokens"] = THINKING_BUDGET
 
     if disable_text_only and images_cnt == 0:
         gr.Warning("Please chat with at least one image or video.")
@@ -1817,6 +1749,16 @@ if __name__ == "__main__":
                         help='Disable parallel image encoding (use serial processing instead)')
     parser.add_argument('--parallel-processes', type=int, default=None,
                         help='Number of parallel processes for image encoding (default: auto-detect, use more CPU cores for better performance)')
+    parser.add_argument('--client-video-decoding', action='store_true',
+                        help='Decode videos here and send frames as images instead of uploading them to /api/video')
+    parser.add_argument('--stateless', action='store_true',
+                        help='Send the whole conversation with every request instead of only the new turns')
+    parser.add_argument('--frame-format', type=str, default=FRAME_FORMAT, choices=frame_encoder.FORMATS,
+                        help='Image format of client-encoded video frames (png is lossless)')
+    parser.add_argument('--frame-quality', type=int, default=FRAME_QUALITY,
+                        help='JPEG/WebP quality of client-encoded video frames')
+    parser.add_argument('--thinking-budget', type=int, default=None,
+                        help='Maximum tokens inside <think> in thinking mode, then the model has to answer')
     args = parser.parse_args()
     port = args.port
     server_url = args.server
@@ -1829,11 +1771,21 @@ if __name__ == "__main__":
         ENABLE_PARALLEL_ENCODING = True
         print("[性能优化] 并行图像编码已启用")
     
+    SERVER_VIDEO_DECODING = not args.client_video_decoding
+    session_turns.ENABLED = not args.stateless
+    THINKING_BUDGET = args.thinking_budget
+
     if args.parallel_processes:
         PARALLEL_PROCESSES = args.parallel_processes
         print(f"[性能优化] 设置并行进程数为: {PARALLEL_PROCESSES}")
     else:
         print(f"[性能优化] 自动检测并行进程数，CPU核心数: {mp.cpu_count()}")
-    
+
+    FRAME_FORMAT = args.frame_format
+    FRAME_QUALITY = args.frame_quality
+    # fork the encoder workers now, while the process has no other threads
+    get_encoder().start()
+    print(f"[性能优化] 视频帧编码: {FRAME_FORMAT}, {get_encoder().processes} 个常驻进程")
+
     demo.launch(share=False, debug=True, show_api=False,
                 server_port=port, server_name="0.0.0.0")
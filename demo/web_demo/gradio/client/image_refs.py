@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Send images the server has already seen as `{"type": "image_ref", "hash": ...}` instead of base64.
+
+The server keeps decoded images in an LRU keyed by the sha256 of the image bytes. If it no longer
+has one of the referenced images it answers 409, and the request is resent with full images.
+Evicted `video_ref` videos are uploaded again before the request is retried.
+"""
+import base64
+import hashlib
+import json
+import threading
+from functools import lru_cache
+
+import requests
+
+import video_upload
+
+_known = set()
+_lock = threading.Lock()
+
+
+@lru_cache(maxsize=4096)
+def image_hash(b64):
+    return hashlib.sha256(base64.b64decode(b64)).hexdigest()
+
+
+def _images(msgs):
+    for msg in msgs:
+        for c in msg.get('content', msg.get('contents', [])):
+            if isinstance(c, dict) and c.get('type') == 'image':
+                yield c
+
+
+def compact_msgs(msgs):
+    """Copy of `msgs` with known images replaced by refs, or `msgs` itself if nothing changed."""
+    with _lock:
+        known = set(_known)
+    if not any(image_hash(c['pairs']) in known for c in _images(msgs)):
+        return msgs
+    compact = []
+    for msg in msgs:
+        key = 'content' if 'content' in msg else 'contents'
+        contents = []
+        for c in msg.get(key, []):
+            if isinstance(c, dict) and c.get('type') == 'image' and image_hash(c['pairs']) in known:
+                c = {'type': 'image_ref', 'hash': image_hash(c['pairs'])}
+            contents.append(c)
+        compact.append({**msg, key: contents})
+    return compact
+
+
+def remember(msgs):
+    with _lock:
+        _known.update(image_hash(c['pairs']) for c in _images(msgs))
+
+
+def forget(hashes):
+    with _lock:
+        _known.difference_update(hashes)
+
+
+def post(url, request_data, msgs, **kwargs):
+    """requests.post with known images sent as refs; retries with full images if the server lost some."""
+    res = _post(url, request_data, msgs, **kwargs)
+    if res.status_code == 409:
+        missing = res.json().get('detail', {}).get('missing_videos', [])
+        if missing and video_upload.reupload(missing):
+            print(f"[image_refs] server lost {len(missing)} video(s), uploaded them again")
+            res = _post(url, request_data, msgs, **kwargs)
+    return res
+
+
+def _post(url, request_data, msgs, **kwargs):
+    compact = compact_msgs(msgs)
+    if compact is not msgs:
+        res = requests.post(url, json={**request_data, "question": json.dumps(compact, ensure_ascii=True)}, **kwargs)
+        if res.status_code != 409:
+            if res.status_code == 200:
+                remember(msgs)
+            return res
+        missing = res.json().get('detail', {}).get('missing_images', [])
+        if not missing:
+            return res
+        print(f"[image_refs] server lost {len(missing)} image(s), resending full images")
+        forget(missing)
+    res = requests.post(url, json=request_data, **kwargs)
+    if res.status_code == 200:
+        remember(msgs)
+    return res
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Send only the new messages of a conversation instead of the whole history every turn.
+
+The server keeps each session's conversation as a tree of turns. A request names the turn it continues
+from (`parent_turn_id`) and carries the messages after it, and the answer returns the new turn ids.
+The client remembers, per session, the path the server confirmed last and matches each request's
+history against it: regenerate, stopped streams and few-shot examples added locally simply continue
+from the last turn both sides agree on, and the server branches there. If the server lost the session
+(expiry, eviction, another instance) it answers 404, and the full history is sent from the root.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import image_refs
+
+ROOT = 'root'
+MAX_SESSIONS = 1000
+# False sends the full history with every request, as before
+ENABLED = True
+
+_paths = OrderedDict()  # session_id -> [(fingerprint, turn_id)]; None fingerprints are generated answers
+_lock = threading.Lock()
+
+
+def _fingerprint(msg):
+    return hashlib.sha1(json.dumps(msg, sort_keys=True, ensure_ascii=True).encode()).hexdigest()
+
+
+def known_prefix(session_id, msgs):
+    """Path entries of the longest prefix of `msgs` that the server already has."""
+    with _lock:
+        path = list(_paths.get(session_id, ()))
+    known = []
+    for (fingerprint, turn_id), msg in zip(path, msgs):
+        if fingerprint is None:
+            # the server stored the answer it generated, the client may keep a cleaned-up copy
+            if msg.get('role') != 'assistant':
+                break
+        elif fingerprint != _fingerprint(msg):
+            break
+        known.append((fingerprint, turn_id))
+    return known
+
+
+def forget(session_id):
+    with _lock:
+        _paths.pop(session_id, None)
+
+
+def _confirm(session_id, msgs, known, turn_ids):
+    # turn_ids: one per message sent, then the answer's
+    new = [(_fingerprint(msg), turn_id) for msg, turn_id in zip(msgs[len(known):], turn_ids)]
+    with _lock:
+        _paths[session_id] = known + new + [(None, turn_ids[-1])]
+        _paths.move_to_end(session_id)
+        while len(_paths) > MAX_SESSIONS:
+            _paths.popitem(last=False)
+
+
+def _send(url, request_data, msgs, known, **kwargs):
+    delta = msgs[len(known):]
+    data = {
+        **request_data,
+        "question": json.dumps(delta, ensure_ascii=True),
+        "parent_turn_id": known[-1][1] if known else ROOT,
+    }
+    res = image_refs.post(url, data, delta, **kwargs)
+    res.turns = (request_data["session_id"], msgs, known)
+    return res
+
+
+def post(url, request_data, msgs, **kwargs):
+    """
+    image_refs.post that only sends the messages the session does not have yet. Non-stream answers
+    are recorded here; for streams call finished() with the final event.
+    """
+    session_id = request_data.get("session_id")
+    if not ENABLED or not session_id:
+        return image_refs.post(url, request_data, msgs, **kwargs)
+    known = known_prefix(session_id, msgs)
+    res = _send(url, request_data, msgs, known, **kwargs)
+    # 404: the session or turn is gone; 409: images of the stored history fell out of the image cache
+    if known and res.status_code in (404, 409):
+        print(f"[session_turns] server lost session {session_id} ({res.status_code}), resending the full history")
+        res.close()
+        forget(session_id)
+        res = _send(url, request_data, msgs, [], **kwargs)
+    if res.status_code == 200 and not kwargs.get('stream'):
+        try:
+            finished(res, res.json().get('data', {}))
+        except ValueError:
+            pass
+    return res
+
+
+def finished(res, data):
+    """Record the turn ids of a successful answer (`data` is the response data or the final stream event)."""
+    turns = getattr(res, 'turns', None)
+    if turns is not None and data.get('turn_ids'):
+        _confirm(*turns, data['turn_ids'])
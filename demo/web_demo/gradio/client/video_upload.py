@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Upload videos to the server's /api/video instead of decoding them here and sending every frame as
+a base64 PNG. The server samples the frames and returns a `video_id`, sent as
+`{"type": "video_ref", "video_id": ...}`, plus the temporal ids for the chat request.
+
+Uploaded paths are remembered, so videos the server has evicted (409 `missing_videos`) can be uploaded again.
+"""
+import threading
+
+import requests
+
+_uploads = {}  # video_id -> (upload url, path, fps)
+_lock = threading.Lock()
+
+
+def video_url(api_url):
+    """/api/video next to the /api or /api/stream endpoint the client talks to."""
+    base = api_url.rstrip('/')
+    if base.endswith('/stream'):
+        base = base[:-len('/stream')]
+    return base + '/video'
+
+
+def upload(api_url, video_path, choose_fps=None, timeout=600):
+    """Returns the message contents for the video and its temporal ids (None for models without them)."""
+    url = video_url(api_url)
+    with open(video_path, 'rb') as f:
+        # requests streams file objects, the video is never read into memory at once
+        res = requests.post(url, data=f, params={'fps': choose_fps} if choose_fps else None, timeout=timeout)
+    res.raise_for_status()
+    info = res.json()
+    with _lock:
+        _uploads[info['video_id']] = (url, video_path, choose_fps)
+    print(f"[video_upload] {video_path}: {info['num_frames']} frames sampled by the server")
+    return [{"type": "video_ref", "video_id": info['video_id']}], info['temporal_ids']
+
+
+def reupload(video_ids):
+    """Upload evicted videos again; the server derives the same ids from the same file. False if any is unknown."""
+    for vid in video_ids:
+        with _lock:
+            entry = _uploads.get(vid)
+        if entry is None:
+            return False
+        url, path, choose_fps = entry
+        with open(path, 'rb') as f:
+            res = requests.post(url, data=f, params={'fps': choose_fps} if choose_fps else None, timeout=600)
+        if res.status_code != 200:
+            return False
+    return True
@@ -0,0 +1,298 @@
+import logging
+import math
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import metrics
+from models import cancellations, timings, RequestTiming
+
+logger = logging.getLogger(__name__)
+
+_STREAM_END = object()
+
+
+class AdmissionRejected(Exception):
+    """Request turned away before it ran; maps to an HTTP error with Retry-After."""
+    status_code = 503
+
+    def __init__(self, message, estimated_wait):
+        super().__init__(message)
+        self.estimated_wait = estimated_wait
+
+    @property
+    def retry_after(self):
+        return max(1, math.ceil(self.estimated_wait))
+
+
+class QueueFullError(AdmissionRejected):
+    pass
+
+
+class WaitTooLong(AdmissionRejected):
+    # the request could be served, just not within its deadline
+    status_code = 429
+
+
+class DeadlineExceeded(AdmissionRejected):
+    pass
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class _Request:
+    def __init__(self, query, stream, batch_key, deadline):
+        self.query = query
+        self.stream = stream
+        self.batch_key = batch_key
+        self.enqueued_at = time.monotonic()
+        self.deadline = self.enqueued_at + deadline if deadline else None
+        self.future = Future()
+        self.started = Future()
+        self.chunks = queue.Queue()
+
+
+class BatchScheduler:
+    """
+    Single GPU worker thread fed by a request queue.
+
+    Non-streaming requests with the same `model.batch_key(query)` are coalesced into one
+    `model.batch_handler` call: the worker waits up to `max_wait_ms` after the first request
+    for up to `max_batch_size` compatible ones. Streaming requests and requests whose batch key
+    is None run alone, in arrival order.
+
+    Admission: every request gets a deadline to start by (`max_queue_wait` seconds unless the
+    request asks for less). Requests whose estimated wait, from an EWMA of recent service times,
+    already exceeds it are rejected up front; requests still queued at their deadline are dropped.
+    """
+
+    def __init__(self, model, max_batch_size=1, max_wait_ms=10, max_queue_size=64, max_queue_wait=60):
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size
+        self.max_queue_wait = max_queue_wait
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._batches = 0
+        self._batched_requests = 0
+        self._rejected = metrics.rejected_total
+        self._service_time = None  # EWMA seconds per request
+        self._running_since = None
+        self.queue_depth_hist = metrics.queue_depth
+        self.queue_wait_hist = metrics.queue_wait
+        self._worker = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+        self._worker.start()
+
+    def estimated_wait(self, ahead=None):
+        """Seconds until a request queued now would start."""
+        if self._service_time is None:
+            return 0.0
+        if ahead is None:
+            ahead = len(self._queue)
+        running_since = self._running_since
+        remaining = 0.0
+        if running_since is not None:
+            remaining = max(self._service_time - (time.monotonic() - running_since), 0.0)
+        return remaining + ahead * self._service_time
+
+    def _enqueue(self, query, stream, deadline=None):
+        batch_key = None
+        if not stream and self.max_batch_size > 1:
+            batch_key = self.model.batch_key(query)
+        deadline = min(deadline, self.max_queue_wait) if deadline else self.max_queue_wait
+        request = _Request(query, stream, batch_key, deadline)
+        with self._cond:
+            depth = len(self._queue)
+            self.queue_depth_hist.observe(depth)
+            if depth >= self.max_queue_size:
+                self._rejected['queue_full'].inc()
+                raise QueueFullError(f"request queue is full ({self.max_queue_size})", self.estimated_wait(depth))
+            estimate = self.estimated_wait(depth)
+            if deadline and estimate > deadline:
+                self._rejected['wait_too_long'].inc()
+                raise WaitTooLong(f"estimated wait {estimate:.1f}s exceeds the {deadline:.1f}s deadline", estimate)
+            self._queue.append(request)
+            self._cond.notify()
+        return request
+
+    def submit(self, query, deadline=None):
+        """
+        Queue a non-streaming request; returns a Future with the handler result.
+        `deadline` is how many seconds the request may wait to start.
+        """
+        return self._enqueue(query, stream=False, deadline=deadline).future
+
+    def submit_stream(self, query, keepalive=None, deadline=None):
+        """
+        Queue a streaming request; returns a Future that resolves once generation starts (or fails
+        with DeadlineExceeded / RequestCancelled), and an iterator over the chunks.
+        With `keepalive` (seconds) set, the iterator yields None whenever no chunk arrived for that long.
+        """
+        request = self._enqueue(query, stream=True, deadline=deadline)
+
+        def iterate():
+            while True:
+                try:
+                    chunk = request.chunks.get(timeout=keepalive)
+                except queue.Empty:
+                    yield None
+                    continue
+                if chunk is _STREAM_END:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        return request.started, iterate()
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "batches": self._batches,
+            "avg_batch_size": round(self._batched_requests / self._batches, 3) if self._batches else 0.0,
+            "service_time": round(self._service_time, 4) if self._service_time is not None else None,
+            "estimated_wait": round(self.estimated_wait(), 3),
+            "rejected": {reason: counter.value() for reason, counter in self._rejected.items()},
+            "queue_depth_hist": self.queue_depth_hist.as_dict(),
+            "queue_wait_hist": self.queue_wait_hist.as_dict(),
+        }
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            first = self._queue.popleft()
+            batch = [first]
+            if first.batch_key is None:
+                return batch
+            deadline = first.enqueued_at + self.max_wait
+            while len(batch) < self.max_batch_size:
+                for request in list(self._queue):
+                    if request.batch_key == first.batch_key:
+                        self._queue.remove(request)
+                        batch.append(request)
+                        if len(batch) == self.max_batch_size:
+                            break
+                remaining = deadline - time.monotonic()
+                if len(batch) == self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            batch = [request for request in batch if not self._skip(request)]
+            if not batch:
+                continue
+            self._batches += 1
+            self._batched_requests += len(batch)
+            start = time.monotonic()
+            self._running_since = start
+            for request in batch:
+                self.queue_wait_hist.observe(start - request.enqueued_at)
+                request.started.set_result(True)
+            if batch[0].stream:
+                self._run_stream(batch[0])
+            elif len(batch) == 1:
+                self._run_single(batch[0])
+            else:
+                self._run_batch(batch)
+            self._running_since = None
+            self._update_service_time((time.monotonic() - start) / len(batch))
+
+    def _update_service_time(self, seconds, alpha=0.2):
+        if self._service_time is None:
+            self._service_time = seconds
+        else:
+            self._service_time = alpha * seconds + (1 - alpha) * self._service_time
+
+    def _skip(self, request):
+        """Drop requests cancelled or past their start deadline while queued."""
+        request_id = request.query.get('request_id')
+        if cancellations.is_cancelled(request_id):
+            logger.info(f"request {request_id} cancelled while queued")
+            error = RequestCancelled(request_id)
+        elif request.deadline is not None and time.monotonic() > request.deadline:
+            waited = time.monotonic() - request.enqueued_at
+            logger.info(f"request {request_id} dropped after waiting {waited:.1f}s in queue")
+            self._rejected['deadline_exceeded'].inc()
+            error = DeadlineExceeded(f"request did not start within its deadline ({waited:.1f}s queued)",
+                                     self.estimated_wait())
+        else:
+            return False
+        cancellations.release(request_id)
+        request.started.set_exception(error)
+        request.future.set_exception(error)
+        if request.stream:
+            request.chunks.put(_STREAM_END)
+        return True
+
+    @staticmethod
+    def _finish(request_id, timing, error=None, tokens=None, **kwargs):
+        if error is not None:
+            outcome = 'error'
+        elif cancellations.is_cancelled(request_id):
+            outcome = 'cancelled'
+        else:
+            outcome = 'ok'
+        metrics.requests_total[outcome].inc()
+        metrics.observe_request(timing, tokens=tokens, **kwargs)
+        cancellations.release(request_id)
+
+    def _run_single(self, request):
+        request_id = request.query.get('request_id')
+        timing = RequestTiming(request.enqueued_at)
+        result, error = None, None
+        try:
+            with cancellations.active(request_id), timings.active(timing):
+                result = self.model.handler(request.query)
+            request.future.set_result(result)
+        except Exception as e:
+            error = e
+            request.future.set_exception(e)
+        finally:
+            tokens = result["usage"].get("output_tokens") if result and result.get("usage") else None
+            self._finish(request_id, timing, error, tokens)
+
+    def _run_batch(self, batch):
+        logger.info(f"running batch of {len(batch)} requests")
+        # one timing for the whole batch: all members share prefill and decode steps
+        timing = RequestTiming(batch[0].enqueued_at)
+        try:
+            # cancelled members stop generating, the rest of the batch runs on
+            with cancellations.active_batch([request.query.get('request_id') for request in batch]), \
+                    timings.active(timing):
+                results = self.model.batch_handler([request.query for request in batch])
+        except Exception as e:
+            logger.warning(f"batched generation failed ({e}), running requests one by one")
+            for request in batch:
+                self._run_single(request)
+            return
+        for request, result in zip(batch, results):
+            self._finish(request.query.get('request_id'), timing, tokens=(result.get("usage") or {}).get("output_tokens"),
+                         enqueued_at=request.enqueued_at, images=False)
+            request.future.set_result(result)
+
+    def _run_stream(self, request):
+        request_id = request.query.get('request_id')
+        timing = RequestTiming(request.enqueued_at)
+        error = None
+        try:
+            # the wrappers' stream generators call chat() lazily, so generation runs inside this context
+            with cancellations.active(request_id), timings.active(timing):
+                for chunk in self.model.stream_handler(request.query):
+                    request.chunks.put(chunk)
+        except Exception as e:
+            error = e
+            request.chunks.put(e)
+        finally:
+            self._finish(request_id, timing, error)
+        request.chunks.put(_STREAM_END)
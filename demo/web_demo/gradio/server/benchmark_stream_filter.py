@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Cost of cleaning up streamed answers.
+
+Compares the old per-chunk clean-up (the `<box>.*</box>` regex and four replaces on every chunk)
+with the incremental TagFilter on long synthetic answers with occasional grounding tags, and checks
+that both give the answer the non-stream path produces when tags are split across chunks.
+With `--tokenizer` it also times re-encoding the answer, which token counting no longer does.
+
+    python benchmark_stream_filter.py --chars 200000 --chunk 4
+    python benchmark_stream_filter.py --tokenizer openbmb/MiniCPM-V-4_5
+"""
+import argparse
+import random
+import re
+import time
+
+from models.postprocess import TagFilter, clean_answer
+
+WORDS = ('the', 'image', 'shows', 'a', 'small', 'cat', 'sitting', 'on', 'wooden', 'table', 'near', 'window')
+
+
+def synthetic_answer(num_chars, tag_every, seed=0):
+    """Prose with a `<ref>object</ref><box>x1 y1 x2 y2</box>` pair about every `tag_every` words."""
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    while size < num_chars:
+        if rng.randrange(tag_every) == 0:
+            box = ' '.join(str(rng.randrange(1000)) for _ in range(4))
+            part = f'<ref>{rng.choice(WORDS)}</ref><box>{box}</box> '
+        else:
+            part = rng.choice(WORDS) + ('.\n' if rng.randrange(20) == 0 else ' ')
+        parts.append(part)
+        size += len(part)
+    return ''.join(parts)
+
+
+def split_chunks(text, chunk_size, seed=0):
+    """Chunks of 1 to 2 * chunk_size characters, like detokenized stream pieces."""
+    rng = random.Random(seed)
+    chunks = []
+    i = 0
+    while i < len(text):
+        n = rng.randint(1, 2 * chunk_size - 1)
+        chunks.append(text[i:i + n])
+        i += n
+    return chunks
+
+
+def legacy_filter(chunks, enable_thinking=True):
+    """What _stream_chat did before: every chunk cleaned on its own."""
+    for chunk in chunks:
+        clean_chunk = re.sub(r'(<box>.*</box>)', '', chunk)
+        clean_chunk = clean_chunk.replace('<ref>', '')
+        clean_chunk = clean_chunk.replace('</ref>', '')
+        clean_chunk = clean_chunk.replace('<box>', '')
+        clean_chunk = clean_chunk.replace('</box>', '')
+        if not enable_thinking:
+            clean_chunk = clean_chunk.replace('</think>', '')
+        yield clean_chunk
+
+
+def incremental_filter(chunks, enable_thinking=True):
+    tag_filter = TagFilter(enable_thinking)
+    for chunk in chunks:
+        clean_chunk = tag_filter.feed(chunk)
+        if clean_chunk:
+            yield clean_chunk
+    rest = tag_filter.flush()
+    if rest:
+        yield rest
+
+
+def run(name, stream, chunks, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = ''.join(stream(chunks))
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<16} {best * 1000:>10.2f} {best / len(chunks) * 1e6:>10.3f}")
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the streaming answer clean-up')
+    parser.add_argument('--chars', type=int, default=200000,
+                        help='Length of the synthetic answer')
+    parser.add_argument('--chunk', type=int, default=4,
+                        help='Average chunk size in characters')
+    parser.add_argument('--tag-every', type=int, default=40,
+                        help='One grounding tag pair per this many words on average')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per method, the best one is reported')
+    parser.add_argument('--tokenizer', type=str, default=None,
+                        help='Also time tokenizer.encode of the answer (model path or hub id)')
+    args = parser.parse_args()
+
+    answer = synthetic_answer(args.chars, args.tag_every)
+    chunks = split_chunks(answer, args.chunk)
+    expected = clean_answer(answer)
+    print(f"{len(answer)} chars in {len(chunks)} chunks\n")
+    print(f"{'method':<16} {'ms/answer':>10} {'us/chunk':>10}")
+
+    legacy = run('per-chunk regex', legacy_filter, chunks, args.repeat)
+    incremental = run('TagFilter', incremental_filter, chunks, args.repeat)
+
+    print()
+    for name, output in (('per-chunk regex', legacy), ('TagFilter', incremental)):
+        leaked = sum(output.count(tag) for tag in ('<ref>', '</ref>', '<box>', '</box>'))
+        print(f"{name:<16} matches non-stream answer: {output == expected}, tags left: {leaked}")
+
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            tokenizer.encode(expected)
+            best = min(best, time.perf_counter() - start)
+        print(f"\ntokenizer.encode of the answer: {best * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,27 @@
 from pydantic import BaseModel
 import uvicorn
 import fastapi
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 import argparse
-from models import ModelMiniCPMV4, ModelMiniCPMV4_5, ModelMiniCPMO4_5
+from models import ModelMiniCPMV4, ModelMiniCPMV4_5, ModelMiniCPMO4_5, ModelStub, image_cache, ImageCacheMiss, vision_cache, kv_store, cancellations, timings, result_cache, \
+    request_key, video_store, VideoNotCached, decode_video, video_id, AdapterManager, AdapterNotFound
+from batch_scheduler import BatchScheduler, AdmissionRejected, RequestCancelled
+import metrics
+from slice_policy import SlicePolicy, QOS_CLASSES, parse_tenant_qos
+from session_store import session_store, TurnNotFound, SessionTooLarge, ROOT, history_text
+from preprocess import preprocessor, PREPROCESS_WORKERS
+from warmup import Warmup, enable_compile
+import asyncio
+import functools
+import hashlib
 import logging
 import json
+import os
+import tempfile
+import re
+import time
+import uuid
 
 from logging_util import setup_root_logger
 
@@ -13,7 +29,8 @@ logger = logging.getLogger(__name__)
 
 
 class Model:
-    def __init__(self, model_path: str, model_type: str, instance_id: int = 0, gpu_id: int = None) -> None:
+    def __init__(self, model_path: str, model_type: str, instance_id: int = 0, gpu_id: int = None,
+                 adapter_dir: str = None, adapter_cache_bytes: int = None) -> None:
         self.instance_id = instance_id
         self.gpu_id = gpu_id
         
@@ -23,6 +40,10 @@ class Model:
             logger.info(f"实例 {instance_id}: 设置CUDA_VISIBLE_DEVICES={gpu_id}")
         
         logger.info(f"实例 {instance_id}: 初始化模型类型 {model_type}")
+        # result cache entries are only valid for the weights that produced them
+        self.model_id = f"{model_type.lower()}:{model_path}"
+        # how /api/video samples frames: MiniCPM-V 4.5 packs frames with temporal ids, older models take 1 fps
+        self.video_plan = 'packing' if model_type.lower() in ('minicpmv4_5', 'stub') else 'one_fps'
         
         match model_type.lower():
             case 'minicpmv4':   
@@ -31,36 +52,162 @@ class Model:
                 self.model = ModelMiniCPMV4_5(model_path)
             case 'minicpmo4_5':
                 self.model = ModelMiniCPMO4_5(model_path)
+            case 'stub':
+                self.model = ModelStub(model_path)
             case _:
                 raise ValueError(f"Unsupported model type: {model_type}")
         
         logger.info(f"实例 {instance_id}: 模型加载完成")
 
+        # LoRA adapters selected per request with params.adapter
+        base = getattr(self.model, 'model', None)
+        if adapter_dir and base is None:
+            logger.warning(f"{model_type} has no torch model to apply adapters to, ignoring --adapter_dir")
+            adapter_dir = None
+        self.adapters = AdapterManager(base, adapter_dir)
+        if adapter_cache_bytes is not None:
+            self.adapters.max_bytes = adapter_cache_bytes
+
+    @staticmethod
+    def _split_adapter(query):
+        """
+        The request's adapter and the params for the model without it. The query keeps its adapter, so a
+        request that is run again after a failed batch still gets it.
+        """
+        params = json.loads(query.get("params", "{}"))
+        adapter = params.pop("adapter", None)
+        return adapter, json.dumps(params)
+
+    @staticmethod
+    def _count_preprocessing(query):
+        # images decoded by the preprocessing workers count towards the request's decode time
+        timing = timings.current()
+        if timing is not None:
+            timing.image_decode_seconds += query.get("image_decode_seconds", 0.0)
+
+    @staticmethod
+    def _session_id(query, adapter):
+        # vision embeddings and prompt KV caches depend on the adapter
+        session_id = query.get("session_id", None)
+        return f"{session_id}@{adapter}" if session_id and adapter else session_id
+
     def handler(self, query):
-        res, output_tokens = self.model({
-            "image": query["image"],
-            "question": query["question"],
-            "params": query.get("params", "{}"),
-            "temporal_ids": query.get("temporal_ids", None)
-        })
+        adapter, params = self._split_adapter(query)
+        self._count_preprocessing(query)
+        with self.adapters.use(adapter):
+            res, usage = self.model({
+                "image": query["image"],
+                "image_hash": query.get("image_hash"),
+                "question": query["question"],
+                "params": params,
+                "temporal_ids": query.get("temporal_ids", None),
+                "session_id": self._session_id(query, adapter)
+            })
+        if query.get("cache_key") and not self._cancelled():
+            result_cache.put(query["cache_key"], res, usage)
+        if query.get("degradation"):
+            usage = {**usage, "degradation": query["degradation"]}
         return {
             "result": res,
-            "usage": {"output_tokens": output_tokens}
+            "usage": usage
         }
 
+    def cache_key(self, query):
+        """Result cache key for deterministic requests, None when caching does not apply."""
+        if not result_cache.enabled:
+            return None
+        try:
+            return request_key(self.model_id, query, getattr(self.model, 'delivery_params', ()))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"not caching malformed request: {e}")
+            return None
+
+    @staticmethod
+    def _cancelled():
+        # a stopped generation returns a truncated answer, which must not be cached
+        token = cancellations.current()
+        return token is not None and token.is_cancelled()
+
+    def batch_key(self, query):
+        """Requests with equal keys can share one batched generate call; None means run alone."""
+        if not hasattr(self.model, 'batch_call'):
+            return None
+        # a top-level image or video temporal ids go through the single-request path
+        if len(query.get("image") or "") > 10 or query.get("temporal_ids"):
+            return None
+        params = json.loads(query.get("params", "{}"))
+        if params.get("stream") or params.get("prompt_lookup"):
+            return None
+        return json.dumps(params, sort_keys=True)
+
+    def batch_handler(self, queries):
+        # the batch key includes params, so all queries name the same adapter
+        split = [self._split_adapter(query) for query in queries]
+        adapter = split[0][0]
+        for query in queries:
+            self._count_preprocessing(query)
+        with self.adapters.use(adapter):
+            results = self.model.batch_call([{
+                "image": query["image"],
+                "question": query["question"],
+                "params": params,
+            } for query, (_, params) in zip(queries, split)])
+        for query, (res, usage) in zip(queries, results):
+            if query.get("cache_key") and not cancellations.is_cancelled(query.get("request_id")):
+                result_cache.put(query["cache_key"], res, usage)
+        return [{
+            "result": res,
+            "usage": {**usage, "degradation": query["degradation"]} if query.get("degradation") else usage,
+        } for query, (res, usage) in zip(queries, results)]
+
+    def count_tokens(self, text):
+        tokenizer = getattr(self.model, 'tokenizer', None)
+        if tokenizer is None:
+            return None
+        return len(tokenizer.encode(text))
+
     def stream_handler(self, query):
         params = json.loads(query.get("params", "{}"))
         params["stream"] = True
         query["params"] = json.dumps(params)
-        
+        adapter, params = self._split_adapter(query)
+        self._count_preprocessing(query)
+
         generator = self.model({
             "image": query["image"],
+            "image_hash": query.get("image_hash"),
             "question": query["question"],
-            "params": query["params"],
-            "temporal_ids": query.get("temporal_ids", None)
+            "params": params,
+            "temporal_ids": query.get("temporal_ids", None),
+            "session_id": self._session_id(query, adapter)
         })
-        
-        return generator
+        return self._finish_stream(self._with_adapter(generator, adapter), query)
+
+    def _with_adapter(self, generator, adapter):
+        # the wrappers generate lazily, so the adapter has to stay active until the stream is drained
+        with self.adapters.use(adapter):
+            yield from generator
+
+    def _finish_stream(self, generator, query):
+        """
+        Runs in the scheduler thread: once the answer is complete, records the tokens counted during
+        generation as query["output_tokens"], and the model's extra usage fields as query["stream_usage"],
+        and caches the answer if the request has a cache key.
+        """
+        chunks = []
+        for chunk in generator:
+            chunks.append(chunk)
+            yield chunk
+        timing = timings.current()
+        if timing is not None and timing.output_tokens:
+            query["output_tokens"] = timing.output_tokens
+        if timing is not None and timing.usage:
+            query["stream_usage"] = dict(timing.usage)
+        if query.get("cache_key") and not self._cancelled():
+            answer = "".join(chunks)
+            output_tokens = query.get("output_tokens") or self.count_tokens(answer)
+            result_cache.put(query["cache_key"], answer,
+                             {"output_tokens": output_tokens} if output_tokens is not None else {})
 
 
 class Item(BaseModel):
@@ -68,13 +215,31 @@ class Item(BaseModel):
     question: str
     params: str
     temporal_ids: str = None
+    session_id: str = None
+    request_id: str = None
+    tenant: str = None
+    deadline_ms: int = None
+    # set: `question` only holds the messages after this turn of the session, see expand_turns
+    parent_turn_id: str = None
+
+
+class CancelItem(BaseModel):
+    request_id: str
+
+
+class TurnsItem(BaseModel):
+    session_id: str
+    messages: str
+    parent_turn_id: str = ROOT
 
 model = None
+scheduler = None
+slice_policy = None
 args = None
 
-def initialize_server():
-    """初始化服务器配置和模型"""
-    global model, args
+def initialize_server(argv=None):
+    """初始化服务器配置和模型; `argv` defaults to the command line"""
+    global model, scheduler, slice_policy, warmup, args
     
     parser = argparse.ArgumentParser(description='Server for MiniCPM-V')
     parser.add_argument('--port', type=int, default=9999,
@@ -89,7 +254,62 @@ def initialize_server():
                         help='Instance ID for multi-instance deployment')
     parser.add_argument('--gpu_id', type=int, default=None,
                         help='GPU ID to use for this instance')
-    args = parser.parse_args()
+    parser.add_argument('--max_batch_size', type=int, default=1,
+                        help='Max non-streaming requests coalesced into one generate call')
+    parser.add_argument('--max_wait_ms', type=int, default=10,
+                        help='How long the scheduler waits for compatible requests to fill a batch')
+    parser.add_argument('--max_queue_size', type=int, default=64,
+                        help='Requests queued beyond this are rejected with 503')
+    parser.add_argument('--max_queue_wait', type=float, default=60,
+                        help='Seconds a request may wait in the queue before it is rejected with 503')
+    parser.add_argument('--image_cache_mb', type=int, default=1024,
+                        help='Memory budget for decoded images reused across turns via image_ref')
+    parser.add_argument('--vision_cache_mb', type=int, default=2048,
+                        help='GPU memory budget for vision embeddings reused across turns of a session')
+    parser.add_argument('--kv_cache_mb', type=int, default=4096,
+                        help='GPU memory budget for per-session prompt KV caches reused by follow-up turns')
+    parser.add_argument('--result_cache_mb', type=int, default=0,
+                        help='Memory budget for answers of deterministic (sampling=false) requests, 0 disables the cache')
+    parser.add_argument('--result_cache_dir', type=str, default=None,
+                        help='Also keep cached answers on disk here, shared across restarts')
+    parser.add_argument('--result_cache_ttl', type=float, default=3600,
+                        help='Seconds a cached answer stays valid, 0 keeps it until evicted')
+    parser.add_argument('--video_cache_mb', type=int, default=4096,
+                        help='Memory budget for frames of videos uploaded to /api/video')
+    parser.add_argument('--max_video_mb', type=int, default=1024,
+                        help='Largest video file accepted by /api/video')
+    parser.add_argument('--session_store_mb', type=int, default=256,
+                        help='Memory budget for conversations kept per session_id for parent_turn_id requests, 0 disables')
+    parser.add_argument('--session_max_mb', type=int, default=32,
+                        help='Memory budget of one session; older branches are dropped, then appends rejected')
+    parser.add_argument('--session_ttl', type=float, default=3600,
+                        help='Seconds an idle session is kept, 0 keeps it until evicted')
+    parser.add_argument('--degrade_queue_depths', type=str, default='',
+                        help='Comma-separated queue depths at which images get fewer slices and a smaller side, '
+                             'e.g. 4,16,32; empty never degrades')
+    parser.add_argument('--tenant_qos', type=str, default='',
+                        help='Comma-separated tenant=class pairs, classes: ' + ', '.join(QOS_CLASSES))
+    parser.add_argument('--default_qos', type=str, default='standard', choices=list(QOS_CLASSES),
+                        help='QoS class of requests without a known tenant')
+    parser.add_argument('--stream_format', type=str, default='v2', choices=['v1', 'v2'],
+                        help='/api/stream event format: v2 sends deltas, v1 the full response in every event')
+    parser.add_argument('--keepalive_interval', type=float, default=15,
+                        help='Seconds without output after which /api/stream sends a keepalive comment (v2)')
+    parser.add_argument('--adapter_dir', type=str, default=None,
+                        help='Directory of LoRA adapters from finetune/finetune.py, one per subdirectory, '
+                             'selected per request with params.adapter')
+    parser.add_argument('--adapter_cache_mb', type=int, default=4096,
+                        help='Memory budget for loaded adapters, the least recently used are unloaded beyond it')
+    parser.add_argument('--skip_warmup', action='store_true',
+                        help='Report ready right after loading instead of first running synthetic warmup requests')
+    parser.add_argument('--compile', action='store_true',
+                        help="torch.compile the language model's forward; compiled during warmup")
+    parser.add_argument('--compile_cache_dir', type=str, default=None,
+                        help='Keep torch.compile kernels here, so restarts reuse them')
+    parser.add_argument('--preprocess_workers', type=int, default=PREPROCESS_WORKERS,
+                        help='Processes that decode request images before they are queued for the model, '
+                             '0 decodes on the model thread')
+    args = parser.parse_args(argv)
 
     setup_root_logger(local_dir=args.log_dir)
 
@@ -102,73 +322,421 @@ def initialize_server():
     logger.info(f"模型路径: {args.model_path}")
     logger.info(f"模型类型: {args.model_type}")
     logger.info(f"日志目录: {args.log_dir}")
+    logger.info(f"批处理: max_batch_size={args.max_batch_size}, max_wait_ms={args.max_wait_ms}, "
+                f"max_queue_size={args.max_queue_size}")
     logger.info(f"="*50)
 
-    model = Model(args.model_path, args.model_type, args.instance_id, args.gpu_id)
+    image_cache.max_bytes = args.image_cache_mb * 1024 ** 2
+    vision_cache.max_bytes = args.vision_cache_mb * 1024 ** 2
+    kv_store.max_bytes = args.kv_cache_mb * 1024 ** 2
+    video_store.max_bytes = args.video_cache_mb * 1024 ** 2
+    result_cache.max_bytes = args.result_cache_mb * 1024 ** 2
+    result_cache.ttl = args.result_cache_ttl
+    result_cache.directory = args.result_cache_dir
+    session_store.max_bytes = args.session_store_mb * 1024 ** 2
+    session_store.ttl = args.session_ttl
+    session_store.max_session_bytes = args.session_max_mb * 1024 ** 2
+    # forked before the model is loaded and before the scheduler thread starts
+    preprocessor.processes = args.preprocess_workers
+    preprocessor.start()
+    model = Model(args.model_path, args.model_type, args.instance_id, args.gpu_id,
+                  args.adapter_dir, args.adapter_cache_mb * 1024 ** 2)
+    startup_timer = getattr(model.model, 'startup_timer', None)
+    if args.compile:
+        enable_compile(getattr(model.model, 'model', None), args.compile_cache_dir)
+    scheduler = BatchScheduler(model, args.max_batch_size, args.max_wait_ms, args.max_queue_size,
+                               args.max_queue_wait)
+    slice_policy = SlicePolicy(
+        queue_depths=[int(depth) for depth in args.degrade_queue_depths.split(',') if depth.strip()],
+        tenant_qos=parse_tenant_qos(args.tenant_qos),
+        default_qos=args.default_qos,
+    )
+
+    # every sample carries these, so instances of different model types can share a dashboard
+    metrics.registry.labels = {"model_type": args.model_type, "instance_id": str(args.instance_id)}
+    metrics.registry.gauge("minicpm_queue_depth", "Requests waiting in the scheduler queue", scheduler.queue_depth)
+    metrics.registry.gauge("minicpm_in_flight_requests", "Requests queued or running",
+                           lambda: cancellations.stats()["in_flight"])
+    for name, cache in (("image", image_cache), ("vision", vision_cache), ("kv", kv_store),
+                        ("video", video_store), ("result", result_cache), ("session", session_store),
+                        ("adapter", model.adapters)):
+        metrics.registry.gauge("minicpm_cache_bytes", "Bytes held by the server-side caches",
+                               lambda cache=cache: cache.bytes, cache=name)
+
+    # generation requests get 503 until the warmup requests are through
+    warmup = Warmup(model, startup_timer)
+    if args.skip_warmup:
+        warmup.skip()
+    else:
+        warmup.start()
 
 app = fastapi.FastAPI()
 
 
 @app.get("/")
 def read_root():
-    return {
+    """Also the readiness probe (the router's health check): 503 while warming up."""
+    content = {
         "message": "MiniCPM-V server", 
         "instance_id": args.instance_id,
         "gpu_id": args.gpu_id,
         "port": args.port,
         "model_type": args.model_type,
-        "status": "running"
+        "status": "running" if warmup.ready else "warming_up",
+        "scheduler": scheduler.stats()
+    }
+    return JSONResponse(content, status_code=200 if warmup.ready else 503)
+
+
+@app.get("/api/stats")
+def stats():
+    return {
+        "scheduler": scheduler.stats(),
+        "image_cache": image_cache.stats(),
+        "vision_cache": vision_cache.stats(),
+        "kv_cache": kv_store.stats(),
+        "cancellation": cancellations.stats(),
+        "video_store": video_store.stats(),
+        "result_cache": result_cache.stats(),
+        "session_store": session_store.stats(),
+        "slice_policy": slice_policy.stats(),
+        "preprocess": preprocessor.stats(),
+        "adapters": model.adapters.stats(),
+        "warmup": warmup.stats(),
     }
 
 
+@app.get("/metrics")
+def metrics_api():
+    """Prometheus text exposition of the scheduler, latency and cache metrics."""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+def image_cache_miss(hashes):
+    # the client resends the conversation with full images on 409
+    return fastapi.HTTPException(status_code=409, detail={
+        "error": "image_ref not cached",
+        "missing_images": hashes,
+    })
+
+
+def video_not_cached(video_ids):
+    # the client uploads the videos to /api/video again and resends the request
+    return fastapi.HTTPException(status_code=409, detail={
+        "error": "video_ref not cached",
+        "missing_videos": video_ids,
+    })
+
+
+def check_image_refs(query):
+    msgs = json.loads(query["question"])
+    missing = image_cache.missing(msgs)
+    if missing:
+        raise image_cache_miss(missing)
+    missing = video_store.missing(msgs)
+    if missing:
+        raise video_not_cached(missing)
+
+
+def check_adapter(query):
+    """Reject unknown adapters, and start reading a known one from disk while the request waits in the queue."""
+    try:
+        adapter = json.loads(query.get("params") or "{}").get("adapter")
+        if adapter is not None:
+            model.adapters.prefetch(adapter)
+    except ValueError:
+        raise fastapi.HTTPException(status_code=400, detail="params is not a JSON object")
+    except AdapterNotFound as e:
+        raise fastapi.HTTPException(status_code=400, detail={
+            "error": str(e),
+            "adapters": model.adapters.stats()["available"],
+        })
+
+
+def turn_not_found(e):
+    # the client resends the whole conversation with parent_turn_id "root"
+    return fastapi.HTTPException(status_code=404, detail={
+        "error": "turn not found",
+        "session_id": e.session_id,
+        "missing_turn": e.turn_id,
+    })
+
+
+def expand_turns(query):
+    """
+    For requests with `parent_turn_id`, `question` only holds the new messages: prepend the stored
+    history, so everything downstream sees the whole conversation. Returns the new messages.
+    """
+    if query.get("parent_turn_id") is None:
+        return None
+    if not query.get("session_id"):
+        raise fastapi.HTTPException(status_code=400, detail="parent_turn_id needs a session_id")
+    try:
+        new_msgs = json.loads(query["question"])
+        if not session_store.enabled and query["parent_turn_id"] != ROOT:
+            raise TurnNotFound(query["session_id"], query["parent_turn_id"])
+        history = session_store.history(query["session_id"], query["parent_turn_id"])
+    except ValueError:
+        raise fastapi.HTTPException(status_code=400, detail="question is not a JSON message list")
+    except TurnNotFound as e:
+        raise turn_not_found(e)
+    query["question"] = json.dumps(history + new_msgs, ensure_ascii=True)
+    return new_msgs
+
+
+def commit_turns(query, new_msgs, answer):
+    """Store the new messages and the answer as turns; returns their ids for the response."""
+    if new_msgs is None or not session_store.enabled:
+        return {}
+    reply = {"role": "assistant", "contents": [{"type": "text", "pairs": history_text(answer)}]}
+    try:
+        turn_ids = session_store.append(query["session_id"], query["parent_turn_id"], new_msgs + [reply])
+    except (TurnNotFound, SessionTooLarge) as e:
+        # evicted while generating, or too long to keep: the answer stands, the next request finds the turn missing
+        logger.warning(f"not storing turns: {e}")
+        return {}
+    # turn_ids[-1] is the answer's, the parent_turn_id of the next request
+    return {"turn_id": turn_ids[-1], "turn_ids": turn_ids}
+
+
+def cached_result(query):
+    """
+    Look the request up in the result cache; hits are answered without queueing for the GPU.
+    Hashes every image and may read the disk tier, so the endpoints run it in the threadpool.
+    """
+    query["cache_key"] = model.cache_key(query)
+    cached = result_cache.get(query["cache_key"])
+    if cached is None:
+        return None
+    res, usage = cached
+    usage["cached"] = True
+    query["request_id"] = query.get("request_id") or uuid.uuid4().hex
+    return {"result": res, "usage": usage, "request_id": query["request_id"]}
+
+
+def replay(text):
+    # word-sized deltas, so a cached answer streams like a generated one
+    for chunk in re.findall(r'\s*\S+\s*|\s+', text):
+        yield chunk
+
+
+def apply_slice_policy(query, tenant):
+    decision = slice_policy.apply(query, scheduler.queue_depth(), tenant)
+    if decision is not None:
+        query["degradation"] = decision
+        # the answer is not what the full-resolution request would get
+        query["cache_key"] = None
+
+
+def register_request(query):
+    # clients pick the id so they can cancel before the first byte arrives
+    query["request_id"] = query.get("request_id") or uuid.uuid4().hex
+    cancellations.register(query["request_id"])
+    return query["request_id"]
+
+
+def admission_rejected(e):
+    return fastapi.HTTPException(
+        status_code=e.status_code,
+        detail={"error": str(e), "estimated_wait": round(e.estimated_wait, 3)},
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+def check_ready():
+    if not warmup.ready:
+        raise fastapi.HTTPException(status_code=503, detail={"error": "warming up"}, headers={"Retry-After": "5"})
+
+
+def request_cancelled():
+    return fastapi.HTTPException(status_code=499, detail="request cancelled")
+
+
+def request_deadline(item):
+    return item.deadline_ms / 1000 if item.deadline_ms else None
+
+
+async def wait_queued(future, request, request_id):
+    """
+    Await a scheduler future without holding a threadpool thread, cancelling the request
+    if the client goes away while it is still queued.
+    """
+    future = asyncio.wrap_future(future)
+    while True:
+        done, _ = await asyncio.wait({future}, timeout=1)
+        if done:
+            return future.result()
+        if await request.is_disconnected():
+            cancellations.cancel(request_id)
+            logger.info(f"client disconnected, cancelling request {request_id}")
+            raise request_cancelled()
+
+
 @app.post("/api")
-def websocket(item: Item):
+async def websocket(item: Item, request: fastapi.Request):
     logger.info(f'params: {str(item.params)}')
     query = item.dict()
-    res = model.handler(query)
+    # these parse the whole question, which can be megabytes of base64; keep them off the event loop
+    new_msgs = await run_in_threadpool(expand_turns, query)
+    res = await run_in_threadpool(cached_result, query)
+    if res is not None:
+        # images of the new messages are decoded when stored, keep that off the event loop
+        res.update(await run_in_threadpool(commit_turns, query, new_msgs, res["result"]))
+        logger.info(f'result (cached): {str(res)}')
+        return {'data': res}
+    check_ready()
+    apply_slice_policy(query, item.tenant)
+    await run_in_threadpool(check_image_refs, query)
+    check_adapter(query)
+    await preprocessor.run(query)
+    request_id = register_request(query)
+    try:
+        future = scheduler.submit(query, deadline=request_deadline(item))
+    except AdmissionRejected as e:
+        cancellations.release(request_id)
+        raise admission_rejected(e)
+    try:
+        res = await wait_queued(future, request, request_id)
+    except AdmissionRejected as e:
+        raise admission_rejected(e)
+    except ImageCacheMiss as e:
+        # evicted between the check above and the model reading it
+        raise image_cache_miss(e.hashes)
+    except VideoNotCached as e:
+        raise video_not_cached(e.video_ids)
+    except RequestCancelled:
+        raise request_cancelled()
+    res["request_id"] = request_id
+    res.update(await run_in_threadpool(commit_turns, query, new_msgs, res["result"]))
 
     logger.info(f'result: {str(res)}')
     return {'data': res}
 
 
+@app.post("/api/video")
+async def video_api(request: fastapi.Request, fps: float = None):
+    """
+    Upload a video file as the raw request body (chunked transfer is fine). The server samples
+    the frames for the model and returns a `video_id`, to be sent as `{"type": "video_ref", "video_id": ...}`,
+    along with the `temporal_ids` for the chat request. Uploading the same file again is cheap.
+    """
+    limit = args.max_video_mb * 1024 ** 2
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(prefix='upload_', suffix='.video', delete=False) as f:
+        path = f.name
+    try:
+        with open(path, 'wb') as f:
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > limit:
+                    raise fastapi.HTTPException(status_code=413, detail=f"video exceeds {args.max_video_mb} MB")
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise fastapi.HTTPException(status_code=400, detail="empty upload")
+
+        vid = video_id(digest.hexdigest(), model.video_plan, fps)
+        video = video_store.get(vid)
+        if video is None:
+            start = time.time()
+            try:
+                # decoding is CPU bound, keep it off the event loop
+                video = await run_in_threadpool(decode_video, path, vid, model.video_plan, fps)
+            except ImportError:
+                raise fastapi.HTTPException(status_code=501, detail="decord is not installed on the server")
+            except Exception as e:
+                logger.warning(f"could not decode uploaded video ({size} bytes): {e}")
+                raise fastapi.HTTPException(status_code=400, detail=f"could not decode video: {e}")
+            video_store.put(video)
+            logger.info(f"video {vid[:12]}: {size} bytes, {len(video.frames)} frames in {time.time() - start:.2f}s")
+    finally:
+        os.remove(path)
+    return video.info()
+
+
+@app.post("/api/cancel")
+def cancel_api(item: CancelItem):
+    """Stop a queued or running request; generation ends at the next decoding step."""
+    cancelled = cancellations.cancel(item.request_id)
+    logger.info(f"cancel request {item.request_id}: {'ok' if cancelled else 'not found'}")
+    return {"request_id": item.request_id, "cancelled": cancelled}
+
+
+@app.post("/api/session/turns")
+def append_turns(item: TurnsItem):
+    """Add messages to a session without generating, e.g. few-shot examples; returns their turn ids."""
+    if not session_store.enabled:
+        raise fastapi.HTTPException(status_code=400, detail="sessions are disabled (--session_store_mb 0)")
+    try:
+        turn_ids = session_store.append(item.session_id, item.parent_turn_id, json.loads(item.messages))
+    except TurnNotFound as e:
+        raise turn_not_found(e)
+    except SessionTooLarge as e:
+        raise fastapi.HTTPException(status_code=413, detail={
+            "error": "session too large",
+            "session_id": e.session_id,
+            "max_session_bytes": e.max_bytes,
+        })
+    except (ValueError, OSError) as e:
+        # bad JSON, bad base64 or an unreadable image
+        raise fastapi.HTTPException(status_code=400, detail=f"invalid messages: {e}")
+    return {"session_id": item.session_id, "turn_id": turn_ids[-1] if turn_ids else item.parent_turn_id,
+            "turn_ids": turn_ids}
+
+
+@app.delete("/api/session/{session_id}")
+def delete_session(session_id: str):
+    return {"session_id": session_id, "deleted": session_store.delete(session_id)}
+
+
 @app.post("/api/stream")
-def stream_api(item: Item):
+async def stream_api(item: Item, request: fastapi.Request):
     query = item.dict()
-    def event_generator():
-        try:
-            generator = model.stream_handler(query)
-            full_response = ""
-            output_tokens = 0
-            
-            for chunk in generator:
-                full_response += chunk
-                output_tokens += 1
-                data = {
-                    "chunk": chunk,
-                    "full_response": full_response,
-                    "finished": False
-                }
-                yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
-            
-            final_data = {
-                "chunk": "",
-                "full_response": full_response,
-                "finished": True
-            }
-            yield f"data: {json.dumps(final_data, ensure_ascii=False)}\n\n"
-            
-        except Exception as e:
-            error_data = {
-                "error": str(e),
-                "finished": True
-            }
-            logger.error(f"Stream error: {e}")
-            yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
-    
+    # these parse the whole question, which can be megabytes of base64; keep them off the event loop
+    new_msgs = await run_in_threadpool(expand_turns, query)
+    # the final event carries the turn ids, once the whole answer is known
+    finish = functools.partial(commit_turns, query, new_msgs) if new_msgs is not None else None
+    cached = await run_in_threadpool(cached_result, query)
+    if cached is not None:
+        logger.info(f"stream request {cached['request_id']} replayed from the result cache")
+        # the final event reports the cached usage, as the non-stream answer does
+        return stream_response(replay(cached["result"]), cached["request_id"], finish=finish,
+                               query={"stream_usage": cached["usage"]})
+    check_ready()
+    apply_slice_policy(query, item.tenant)
+    await run_in_threadpool(check_image_refs, query)
+    check_adapter(query)
+    await preprocessor.run(query)
+    request_id = register_request(query)
+    keepalive = args.keepalive_interval if args.stream_format == 'v2' else None
+    try:
+        started, generator = scheduler.submit_stream(query, keepalive=keepalive, deadline=request_deadline(item))
+    except AdmissionRejected as e:
+        cancellations.release(request_id)
+        raise admission_rejected(e)
+    # the status line waits until generation starts, so queue rejections can still be a 503
+    try:
+        await wait_queued(started, request, request_id)
+    except AdmissionRejected as e:
+        raise admission_rejected(e)
+    except RequestCancelled:
+        raise request_cancelled()
+
+    return stream_response(generator, request_id, query.get("degradation"), finish, query)
+
+
+def stream_response(generator, request_id, degradation=None, finish=None, query=None):
+    if args.stream_format == 'v1':
+        event_generator = stream_events_v1(generator, finish)
+    else:
+        event_generator = stream_events_v2(generator, degradation, finish, query)
+
     return StreamingResponse(
-        event_generator(), 
+        cancel_on_disconnect(event_generator, request_id),
         media_type="text/plain",
         headers={
+            "X-Request-Id": request_id,
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
             "Access-Control-Allow-Origin": "*",
@@ -176,8 +744,106 @@ def stream_api(item: Item):
         }
     )
 
+
+async def cancel_on_disconnect(events, request_id):
+    """
+    Starlette stops iterating when the client goes away, but a sync generator is only closed
+    whenever it gets garbage collected; this wrapper cancels the generation right away.
+    """
+    finished = False
+    try:
+        async for event in iterate_in_threadpool(events):
+            yield event
+        finished = True
+    finally:
+        if not finished and cancellations.cancel(request_id):
+            logger.info(f"client disconnected, cancelling request {request_id}")
+
+
+def stream_events_v1(generator, finish=None):
+    """Legacy format: every event carries the whole response so far."""
+    try:
+        full_response = ""
+        
+        for chunk in generator:
+            full_response += chunk
+            data = {
+                "chunk": chunk,
+                "full_response": full_response,
+                "finished": False
+            }
+            yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+        
+        final_data = {
+            "chunk": "",
+            "full_response": full_response,
+            "finished": True
+        }
+        if finish is not None:
+            final_data.update(finish(full_response))
+        yield f"data: {json.dumps(final_data, ensure_ascii=False)}\n\n"
+        
+    except Exception as e:
+        error_data = {
+            "error": str(e),
+            "finished": True
+        }
+        logger.error(f"Stream error: {e}")
+        yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+
+
+def stream_events_v2(generator, degradation=None, finish=None, query=None):
+    """
+    Delta format: `{"seq", "delta"}` events, `: keepalive` comments while the model is silent,
+    and a final `{"seq", "finished": true, "usage"}` summary, which includes the slice policy's
+    `degradation` decision if there was one. `finish(full_response)` adds fields to the summary.
+    Output tokens come from the generation count in `query`, set by Model._finish_stream.
+    """
+    seq = 0
+    chunks = []
+    start = time.time()
+    try:
+        for chunk in generator:
+            if chunk is None:
+                yield ": keepalive\n\n"
+                continue
+            if not chunk:
+                continue
+            chunks.append(chunk)
+            yield f"data: {json.dumps({'seq': seq, 'delta': chunk}, ensure_ascii=False)}\n\n"
+            seq += 1
+
+        full_response = "".join(chunks)
+        # re-encoding the answer is only needed for replays and models without generation timing
+        output_tokens = (query or {}).get("output_tokens") or model.count_tokens(full_response)
+        usage = {
+            # models without a tokenizer (stub) report chunks instead
+            "output_tokens": output_tokens if output_tokens is not None else len(chunks),
+            "output_chars": len(full_response),
+            "chunks": len(chunks),
+            "elapsed": round(time.time() - start, 3),
+        }
+        usage.update((query or {}).get("stream_usage", {}))
+        if degradation:
+            usage["degradation"] = degradation
+        final_data = {"seq": seq, "finished": True, "usage": usage}
+        if finish is not None:
+            final_data.update(finish(full_response))
+        yield f"data: {json.dumps(final_data, ensure_ascii=False)}\n\n"
+
+    except Exception as e:
+        logger.error(f"Stream error: {e}")
+        error_data = {"seq": seq, "error": str(e), "finished": True}
+        if isinstance(e, ImageCacheMiss):
+            error_data["missing_images"] = e.hashes
+        elif isinstance(e, VideoNotCached):
+            error_data["missing_videos"] = e.video_ids
+        yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+
 if __name__ == "__main__":
     initialize_server()
     
-    _cfg = uvicorn.Config(app, host="0.0.0.0", port=args.port, workers=2)
+    # a single process owns the model; uvicorn ignores `workers` for an app object anyway, and separate
+    # worker processes would each load their own copy. CPU work is spread over --preprocess_workers.
+    _cfg = uvicorn.Config(app, host="0.0.0.0", port=args.port)
     uvicorn.Server(_cfg).run()
@@ -0,0 +1,212 @@
+import abc
+import bisect
+import threading
+import weakref
+
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+TOKEN_BUCKETS = (1, 8, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+IMAGE_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+
+class _ShardRef:
+    """Held only by the owning thread's local storage, so it goes away with the thread."""
+    __slots__ = ('shard', '__weakref__')
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+class _Sharded(abc.ABC):
+    """
+    Per-thread shards: each thread only writes its own shard, so observing takes no lock.
+    Readers sum all shards and may miss an update in flight, which is fine for monitoring.
+    When a thread exits, its shard is folded into a base shard, so threads that come and go
+    (threadpool, preprocessing callbacks) do not grow the shard list.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._base = self._new_shard()
+        self._shards = {}  # id -> shard of a live thread
+        self._lock = threading.Lock()  # guards the base and the shard list, taken once per thread
+
+    @abc.abstractmethod
+    def _new_shard(self):
+        """A zeroed shard: a flat list of numbers."""
+
+    def _shard(self):
+        ref = getattr(self._local, 'ref', None)
+        if ref is None:
+            ref = _ShardRef(self._new_shard())
+            self._local.ref = ref
+            with self._lock:
+                self._shards[id(ref.shard)] = ref.shard
+            weakref.finalize(ref, self._retire, ref.shard)
+        return ref.shard
+
+    def _retire(self, shard):
+        # the thread is gone, nothing writes to the shard any more
+        with self._lock:
+            for i, v in enumerate(shard):
+                self._base[i] += v
+            del self._shards[id(shard)]
+
+    def _all_shards(self):
+        with self._lock:
+            return [list(self._base)] + list(self._shards.values())
+
+
+class Counter(_Sharded):
+    def _new_shard(self):
+        return [0]
+
+    def inc(self, amount=1):
+        self._shard()[0] += amount
+
+    def value(self):
+        return sum(shard[0] for shard in self._all_shards())
+
+
+class Histogram(_Sharded):
+    """Cumulative-bucket histogram in the Prometheus sense: counts[i] covers values <= buckets[i]."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__()
+
+    def _new_shard(self):
+        # bucket counts, then sum and count
+        return [0] * (len(self.buckets) + 1) + [0.0, 0]
+
+    def observe(self, value):
+        shard = self._shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+
+    def snapshot(self):
+        """(cumulative bucket counts including +Inf, sum, count)"""
+        totals = [0] * (len(self.buckets) + 3)
+        for shard in self._all_shards():
+            for i, v in enumerate(shard):
+                totals[i] += v
+        counts, total, count = totals[:-2], totals[-2], totals[-1]
+        cumulative = []
+        for c in counts:
+            cumulative.append((cumulative[-1] if cumulative else 0) + c)
+        return cumulative, total, count
+
+    def as_dict(self):
+        cumulative, total, count = self.snapshot()
+        buckets = {str(le): c for le, c in zip(self.buckets + ('+Inf',), cumulative)}
+        return {'buckets': buckets, 'sum': round(total, 6), 'count': count}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+
+class MetricsRegistry:
+    """
+    Named metrics rendered in the Prometheus text format. `labels` are added to every sample,
+    the server sets the model type and instance there.
+    """
+
+    def __init__(self):
+        self.labels = {}
+        self._families = {}  # name -> (type, help, [(labels, metric)])
+        self._lock = threading.Lock()
+
+    def _register(self, kind, name, help, metric, labels):
+        with self._lock:
+            family = self._families.setdefault(name, (kind, help, []))
+            family[2].append((labels, metric))
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self._register('counter', name, help, Counter(), labels)
+
+    def histogram(self, name, help, buckets, **labels):
+        return self._register('histogram', name, help, Histogram(buckets), labels)
+
+    def gauge(self, name, help, read, **labels):
+        """`read` is called at scrape time."""
+        return self._register('gauge', name, help, read, labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            families = [(name, kind, help, list(metrics)) for name, (kind, help, metrics) in self._families.items()]
+        for name, kind, help, metrics in families:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, metric in metrics:
+                labels = {**self.labels, **labels}
+                if kind == 'counter':
+                    lines.append(f'{name}{_format_labels(labels)} {metric.value()}')
+                elif kind == 'gauge':
+                    lines.append(f'{name}{_format_labels(labels)} {metric()}')
+                else:
+                    cumulative, total, count = metric.snapshot()
+                    for le, c in zip(metric.buckets + ('+Inf',), cumulative):
+                        lines.append(f'{name}_bucket{_format_labels({**labels, "le": le})} {c}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+queue_wait = registry.histogram(
+    'minicpm_queue_wait_seconds', 'Time from enqueue until the request started running', WAIT_BUCKETS)
+queue_depth = registry.histogram(
+    'minicpm_queue_depth_on_arrival', 'Requests already queued when a request arrived', DEPTH_BUCKETS)
+image_decode = registry.histogram(
+    'minicpm_image_decode_seconds', 'Base64 and image decoding time per request', LATENCY_BUCKETS)
+prefill = registry.histogram(
+    'minicpm_prefill_seconds', 'Time from generate() start to the first token', LATENCY_BUCKETS)
+time_to_first_token = registry.histogram(
+    'minicpm_time_to_first_token_seconds', 'Time from enqueue to the first generated token', WAIT_BUCKETS)
+decode_rate = registry.histogram(
+    'minicpm_decode_tokens_per_second', 'Generation speed after the first token', RATE_BUCKETS)
+output_tokens = registry.histogram(
+    'minicpm_output_tokens', 'Generated tokens per request', TOKEN_BUCKETS)
+images_per_request = registry.histogram(
+    'minicpm_images_per_request', 'Images per request, including image_ref', IMAGE_BUCKETS)
+requests_total = {
+    outcome: registry.counter('minicpm_requests_total', 'Finished requests by outcome', outcome=outcome)
+    for outcome in ('ok', 'error', 'cancelled')
+}
+rejected_total = {
+    reason: registry.counter('minicpm_rejected_requests_total', 'Requests turned away by admission control', reason=reason)
+    for reason in ('queue_full', 'wait_too_long', 'deadline_exceeded')
+}
+
+
+def observe_request(timing, enqueued_at=None, tokens=None, images=True):
+    """
+    Record a finished request from its RequestTiming. For batched requests the timing is shared
+    by the batch, `enqueued_at` is the request's own and images are not attributed.
+    """
+    if enqueued_at is None:
+        enqueued_at = timing.enqueued_at
+    if images:
+        images_per_request.observe(timing.images)
+        if timing.images:
+            image_decode.observe(timing.image_decode_seconds)
+    if timing.prefill_seconds is not None:
+        prefill.observe(timing.prefill_seconds)
+    if timing.first_token_at is not None:
+        time_to_first_token.observe(timing.first_token_at - enqueued_at)
+    if timing.decode_tokens_per_second is not None:
+        decode_rate.observe(timing.decode_tokens_per_second)
+    # the wrappers' usage counts the post-processed answer, prefer it over generate() steps
+    tokens = tokens or timing.output_tokens
+    if tokens:
+        output_tokens.observe(tokens)
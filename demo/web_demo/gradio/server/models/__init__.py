@@ -1,3 +1,12 @@
 from .minicpmv4 import ModelMiniCPMV4
 from .minicpmv4_5 import ModelMiniCPMV4_5
-from .minicpmo4_5 import ModelMiniCPMO4_5
\ No newline at end of file
+from .minicpmo4_5 import ModelMiniCPMO4_5
+from .stub import ModelStub
+from .image_cache import image_cache, ImageCacheMiss
+from .vision_cache import vision_cache
+from .kv_cache import kv_store
+from .cancellation import cancellations
+from .timing import timings, RequestTiming
+from .result_cache import result_cache, request_key
+from .video_store import video_store, VideoNotCached, decode_video, video_id
+from .adapters import AdapterManager, AdapterNotFound
@@ -0,0 +1,152 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+ADAPTER_CACHE_MAX_BYTES = 4 * 1024 ** 3
+ADAPTER_CONFIG = 'adapter_config.json'
+
+
+class AdapterNotFound(Exception):
+    def __init__(self, name):
+        self.name = name
+        super().__init__(f"unknown adapter: {name}")
+
+
+def _state_dict_bytes(state_dict):
+    return sum(t.numel() * t.element_size() for t in state_dict.values())
+
+
+class AdapterManager:
+    """
+    LoRA adapters saved by finetune/finetune.py, served on top of one base model. Every subdirectory
+    of `adapter_dir` with an adapter_config.json is an adapter named after the directory.
+
+    Adapters are injected into the base model with peft when first used, and the least recently used
+    ones are deleted again beyond `max_bytes` of adapter weights (including `modules_to_save` copies).
+    Reading the weights from disk starts in the background as soon as a request is admitted
+    (`prefetch`), so the scheduler thread only copies them to the GPU; switching between loaded
+    adapters just changes which one is active. Everything but `prefetch` runs on the scheduler thread.
+    """
+
+    def __init__(self, model, adapter_dir=None, max_bytes=ADAPTER_CACHE_MAX_BYTES):
+        self.model = model
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.loads = 0
+        self.evictions = 0
+        self.switches = 0
+        self.load_seconds = 0.0
+        self._paths = {}
+        self._loaded = OrderedDict()  # name -> bytes, least recently used first
+        self._pending = {}  # name -> Future of (config, state_dict) read from disk
+        self._peft_model = None
+        self._active = None
+        self._lock = threading.Lock()
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='adapter-reader')
+        if adapter_dir:
+            self.scan(adapter_dir)
+
+    @property
+    def enabled(self):
+        return bool(self._paths)
+
+    def scan(self, adapter_dir):
+        for name in sorted(os.listdir(adapter_dir)):
+            path = os.path.join(adapter_dir, name)
+            if os.path.isfile(os.path.join(path, ADAPTER_CONFIG)):
+                self._paths[name] = path
+        logger.info(f"adapters in {adapter_dir}: {', '.join(self._paths) or 'none'}")
+
+    def check(self, name):
+        if name not in self._paths:
+            raise AdapterNotFound(name)
+
+    def _read(self, name):
+        from peft import PeftConfig
+        from peft.utils import load_peft_weights
+        path = self._paths[name]
+        return PeftConfig.from_pretrained(path), load_peft_weights(path, device='cpu')
+
+    def prefetch(self, name):
+        """Start reading the adapter from disk unless it is loaded or already being read."""
+        self.check(name)
+        with self._lock:
+            if name in self._loaded or name in self._pending:
+                return
+            self._pending[name] = self._reader.submit(self._read, name)
+
+    def _evict(self, size):
+        while self._loaded and self.bytes + size > self.max_bytes:
+            name, evicted = self._loaded.popitem(last=False)
+            self._peft_model.delete_adapter(name)
+            self.bytes -= evicted
+            self.evictions += 1
+            if self._active == name:
+                self._active = None
+            logger.info(f"adapter {name} unloaded")
+
+    def _load(self, name):
+        from peft import get_peft_model, set_peft_model_state_dict
+        start = time.monotonic()
+        with self._lock:
+            future = self._pending.pop(name, None)
+        config, state_dict = future.result() if future is not None else self._read(name)
+        config.inference_mode = True
+        size = _state_dict_bytes(state_dict)
+        self._evict(size)
+        if self._peft_model is None:
+            # injects the LoRA layers into the base model in place, its chat() stays as it is
+            self._peft_model = get_peft_model(self.model, config, adapter_name=name)
+        else:
+            self._peft_model.add_adapter(name, config)
+        set_peft_model_state_dict(self._peft_model, state_dict, adapter_name=name)
+        self._loaded[name] = size
+        self.bytes += size
+        self.loads += 1
+        self.load_seconds += time.monotonic() - start
+        logger.info(f"adapter {name} loaded in {time.monotonic() - start:.2f}s ({size / 1024 ** 2:.0f} MiB)")
+
+    def _activate(self, name):
+        if name == self._active or self._peft_model is None:
+            return
+        if name is None:
+            self._peft_model.base_model.disable_adapter_layers()
+        else:
+            self._peft_model.set_adapter(name)
+            self._peft_model.base_model.enable_adapter_layers()
+        self._active = name
+        self.switches += 1
+
+    @contextmanager
+    def use(self, name):
+        """Run the block with adapter `name` active, or the plain base model for None."""
+        if name is not None:
+            self.check(name)
+            if name in self._loaded:
+                self._loaded.move_to_end(name)
+            else:
+                self._load(name)
+        self._activate(name)
+        yield
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'available': list(self._paths),
+            'loaded': list(self._loaded),
+            'active': self._active,
+            'pending': pending,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'switches': self.switches,
+            'load_seconds': round(self.load_seconds, 3),
+        }
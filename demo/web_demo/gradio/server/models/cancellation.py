@@ -0,0 +1,171 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+logger = logging.getLogger(__name__)
+
+
+class CancelToken:
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.generated_tokens = 0
+        self.max_new_tokens = None
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    def is_cancelled(self):
+        return self._event.is_set()
+
+
+class CancellationRegistry:
+    """
+    Request id -> CancelToken for requests that are queued or running.
+    The scheduler marks the token of the request it is running as current for the worker thread,
+    where the generation hooks pick it up. For a batched generate call it marks one token per batch row.
+    """
+
+    def __init__(self):
+        self.cancelled_requests = 0
+        self.cancelled_tokens = 0
+        self.skipped_tokens = 0
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def register(self, request_id):
+        token = CancelToken(request_id)
+        with self._lock:
+            self._tokens[request_id] = token
+        return token
+
+    def cancel(self, request_id):
+        with self._lock:
+            token = self._tokens.get(request_id)
+        if token is None:
+            return False
+        token.cancel()
+        return True
+
+    def is_cancelled(self, request_id):
+        with self._lock:
+            token = self._tokens.get(request_id)
+        return token is not None and token.is_cancelled()
+
+    def release(self, request_id):
+        with self._lock:
+            token = self._tokens.pop(request_id, None)
+            if token is None or not token.is_cancelled():
+                return
+            self.cancelled_requests += 1
+            self.cancelled_tokens += token.generated_tokens
+            if token.max_new_tokens:
+                self.skipped_tokens += max(token.max_new_tokens - token.generated_tokens, 0)
+        logger.info(f"request {request_id} cancelled after {token.generated_tokens} tokens")
+
+    @contextmanager
+    def active(self, request_id):
+        with self._lock:
+            token = self._tokens.get(request_id)
+        self._local.token = token
+        try:
+            yield token
+        finally:
+            self._local.token = None
+
+    def current(self):
+        return getattr(self._local, 'token', None)
+
+    @contextmanager
+    def active_batch(self, request_ids):
+        with self._lock:
+            tokens = [self._tokens.get(request_id) for request_id in request_ids]
+        self._local.batch = tokens
+        try:
+            yield tokens
+        finally:
+            self._local.batch = None
+
+    def current_batch(self):
+        return getattr(self._local, 'batch', None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._tokens),
+                'cancelled_requests': self.cancelled_requests,
+                # tokens generated before the stop, and the max_new_tokens budget left unspent
+                'cancelled_tokens': self.cancelled_tokens,
+                'skipped_tokens': self.skipped_tokens,
+            }
+
+
+cancellations = CancellationRegistry()
+
+
+class CancelCriteria(StoppingCriteria):
+    def __init__(self, token):
+        self.token = token
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.token.generated_tokens += 1
+        return torch.full((input_ids.shape[0],), self.token.is_cancelled(), dtype=torch.bool, device=input_ids.device)
+
+
+class BatchCancelCriteria(StoppingCriteria):
+    """Stops the rows of the batch members that were cancelled; a member has num_beams rows."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def __call__(self, input_ids, scores, **kwargs):
+        cancelled = []
+        for token in self.tokens:
+            stopped = token is not None and token.is_cancelled()
+            if token is not None and not stopped:
+                token.generated_tokens += 1
+            cancelled.append(stopped)
+        rows_per_member = input_ids.shape[0] // len(self.tokens)
+        return torch.tensor(cancelled, device=input_ids.device).repeat_interleave(rows_per_member)
+
+
+class GenerationCancellation:
+    """
+    Adds a CancelCriteria for the current request to MiniCPM's `_decode` / `_decode_stream`, which run
+    on the calling thread and forward their kwargs to `llm.generate` (for streaming, on another thread).
+    """
+
+    def __init__(self, model, registry=cancellations):
+        self.registry = registry
+        self.supported = hasattr(model, '_decode') and hasattr(model, '_decode_stream')
+        if not self.supported:
+            logger.warning("Generation cancellation unavailable: model has no _decode/_decode_stream")
+            return
+        model._decode = self._wrap_decode(model._decode)
+        model._decode_stream = self._wrap_decode(model._decode_stream)
+
+    def _wrap_decode(self, decode):
+        registry = self.registry
+
+        def decode_with_cancel(*args, **kwargs):
+            token = registry.current()
+            batch = registry.current_batch()
+            if token is None and not batch:
+                return decode(*args, **kwargs)
+            criteria = StoppingCriteriaList(kwargs.get('stopping_criteria') or [])
+            if token is not None:
+                token.max_new_tokens = kwargs.get('max_new_tokens')
+                criteria.append(CancelCriteria(token))
+            else:
+                for member in batch:
+                    if member is not None:
+                        member.max_new_tokens = kwargs.get('max_new_tokens')
+                criteria.append(BatchCancelCriteria(batch))
+            kwargs['stopping_criteria'] = criteria
+            return decode(*args, **kwargs)
+
+        return decode_with_cancel
@@ -0,0 +1,161 @@
+import base64
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+from .timing import timings
+
+logger = logging.getLogger(__name__)
+
+IMAGE_CACHE_MAX_BYTES = 1024 ** 3
+
+
+class ImageCacheMiss(Exception):
+    """Raised for `image_ref` contents whose image is not (or no longer) cached."""
+
+    def __init__(self, hashes):
+        self.hashes = list(hashes)
+        super().__init__(f"images not cached: {', '.join(self.hashes)}")
+
+
+def image_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ImageCache:
+    """
+    Thread-safe LRU of decoded RGB images keyed by the sha256 of the uploaded (base64-decoded) bytes,
+    bounded by decoded pixel bytes.
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(image):
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, key):
+        with self._lock:
+            image = self._items.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def contains(self, key):
+        with self._lock:
+            return key in self._items
+
+    def put(self, key, image):
+        size = self._size(image)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._size(self._items.pop(key))
+            self._items[key] = image
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.bytes -= self._size(evicted)
+
+    def decode(self, b64):
+        """Decode a base64 image, reusing the cached copy when the same bytes were seen before."""
+        start = time.monotonic()
+        data = base64.b64decode(b64)
+        key = image_hash(data)
+        image = self.get(key)
+        if image is None:
+            image = Image.open(BytesIO(data)).convert('RGB')
+            # lets later stages (vision embedding cache) key on the content hash
+            image.info['sha256'] = key
+            self.put(key, image)
+        timing = timings.current()
+        if timing is not None:
+            timing.image(time.monotonic() - start)
+        return image
+
+    def resolve(self, key):
+        image = self.get(key)
+        if image is None:
+            raise ImageCacheMiss([key])
+        timing = timings.current()
+        if timing is not None:
+            timing.image()
+        return image
+
+    def missing(self, msgs):
+        """Hashes of `image_ref` contents in `msgs` that are not cached."""
+        missing = []
+        for msg in msgs:
+            for c in msg.get('content', msg.get('contents', [])):
+                if isinstance(c, dict) and c.get('type') == 'image_ref' and not self.contains(c['hash']):
+                    missing.append(c['hash'])
+        return missing
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._items),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+image_cache = ImageCache()
+
+
+def image_key(image):
+    """Content hash of an image that came through the cache, else None."""
+    return image.info.get('sha256')
+
+
+def load_image_content(c):
+    """Turn an `image` (base64 `pairs`) or `image_ref` (`hash`) content item into a PIL image."""
+    if c['type'] == 'image':
+        # the server's preprocessing workers add the hash of images they already decoded
+        if c.get('hash'):
+            try:
+                return image_cache.resolve(c['hash'])
+            except ImageCacheMiss:
+                pass
+        return image_cache.decode(c['pairs'])
+    return image_cache.resolve(c['hash'])
+
+
+def limit_image_side(image, msgs, max_side):
+    """
+    Downscale the top-level image and the images in `msgs` (in place) so their longer side is at
+    most `max_side`. Resized copies get their own content key, so caches keep full-size and
+    downscaled embeddings apart. Returns the top-level image.
+    """
+    def limit(img):
+        if max(img.size) <= max_side:
+            return img
+        scale = max_side / max(img.size)
+        resized = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.BICUBIC)
+        key = image_key(img)
+        if key is not None:
+            resized.info['sha256'] = f'{key}@{max_side}'
+        return resized
+
+    for msg in msgs:
+        msg['content'] = [limit(c) if isinstance(c, Image.Image) else c for c in msg['content']]
+    return limit(image) if image is not None else None
@@ -0,0 +1,200 @@
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from PIL import Image
+from transformers import DynamicCache
+
+from .image_cache import image_key
+
+logger = logging.getLogger(__name__)
+
+KV_CACHE_MAX_BYTES = 4 * 1024 ** 3
+
+
+def cache_bytes(cache):
+    if hasattr(cache, 'layers'):
+        tensors = [t for layer in cache.layers for t in (layer.keys, layer.values) if t is not None]
+    else:
+        tensors = list(cache.key_cache) + list(cache.value_cache)
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def common_prefix_len(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class PrefixEntry:
+    def __init__(self, tokens, images, cache):
+        self.tokens = tokens  # prompt token ids the cache holds keys/values for
+        self.images = images  # content hashes of the images behind the prompt's image placeholders
+        self.cache = cache
+        self.bytes = cache_bytes(cache)
+
+
+class PrefixKVStore:
+    """Last-turn KV cache per session_id, LRU-evicted under a global byte budget."""
+
+    def __init__(self, max_bytes=KV_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_prefill_tokens = 0
+        self.prefill_tokens = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, session_id):
+        """Remove and return the session's entry; the caller extends the cache in place."""
+        with self._lock:
+            entry = self._items.pop(session_id, None)
+            if entry is not None:
+                self.bytes -= entry.bytes
+            return entry
+
+    def put(self, session_id, entry):
+        if entry.bytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(session_id, None)
+            if old is not None:
+                self.bytes -= old.bytes
+            self._items[session_id] = entry
+            self.bytes += entry.bytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.bytes -= evicted.bytes
+
+    def record(self, prompt_tokens, reused_tokens):
+        with self._lock:
+            if reused_tokens:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.saved_prefill_tokens += reused_tokens
+            self.prefill_tokens += prompt_tokens - reused_tokens
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'sessions': len(self._items),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'saved_prefill_tokens': self.saved_prefill_tokens,
+                'prefill_tokens': self.prefill_tokens,
+            }
+
+
+kv_store = PrefixKVStore()
+
+
+class _Pending:
+    def __init__(self, session_id, images):
+        self.session_id = session_id
+        self.images = images
+        self.input_ids = None
+
+
+class SessionKVReuse:
+    """
+    Reuses the KV cache of a session's previous turn when the new prompt extends it.
+
+    MiniCPM `chat` builds the whole conversation prompt every turn. While enabled, the prompt ids
+    are captured in `get_vllm_embedding`, and `_decode` / `_decode_stream` hand the LLM the previous
+    turn's cache cropped to the longest common token prefix. generate() then only prefills the
+    new suffix. The prefix also has to cover the same images, since image placeholders tokenize
+    alike for any image. After generation the cache is cropped back to the prompt and stored.
+    Only the prompt is kept: clients resend answers without the thinking part, so generated
+    tokens rarely match the next prompt. Beam search and batched calls are left alone.
+    """
+
+    def __init__(self, model, store=kv_store):
+        self.model = model
+        self.store = store
+        self.supported = all(hasattr(model, name) for name in ('get_vllm_embedding', '_decode', '_decode_stream'))
+        self._local = threading.local()
+        if not self.supported:
+            logger.warning("KV prefix reuse unavailable: model has no get_vllm_embedding/_decode/_decode_stream")
+            return
+
+        local = self._local
+        get_vllm_embedding = model.get_vllm_embedding
+
+        def capture_input_ids(data, *args, **kwargs):
+            pending = getattr(local, 'pending', None)
+            if pending is not None:
+                pending.input_ids = data['input_ids']
+            return get_vllm_embedding(data, *args, **kwargs)
+
+        model.get_vllm_embedding = capture_input_ids
+        model._decode = self._wrap_decode(model._decode, stream=False)
+        model._decode_stream = self._wrap_decode(model._decode_stream, stream=True)
+
+    def _wrap_decode(self, decode, stream):
+        local = self._local
+        store = self.store
+
+        def decode_with_prefix(*args, **kwargs):
+            pending = getattr(local, 'pending', None)
+            local.pending = None
+            input_ids = pending.input_ids if pending is not None else None
+            if (input_ids is None or len(input_ids) != 1 or kwargs.get('num_beams', 1) > 1
+                    or 'past_key_values' in kwargs):
+                return decode(*args, **kwargs)
+
+            prompt = input_ids[0].tolist()
+            entry = store.take(pending.session_id)
+            cache, reused = None, 0
+            if entry is not None and pending.images[:len(entry.images)] == entry.images:
+                # keep at least one token to prefill, generate() needs logits for it
+                reused = min(common_prefix_len(entry.tokens, prompt), len(prompt) - 1)
+                if reused > 0:
+                    cache = entry.cache
+                    cache.crop(reused)
+            if cache is None:
+                cache, reused = DynamicCache(), 0
+            store.record(len(prompt), reused)
+            kwargs['past_key_values'] = cache
+
+            def save():
+                cache.crop(len(prompt))
+                store.put(pending.session_id, PrefixEntry(prompt, pending.images, cache))
+
+            output = decode(*args, **kwargs)
+            if not stream:
+                save()
+                return output
+
+            def stream_then_save():
+                # the streamer is fed by a generate() thread; the cache is complete once it is drained
+                yield from output
+                save()
+            return stream_then_save()
+
+        return decode_with_prefix
+
+    @contextmanager
+    def use(self, session_id, msgs, chat_kwargs):
+        if not self.supported or not session_id or chat_kwargs.get('image') is not None:
+            yield
+            return
+        images = tuple(image_key(c) for msg in msgs for c in msg['content'] if isinstance(c, Image.Image))
+        if None in images:
+            yield
+            return
+        self._local.pending = _Pending(session_id, images)
+        try:
+            yield
+        finally:
+            self._local.pending = None
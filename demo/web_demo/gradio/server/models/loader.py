@@ -0,0 +1,134 @@
+import glob
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import torch
+from transformers import AutoConfig, AutoModel
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """Collects wall-clock durations of named startup phases."""
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = []
+
+    @contextmanager
+    def phase(self, label):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((label, time.perf_counter() - start))
+
+    def total(self):
+        return sum(seconds for _, seconds in self.phases)
+
+    def as_dict(self):
+        return {label: round(seconds, 3) for label, seconds in self.phases}
+
+    def report(self):
+        logger.info(f"[startup] {self.name} timing breakdown:")
+        for label, seconds in self.phases:
+            logger.info(f"[startup]   {label:<20s} {seconds:8.2f}s")
+        logger.info(f"[startup]   {'total':<20s} {self.total():8.2f}s")
+
+
+def resolve_model_dir(path):
+    if os.path.isdir(path):
+        return path
+    from huggingface_hub import snapshot_download
+    return snapshot_download(path)
+
+
+def _safetensors_files(model_dir):
+    index_file = os.path.join(model_dir, 'model.safetensors.index.json')
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            weight_map = json.load(f)['weight_map']
+        return [os.path.join(model_dir, name) for name in sorted(set(weight_map.values()))]
+    return sorted(glob.glob(os.path.join(model_dir, '*.safetensors')))
+
+
+def _load_lazy(model_dir, config, torch_dtype, device, skip_prefixes, timer, model_kwargs):
+    from accelerate import init_empty_weights
+    from accelerate.utils import set_module_tensor_to_device
+    from safetensors import safe_open
+
+    files = _safetensors_files(model_dir)
+    if not files:
+        raise FileNotFoundError(f"no safetensors weights found in {model_dir}")
+
+    with timer.phase('meta_init'):
+        # Buffers stay on the host: they are small and many of them are
+        # computed in __init__ rather than stored in the checkpoint.
+        with init_empty_weights(include_buffers=False):
+            model = AutoModel.from_config(
+                config, trust_remote_code=True, torch_dtype=torch_dtype, **model_kwargs)
+
+    pending = set(model.state_dict().keys())
+    # checkpoints saved from a model with a head carry the base model prefix
+    strip_prefix = f"{model.base_model_prefix}." if model.base_model_prefix else None
+    loaded, skipped = 0, 0
+    with timer.phase('load_weights'):
+        for file in files:
+            # safe_open memory-maps the shard; get_tensor copies each tensor
+            # straight to `device` without materializing the shard on the host.
+            with safe_open(file, framework='pt', device=str(device)) as shard:
+                for key in shard.keys():
+                    name = key
+                    if name not in pending and strip_prefix and name.startswith(strip_prefix):
+                        name = name[len(strip_prefix):]
+                    if key.startswith(skip_prefixes) or name not in pending:
+                        skipped += 1
+                        continue
+                    value = shard.get_tensor(key)
+                    dtype = torch_dtype if value.is_floating_point() else None
+                    set_module_tensor_to_device(model, name, device, value=value, dtype=dtype)
+                    pending.discard(name)
+                    loaded += 1
+
+    with timer.phase('finalize'):
+        model.tie_weights()
+        missing = [name for name, param in model.named_parameters() if param.device.type == 'meta']
+        if missing:
+            raise RuntimeError(f"{len(missing)} parameters missing from checkpoint, e.g. {missing[:3]}")
+        model.to(device)
+
+    logger.info(f"Lazy load: {loaded} tensors loaded, {skipped} skipped from {len(files)} shard(s)")
+    return model
+
+
+def load_pretrained(path, config=None, torch_dtype=torch.bfloat16, device='cuda',
+                    skip_prefixes=(), timer=None, **model_kwargs):
+    """
+    Build the model on the meta device and stream safetensors weights straight to `device`.
+    Checkpoint keys under `skip_prefixes` (or belonging to modules disabled in `config`) are never read.
+    Falls back to `AutoModel.from_pretrained` when the checkpoint cannot be loaded lazily.
+    """
+    timer = timer or StartupTimer(os.path.basename(path.rstrip('/')))
+    with timer.phase('resolve'):
+        model_dir = resolve_model_dir(path)
+    if config is None:
+        with timer.phase('config'):
+            config = AutoConfig.from_pretrained(model_dir, trust_remote_code=True)
+
+    try:
+        return _load_lazy(model_dir, config, torch_dtype, device, tuple(skip_prefixes), timer, model_kwargs).eval()
+    except Exception as e:
+        logger.warning(f"Lazy load failed ({e}), falling back to from_pretrained")
+
+    # the partially loaded model is unreachable once the except block exits
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    with timer.phase('from_pretrained'):
+        model = AutoModel.from_pretrained(
+            model_dir, config=config, trust_remote_code=True, torch_dtype=torch_dtype,
+            low_cpu_mem_usage=True, **model_kwargs)
+        model.to(device)
+    return model.eval()
@@ -1,36 +1,59 @@
-from io import BytesIO
 import torch
-from PIL import Image
-import base64
 import json
-import re
 import logging
-from transformers import AutoModel, AutoTokenizer, AutoConfig
+from transformers import AutoTokenizer, AutoProcessor, AutoConfig
+from .loader import StartupTimer, load_pretrained
+from .image_cache import load_image_content, limit_image_side
+from .video_store import load_video_content
+from .vision_cache import SessionVisionCache
+from .kv_cache import SessionKVReuse
+from .cancellation import GenerationCancellation
+from .timing import GenerationTiming
+from .postprocess import TagFilter, clean_answer, output_tokens
 
 logger = logging.getLogger(__name__)
 
+AUDIO_TTS_PREFIXES = ('apm.', 'audio_projection_layer.', 'audio_avg_pooler.', 'tts.')
+
 class ModelMiniCPMO4_5:
-    def __init__(self, path) -> None:
+    def __init__(self, path, device='cuda') -> None:
+        self.startup_timer = StartupTimer('MiniCPM-o 4.5')
         # Load config and disable audio/TTS modules, keeping only vision module to save VRAM
-        config = AutoConfig.from_pretrained(path, trust_remote_code=True)
+        with self.startup_timer.phase('config'):
+            config = AutoConfig.from_pretrained(path, trust_remote_code=True)
         config.init_audio = False  # Disable audio module (Whisper)
         config.init_tts = False    # Disable TTS module
         config.init_vision = True  # Keep vision module
         
         logger.info(f"Loading MiniCPM-o 4.5 with vision-only mode (init_audio={config.init_audio}, init_tts={config.init_tts}, init_vision={config.init_vision})")
         
-        self.model = AutoModel.from_pretrained(
-            path, config=config, trust_remote_code=True, attn_implementation='sdpa', torch_dtype=torch.bfloat16)
-        self.model.eval().cuda()
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            path, trust_remote_code=True)
+        # Audio/TTS weights are skipped without being read from the checkpoint
+        self.model = load_pretrained(
+            path, config=config, device=device, timer=self.startup_timer,
+            skip_prefixes=AUDIO_TTS_PREFIXES, attn_implementation='sdpa', torch_dtype=torch.bfloat16)
+        with self.startup_timer.phase('tokenizer'):
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                path, trust_remote_code=True)
+        with self.startup_timer.phase('processor'):
+            self.processor = AutoProcessor.from_pretrained(
+                path, trust_remote_code=True)
+        # chat() would otherwise load its own copy on the first request
+        if getattr(self.model, 'processor', None) is None:
+            self.model.processor = self.processor
+        self.vision_cache = SessionVisionCache(self.model, self.processor.image_processor)
+        self.kv_reuse = SessionKVReuse(self.model)
+        self.cancellation = GenerationCancellation(self.model)
+        self.timing = GenerationTiming(self.model)
+        self.startup_timer.report()
 
     def __call__(self, input_data):
         image = None
         if "image" in input_data and len(input_data["image"]) > 10:
-            image = Image.open(BytesIO(base64.b64decode(
-                input_data["image"]))).convert('RGB')
+            # the preprocessing workers may have decoded it already
+            image = load_image_content({'type': 'image', 'pairs': input_data["image"],
+                                        'hash': input_data.get("image_hash")})
 
+        session_id = input_data.get("session_id")
         msgs = input_data["question"]
         params = input_data.get("params", "{}")
         params = json.loads(params)
@@ -54,14 +77,21 @@ class ModelMiniCPMO4_5:
                 if isinstance(c, dict):
                     if c['type'] == 'text':
                         c = c['pairs']
-                    elif c['type'] == 'image':
-                        c = Image.open(
-                            BytesIO(base64.b64decode(c["pairs"]))).convert('RGB')
+                    elif c['type'] in ('image', 'image_ref'):
+                        c = load_image_content(c)
+                    elif c['type'] == 'video_ref':
+                        # frames sampled by /api/video
+                        new_cnts.extend(load_video_content(c))
+                        continue
                     else:
                         raise ValueError(
-                            "contents type only support text and image.")
+                            "contents type only support text, image, image_ref and video_ref.")
                 new_cnts.append(c)
             msg['content'] = new_cnts
+        # set by the server's slice policy under load
+        max_image_side = params.pop('max_image_side', None)
+        if max_image_side:
+            image = limit_image_side(image, msgs, max_image_side)
         logger.info(f'msgs: {str(msgs)}')
 
         enable_thinking = params.pop('enable_thinking', False)
@@ -85,7 +115,7 @@ class ModelMiniCPMO4_5:
             logger.info(f'Suppressing <think> token (151667) since enable_thinking=False')
         
         if is_streaming:
-            return self._stream_chat(image, msgs, enable_thinking, params)
+            return self._stream_chat(image, msgs, enable_thinking, params, session_id)
         else:
             # MiniCPM-o 4.5's chat method doesn't need tokenizer and processor params
             chat_kwargs = {
@@ -95,22 +125,18 @@ class ModelMiniCPMO4_5:
                 **params
             }
             
-            answer = self.model.chat(**chat_kwargs)
+            with self.vision_cache.use(session_id, msgs, chat_kwargs), \
+                    self.kv_reuse.use(session_id, msgs, chat_kwargs):
+                answer = self.model.chat(**chat_kwargs)
 
-            res = re.sub(r'(<box>.*</box>)', '', answer)
-            res = res.replace('<ref>', '')
-            res = res.replace('</ref>', '')
-            res = res.replace('<box>', '')
-            answer = res.replace('</box>', '')
+            answer = clean_answer(answer)
             
             # Log raw output for debugging
             logger.info(f'Raw answer (first 500 chars): {answer[:500] if len(answer) > 500 else answer}')
                 
-            oids = self.tokenizer.encode(answer)
-            output_tokens = len(oids)
-            return answer, output_tokens
+            return answer, {"output_tokens": output_tokens(answer, self.tokenizer)}
 
-    def _stream_chat(self, image, msgs, enable_thinking, params): 
+    def _stream_chat(self, image, msgs, enable_thinking, params, session_id=None): 
         try:
             params['stream'] = True
             # MiniCPM-o 4.5's chat method doesn't need tokenizer and processor params
@@ -121,34 +147,23 @@ class ModelMiniCPMO4_5:
                 **params
             }
             
-            answer_generator = self.model.chat(**chat_kwargs)
+            with self.vision_cache.use(session_id, msgs, chat_kwargs), \
+                    self.kv_reuse.use(session_id, msgs, chat_kwargs):
+                answer_generator = self.model.chat(**chat_kwargs)
             
             if not hasattr(answer_generator, '__iter__'):
-                answer = answer_generator
-                res = re.sub(r'(<box>.*</box>)', '', answer)
-                res = res.replace('<ref>', '')
-                res = res.replace('</ref>', '')
-                res = res.replace('<box>', '')
-                answer = res.replace('</box>', '')
-                
-                for char in answer:
+                for char in clean_answer(answer_generator):
                     yield char
             else:
-                full_answer = ""
-                
+                # tags may be split across chunks, the filter holds back a possible tag prefix
+                tag_filter = TagFilter()
                 for chunk in answer_generator:
-                    if isinstance(chunk, str):
-                        clean_chunk = re.sub(r'(<box>.*</box>)', '', chunk)
-                        clean_chunk = clean_chunk.replace('<ref>', '')
-                        clean_chunk = clean_chunk.replace('</ref>', '')
-                        clean_chunk = clean_chunk.replace('<box>', '')
-                        clean_chunk = clean_chunk.replace('</box>', '')
-                        
-                        full_answer += chunk
+                    clean_chunk = tag_filter.feed(chunk if isinstance(chunk, str) else str(chunk))
+                    if clean_chunk:
                         yield clean_chunk
-                    else:
-                        full_answer += str(chunk)
-                        yield str(chunk)
+                rest = tag_filter.flush()
+                if rest:
+                    yield rest
                         
         except Exception as e:
             logger.error(f"Stream chat error: {e}")
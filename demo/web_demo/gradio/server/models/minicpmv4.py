@@ -1,11 +1,15 @@
-from io import BytesIO
 import torch
-from PIL import Image
-import base64
 import json
-import re
 import logging
-from transformers import AutoModel, AutoTokenizer, AutoProcessor, set_seed
+from transformers import AutoTokenizer, AutoProcessor, set_seed
+from .loader import StartupTimer, load_pretrained
+from .image_cache import load_image_content, limit_image_side
+from .video_store import load_video_content
+from .vision_cache import SessionVisionCache
+from .kv_cache import SessionKVReuse
+from .cancellation import GenerationCancellation
+from .timing import GenerationTiming
+from .postprocess import clean_answer, output_tokens
 # set_seed(42)
 
 
@@ -13,22 +17,32 @@ logger = logging.getLogger(__name__)
 
 
 class ModelMiniCPMV4:
-    def __init__(self, path) -> None:
-        self.model = AutoModel.from_pretrained(
-            path, trust_remote_code=True, attn_implementation='sdpa', torch_dtype=torch.bfloat16)
-        self.model.eval().cuda()
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            path, trust_remote_code=True)
-        self.processor = AutoProcessor.from_pretrained(
-            path, trust_remote_code=True)
+    def __init__(self, path, device='cuda') -> None:
+        self.startup_timer = StartupTimer('MiniCPM-V 4.0')
+        self.model = load_pretrained(
+            path, device=device, timer=self.startup_timer,
+            attn_implementation='sdpa', torch_dtype=torch.bfloat16)
+        with self.startup_timer.phase('tokenizer'):
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                path, trust_remote_code=True)
+        with self.startup_timer.phase('processor'):
+            self.processor = AutoProcessor.from_pretrained(
+                path, trust_remote_code=True)
+        self.vision_cache = SessionVisionCache(self.model, self.processor.image_processor)
+        self.kv_reuse = SessionKVReuse(self.model)
+        self.cancellation = GenerationCancellation(self.model)
+        self.timing = GenerationTiming(self.model)
+        self.startup_timer.report()
 
     def __call__(self, input_data):
         image = None
         # legacy API
         if "image" in input_data and len(input_data["image"]) > 10:
-            image = Image.open(BytesIO(base64.b64decode(
-                input_data["image"]))).convert('RGB')
+            # the preprocessing workers may have decoded it already
+            image = load_image_content({'type': 'image', 'pairs': input_data["image"],
+                                        'hash': input_data.get("image_hash")})
 
+        session_id = input_data.get("session_id")
         msgs = input_data["question"]
         params = input_data.get("params", "{}")
         params = json.loads(params)
@@ -51,29 +65,32 @@ class ModelMiniCPMV4:
                 if isinstance(c, dict):
                     if c['type'] == 'text':
                         c = c['pairs']
-                    elif c['type'] == 'image':
-                        c = Image.open(
-                            BytesIO(base64.b64decode(c["pairs"]))).convert('RGB')
+                    elif c['type'] in ('image', 'image_ref'):
+                        c = load_image_content(c)
+                    elif c['type'] == 'video_ref':
+                        # frames sampled by /api/video
+                        new_cnts.extend(load_video_content(c))
+                        continue
                     else:
                         raise ValueError(
-                            "contents type only support text and image.")
+                            "contents type only support text, image, image_ref and video_ref.")
                 new_cnts.append(c)
             msg['content'] = new_cnts
+        # set by the server's slice policy under load
+        max_image_side = params.pop('max_image_side', None)
+        if max_image_side:
+            image = limit_image_side(image, msgs, max_image_side)
         logger.info(f'msgs: {str(msgs)}')
 
-        answer = self.model.chat(
-            image=image,
-            msgs=msgs,
-            tokenizer=self.tokenizer,
-            processor=self.processor,
+        chat_kwargs = {
+            "image": image,
+            "msgs": msgs,
+            "tokenizer": self.tokenizer,
+            "processor": self.processor,
             **params
-        )
-        res = re.sub(r'(<box>.*</box>)', '', answer)
-        res = res.replace('<ref>', '')
-        res = res.replace('</ref>', '')
-        res = res.replace('<box>', '')
-        answer = res.replace('</box>', '')
-
-        oids = self.tokenizer.encode(answer)
-        output_tokens = len(oids)
-        return answer, output_tokens
+        }
+        with self.vision_cache.use(session_id, msgs, chat_kwargs), \
+                self.kv_reuse.use(session_id, msgs, chat_kwargs):
+            answer = self.model.chat(**chat_kwargs)
+        answer = clean_answer(answer)
+        return answer, {"output_tokens": output_tokens(answer, self.tokenizer)}
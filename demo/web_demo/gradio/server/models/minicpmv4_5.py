@@ -1,30 +1,47 @@
-from io import BytesIO
 import torch
-from PIL import Image
-import base64
 import json
-import re
 import logging
-from transformers import AutoModel, AutoTokenizer, AutoProcessor, set_seed
+from transformers import AutoTokenizer, AutoProcessor, set_seed
+from .loader import StartupTimer, load_pretrained
+from .image_cache import load_image_content, limit_image_side
+from .video_store import load_video_content
+from .prompt_lookup import PromptLookupDecoding
+from .vision_cache import SessionVisionCache
+from .kv_cache import SessionKVReuse
+from .cancellation import GenerationCancellation
+from .timing import GenerationTiming, timings
+from .thinking_budget import ThinkingBudget
+from .postprocess import TagFilter, clean_answer, output_tokens
 # set_seed(42)
 
 logger = logging.getLogger(__name__)
 
 class ModelMiniCPMV4_5:
-    def __init__(self, path) -> None:
-        self.model = AutoModel.from_pretrained(
-            path, trust_remote_code=True, attn_implementation='sdpa', torch_dtype=torch.bfloat16, device_map="auto")
-        self.model.eval().cuda()
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            path, trust_remote_code=True)
-        self.processor = AutoProcessor.from_pretrained(
-            path, trust_remote_code=True)
+    def __init__(self, path, device='cuda') -> None:
+        self.startup_timer = StartupTimer('MiniCPM-V 4.5')
+        self.model = load_pretrained(
+            path, device=device, timer=self.startup_timer,
+            attn_implementation='sdpa', torch_dtype=torch.bfloat16)
+        with self.startup_timer.phase('tokenizer'):
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                path, trust_remote_code=True)
+        with self.startup_timer.phase('processor'):
+            self.processor = AutoProcessor.from_pretrained(
+                path, trust_remote_code=True)
+        self.prompt_lookup = PromptLookupDecoding(self.model)
+        self.vision_cache = SessionVisionCache(self.model, self.processor.image_processor)
+        self.kv_reuse = SessionKVReuse(self.model)
+        self.cancellation = GenerationCancellation(self.model)
+        self.timing = GenerationTiming(self.model)
+        self.thinking_budget = ThinkingBudget(self.model, self.tokenizer)
+        self.startup_timer.report()
 
-    def __call__(self, input_data):
+    def _parse_input(self, input_data):
         image = None
         if "image" in input_data and len(input_data["image"]) > 10:
-            image = Image.open(BytesIO(base64.b64decode(
-                input_data["image"]))).convert('RGB')
+            # the preprocessing workers may have decoded it already
+            image = load_image_content({'type': 'image', 'pairs': input_data["image"],
+                                        'hash': input_data.get("image_hash")})
 
         msgs = input_data["question"]
         params = input_data.get("params", "{}")
@@ -53,22 +70,46 @@ class ModelMiniCPMV4_5:
                 if isinstance(c, dict):
                     if c['type'] == 'text':
                         c = c['pairs']
-                    elif c['type'] == 'image':
-                        c = Image.open(
-                            BytesIO(base64.b64decode(c["pairs"]))).convert('RGB')
+                    elif c['type'] in ('image', 'image_ref'):
+                        c = load_image_content(c)
+                    elif c['type'] == 'video_ref':
+                        # frames sampled by /api/video
+                        new_cnts.extend(load_video_content(c))
+                        continue
                     else:
                         raise ValueError(
-                            "contents type only support text and image.")
+                            "contents type only support text, image, image_ref and video_ref.")
                 new_cnts.append(c)
             msg['content'] = new_cnts
+        # set by the server's slice policy under load
+        max_image_side = params.pop('max_image_side', None)
+        if max_image_side:
+            image = limit_image_side(image, msgs, max_image_side)
         logger.info(f'msgs: {str(msgs)}')
+        return image, msgs, params, temporal_ids
+
+    def __call__(self, input_data):
+        image, msgs, params, temporal_ids = self._parse_input(input_data)
+        session_id = input_data.get("session_id")
 
         enable_thinking = params.pop('enable_thinking', True)
         is_streaming = params.pop('stream', False)
+        # OCR / document fast mode: prompt-lookup speculative decoding, greedy only.
+        # `prompt_lookup` is true or the number of draft tokens per step.
+        prompt_lookup = params.pop('prompt_lookup', False)
+        # tokens allowed inside <think> before </think> is forced
+        thinking_budget = params.pop('thinking_budget_tokens', None)
+        if not enable_thinking:
+            thinking_budget = None
         
         if is_streaming:
-            return self._stream_chat(image, msgs, enable_thinking, params, temporal_ids)
+            if prompt_lookup:
+                logger.info("prompt_lookup is ignored for streaming requests")
+            return self._stream_chat(image, msgs, enable_thinking, params, temporal_ids, session_id, thinking_budget)
         else:
+            if prompt_lookup:
+                params['sampling'] = False
+                params['num_beams'] = 1
             chat_kwargs = {
                 "image": image,
                 "msgs": msgs,
@@ -81,22 +122,63 @@ class ModelMiniCPMV4_5:
             if temporal_ids is not None:
                 chat_kwargs["temporal_ids"] = temporal_ids
             
-            answer = self.model.chat(**chat_kwargs)
+            usage = {}
+            budget = None
+            if prompt_lookup:
+                if thinking_budget is not None:
+                    # assisted decoding scores draft tokens the processor has not seen in order
+                    logger.info("thinking_budget_tokens is ignored with prompt_lookup")
+                num_tokens = 10 if prompt_lookup is True else int(prompt_lookup)
+                with self.prompt_lookup.enabled(num_tokens) as lookup_stats, \
+                        self.vision_cache.use(session_id, msgs, chat_kwargs):
+                    answer = self.model.chat(**chat_kwargs)
+                if self.prompt_lookup.supported:
+                    usage.update(lookup_stats.as_dict())
+            else:
+                with self.vision_cache.use(session_id, msgs, chat_kwargs), \
+                        self.kv_reuse.use(session_id, msgs, chat_kwargs), \
+                        self.thinking_budget.enabled(thinking_budget) as budget:
+                    answer = self.model.chat(**chat_kwargs)
+
+            answer, output_usage = self._postprocess_answer(answer, enable_thinking)
+            usage.update(output_usage)
+            if budget is not None:
+                usage.update(budget.usage(output_tokens=output_usage["output_tokens"]))
+            return answer, usage
 
-            res = re.sub(r'(<box>.*</box>)', '', answer)
-            res = res.replace('<ref>', '')
-            res = res.replace('</ref>', '')
-            res = res.replace('<box>', '')
-            answer = res.replace('</box>', '')
-            if not enable_thinking:
-                print(f"enable_thinking: {enable_thinking}")
-                answer = answer.replace('</think>', '')
-                
-            oids = self.tokenizer.encode(answer)
-            output_tokens = len(oids)
-            return answer, output_tokens
+    def _postprocess_answer(self, answer, enable_thinking, batched=False):
+        answer = clean_answer(answer, enable_thinking)
+        # a batch shares one generation count, so its rows are still counted by re-encoding
+        oids = len(self.tokenizer.encode(answer)) if batched else output_tokens(answer, self.tokenizer)
+        return answer, {"output_tokens": oids}
 
-    def _stream_chat(self, image, msgs, enable_thinking, params, temporal_ids=None): 
+    def batch_call(self, input_datas):
+        """Batched non-streaming generation; the scheduler only groups requests with identical params."""
+        parsed = [self._parse_input(input_data) for input_data in input_datas]
+        params = parsed[0][2]
+        enable_thinking = params.pop('enable_thinking', True)
+        params.pop('stream', None)
+        thinking_budget = params.pop('thinking_budget_tokens', None)
+        if not enable_thinking:
+            thinking_budget = None
+        # batched chat takes images inside msgs and a list of conversations
+        with self.thinking_budget.enabled(thinking_budget) as budget:
+            answers = self.model.chat(
+                image=None,
+                msgs=[msgs for _, msgs, _, _ in parsed],
+                tokenizer=self.tokenizer,
+                processor=self.processor,
+                enable_thinking=enable_thinking,
+                **params
+            )
+        results = [self._postprocess_answer(answer, enable_thinking, batched=True) for answer in answers]
+        if budget is not None:
+            for row, (_, usage) in enumerate(results):
+                usage.update(budget.usage(row, usage["output_tokens"]))
+        return results
+
+    def _stream_chat(self, image, msgs, enable_thinking, params, temporal_ids=None, session_id=None,
+                     thinking_budget=None):
         try:
             params['stream'] = True
             chat_kwargs = {
@@ -110,47 +192,28 @@ class ModelMiniCPMV4_5:
             if temporal_ids is not None:
                 chat_kwargs["temporal_ids"] = temporal_ids
             
-            answer_generator = self.model.chat(**chat_kwargs)
+            with self.vision_cache.use(session_id, msgs, chat_kwargs), \
+                    self.kv_reuse.use(session_id, msgs, chat_kwargs), \
+                    self.thinking_budget.enabled(thinking_budget) as budget:
+                answer_generator = self.model.chat(**chat_kwargs)
             
             if not hasattr(answer_generator, '__iter__'):
-                answer = answer_generator
-                res = re.sub(r'(<box>.*</box>)', '', answer)
-                res = res.replace('<ref>', '')
-                res = res.replace('</ref>', '')
-                res = res.replace('<box>', '')
-                answer = res.replace('</box>', '')
-                if not enable_thinking:
-                    answer = answer.replace('</think>', '')
-                
-                char_count = 0
-                for char in answer:
+                for char in clean_answer(answer_generator, enable_thinking):
                     yield char
-                    char_count += 1
             else:
-                full_answer = ""
-                chunk_count = 0
-                char_count = 0
-                
+                # tags may be split across chunks, the filter holds back a possible tag prefix
+                tag_filter = TagFilter(enable_thinking)
                 for chunk in answer_generator:
-                    if isinstance(chunk, str):
-                        clean_chunk = re.sub(r'(<box>.*</box>)', '', chunk)
-                        clean_chunk = clean_chunk.replace('<ref>', '')
-                        clean_chunk = clean_chunk.replace('</ref>', '')
-                        clean_chunk = clean_chunk.replace('<box>', '')
-                        clean_chunk = clean_chunk.replace('</box>', '')
-                        
-                        if not enable_thinking:
-                            clean_chunk = clean_chunk.replace('</think>', '')
-                        
-                        full_answer += chunk
-                        char_count += len(clean_chunk)
-                        chunk_count += 1
+                    clean_chunk = tag_filter.feed(chunk if isinstance(chunk, str) else str(chunk))
+                    if clean_chunk:
                         yield clean_chunk
-                    else:
-                        full_answer += str(chunk)
-                        char_count += len(str(chunk))
-                        chunk_count += 1
-                        yield str(chunk)
+                rest = tag_filter.flush()
+                if rest:
+                    yield rest
+            timing = timings.current()
+            if budget is not None and timing is not None:
+                # the server adds these to the stream's final usage event
+                timing.usage.update(budget.usage(output_tokens=timing.output_tokens))
                         
         except Exception as e:
             logger.error(f"Stream chat error: {e}")
@@ -0,0 +1,87 @@
+from .timing import timings
+
+BOX_OPEN, BOX_CLOSE = '<box>', '</box>'
+DROPPED_TAGS = ('<ref>', '</ref>')
+THINK_CLOSE = '</think>'
+
+
+class TagFilter:
+    """
+    Streaming version of the answer clean-up: `<box>...</box>` spans are removed, `<ref>` / `</ref>`
+    and stray box tags are dropped, and so is `</think>` unless thinking is enabled. Chunks may split
+    tags anywhere; a possible tag prefix at the end of a chunk is held back until the next one.
+
+    Unlike the greedy `<box>.*</box>` regex it replaces, each box is removed on its own, so text between
+    two boxes on a line is kept. As with the regex, a box only spans one line: at a newline or at the
+    end of the answer, an unclosed box's content is let through without the tag.
+    """
+
+    def __init__(self, enable_thinking=True):
+        self.tags = (BOX_OPEN, BOX_CLOSE) + DROPPED_TAGS + (() if enable_thinking else (THINK_CLOSE,))
+        self._pending = ''  # possible start of a tag
+        self._box = None  # content of the open box, None outside one
+
+    def _text(self, out, text):
+        if self._box is None:
+            out.append(text)
+            return
+        newline = text.find('\n')
+        if newline == -1:
+            self._box += text
+            return
+        out.append(self._box + text)
+        self._box = None
+
+    def _tag(self, tag):
+        if tag == BOX_OPEN:
+            if self._box is None:
+                self._box = ''
+        elif tag == BOX_CLOSE:
+            self._box = None
+
+    def feed(self, chunk):
+        text = self._pending + chunk
+        self._pending = ''
+        if self._box is None and '<' not in text:
+            # most chunks: no tag can start here
+            return text
+        out = []
+        i = 0
+        while i < len(text):
+            j = text.find('<', i)
+            if j == -1:
+                self._text(out, text[i:])
+                break
+            if j > i:
+                self._text(out, text[i:j])
+            tag = next((t for t in self.tags if text.startswith(t, j)), None)
+            if tag is not None:
+                self._tag(tag)
+                i = j + len(tag)
+            elif any(t.startswith(text[j:]) for t in self.tags):
+                self._pending = text[j:]
+                break
+            else:
+                self._text(out, '<')
+                i = j + 1
+        return ''.join(out)
+
+    def flush(self):
+        """Whatever was held back, once the answer is complete."""
+        rest = (self._box or '') + self._pending
+        self._box = None
+        self._pending = ''
+        return rest
+
+
+def clean_answer(answer, enable_thinking=True):
+    tag_filter = TagFilter(enable_thinking)
+    return tag_filter.feed(answer) + tag_filter.flush()
+
+
+def output_tokens(answer, tokenizer):
+    """Tokens generated for the current request as counted during generation, else re-encoded from the answer."""
+    timing = timings.current()
+    if timing is not None and timing.output_tokens:
+        return timing.output_tokens
+    return len(tokenizer.encode(answer))
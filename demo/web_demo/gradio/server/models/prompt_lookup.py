@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+from transformers import DynamicCache
+
+logger = logging.getLogger(__name__)
+
+
+class PromptLookupStats:
+    def __init__(self):
+        self.forward_calls = 0
+        self.draft_tokens = 0
+        self.output_tokens = 0
+        self.generate_time = 0.0
+
+    def as_dict(self):
+        # the prefill yields no token, every verification step yields its accepted drafts plus one
+        steps = max(self.forward_calls - 1, 0)
+        accepted = max(self.output_tokens - steps, 0)
+        return {
+            "decoding": "prompt_lookup",
+            "draft_tokens": self.draft_tokens,
+            "accepted_tokens": accepted,
+            "acceptance_rate": round(accepted / self.draft_tokens, 4) if self.draft_tokens else 0.0,
+            "tokens_per_second": round(self.output_tokens / self.generate_time, 2) if self.generate_time else 0.0,
+        }
+
+
+class PromptLookupDecoding:
+    """
+    Opt-in prompt-lookup (n-gram) speculative decoding for MiniCPM `chat` calls.
+
+    MiniCPM feeds the LLM `inputs_embeds` only, and transformers' assisted decoding needs the
+    token ids to look n-grams up in. While enabled on the calling thread, the prompt ids are
+    captured in `get_vllm_embedding`. The prompt but its last token is prefilled from the
+    embeddings, which carry the image features, and `llm.generate` continues from that cache with
+    the ids: generate() only re-embeds the uncached tail, the last prompt token and the drafts,
+    and never the image placeholders. The prompt is stripped from the result so the caller sees
+    the usual output. Greedy output is identical to plain greedy decoding; only batch size 1
+    without beams is supported.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.supported = hasattr(model, 'get_vllm_embedding') and hasattr(model, 'llm')
+        self._local = threading.local()
+        if not self.supported:
+            logger.warning("Prompt lookup decoding unavailable: model has no get_vllm_embedding/llm")
+            return
+
+        local = self._local
+        get_vllm_embedding = model.get_vllm_embedding
+        llm_generate = model.llm.generate
+
+        def capture_input_ids(data, *args, **kwargs):
+            if getattr(local, 'stats', None) is not None:
+                local.input_ids = data['input_ids']
+            return get_vllm_embedding(data, *args, **kwargs)
+
+        def generate_with_lookup(*args, **kwargs):
+            stats = getattr(local, 'stats', None)
+            input_ids = getattr(local, 'input_ids', None)
+            if stats is None or input_ids is None or args or 'inputs_embeds' not in kwargs:
+                return llm_generate(*args, **kwargs)
+            inputs_embeds = kwargs.pop('inputs_embeds')
+            input_ids = input_ids.to(inputs_embeds.device)
+            attention_mask = kwargs.get('attention_mask')
+            kwargs['prompt_lookup_num_tokens'] = local.num_tokens
+            kwargs['max_matching_ngram_size'] = local.max_ngram_size
+            start = time.perf_counter()
+            # the last prompt token is chat template text, so its embedding is the plain token embedding
+            cache = DynamicCache()
+            with torch.no_grad():
+                model.llm(inputs_embeds=inputs_embeds[:, :-1],
+                          attention_mask=attention_mask[:, :-1] if attention_mask is not None else None,
+                          past_key_values=cache, use_cache=True)
+            kwargs['past_key_values'] = cache
+            output = llm_generate(input_ids, **kwargs)
+            stats.generate_time += time.perf_counter() - start
+            output = output[:, input_ids.shape[1]:]
+            stats.output_tokens += output.shape[1]
+            return output
+
+        def count_forward(module, args, kwargs):
+            stats = getattr(local, 'stats', None)
+            if stats is None:
+                return
+            inputs = kwargs.get('input_ids')
+            if inputs is None:
+                inputs = kwargs.get('inputs_embeds')
+            if stats.forward_calls and inputs is not None:
+                # verification passes see the last accepted token plus the drafted ones
+                stats.draft_tokens += inputs.shape[1] - 1
+            stats.forward_calls += 1
+
+        model.get_vllm_embedding = capture_input_ids
+        model.llm.generate = generate_with_lookup
+        model.llm.register_forward_pre_hook(count_forward, with_kwargs=True)
+
+    @contextmanager
+    def enabled(self, num_tokens=10, max_ngram_size=2):
+        stats = PromptLookupStats()
+        if not self.supported:
+            yield stats
+            return
+        self._local.stats = stats
+        self._local.num_tokens = num_tokens
+        self._local.max_ngram_size = max_ngram_size
+        try:
+            yield stats
+        finally:
+            self._local.stats = None
+            self._local.input_ids = None
@@ -0,0 +1,192 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .image_cache import image_hash
+
+logger = logging.getLogger(__name__)
+
+# params that change how a result is delivered, not what it is
+_DELIVERY_PARAMS = ('stream',)
+
+
+def is_deterministic(params):
+    # MiniCPM chat samples unless told otherwise; prompt lookup forces greedy decoding
+    return params.get('sampling') is False or bool(params.get('prompt_lookup'))
+
+
+def _canonical_content(c):
+    if isinstance(c, dict) and c.get('type') == 'image':
+        return {'type': 'image', 'sha256': image_hash(base64.b64decode(c['pairs']))}
+    if isinstance(c, dict) and c.get('type') == 'image_ref':
+        # same key as the full image, so a replayed conversation hits either way
+        return {'type': 'image', 'sha256': c['hash']}
+    return c
+
+
+def request_key(model_id, query, delivery_params=()):
+    """
+    Hash of everything that determines a deterministic answer, or None when the request samples.
+    Images are replaced by the sha256 of their bytes, so re-encoded base64 of the same file still matches.
+    `delivery_params` are the model's own params that do not change the answer.
+    """
+    params = json.loads(query.get('params') or '{}')
+    if not is_deterministic(params):
+        return None
+    for name in _DELIVERY_PARAMS + tuple(delivery_params):
+        params.pop(name, None)
+    msgs = [
+        {'role': msg.get('role'), 'content': [_canonical_content(c) for c in msg.get('content', msg.get('contents', []))]}
+        for msg in json.loads(query['question'])
+    ]
+    image = query.get('image') or ''
+    canonical = {
+        'model': model_id,
+        'params': params,
+        'msgs': msgs,
+        'image': image_hash(base64.b64decode(image)) if len(image) > 10 else None,
+        'temporal_ids': query.get('temporal_ids'),
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, ensure_ascii=True).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Answers of deterministic requests, in a thread-safe in-memory LRU bounded by bytes and optionally
+    backed by one JSON file per entry in `directory`. Entries expire `ttl` seconds after they were stored.
+    Disabled while `max_bytes` is 0.
+
+    `put` is called from the scheduler thread, so disk writes go to a background writer and never hold
+    up generation. `get` and `request_key` (base64 decoding, hashing, disk reads) block, the server calls
+    them from its threadpool.
+    """
+
+    def __init__(self, max_bytes=0, ttl=3600, directory=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # key -> (stored_at, result, usage, size)
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='result-cache-writer')
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _expired(self, stored_at):
+        return self.ttl and time.time() - stored_at > self.ttl
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def _put_memory(self, key, stored_at, result, usage):
+        size = len(result.encode()) + len(key)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= old[3]
+            self._items[key] = (stored_at, result, usage, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.bytes -= evicted[3]
+
+    def _get_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"result cache: unreadable entry {path}: {e}")
+            return None
+        if self._expired(entry['stored_at']):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry
+
+    def get(self, key):
+        """(result, usage) for a live entry, else None."""
+        if not self.enabled or key is None:
+            return None
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and self._expired(entry[0]):
+                del self._items[key]
+                self.bytes -= entry[3]
+                entry = None
+            if entry is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return entry[1], dict(entry[2])
+        if self.directory:
+            disk = self._get_disk(key)
+            if disk is not None:
+                self._put_memory(key, disk['stored_at'], disk['result'], disk['usage'])
+                with self._lock:
+                    self.disk_hits += 1
+                return disk['result'], dict(disk['usage'])
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result, usage):
+        if not self.enabled or key is None:
+            return
+        stored_at = time.time()
+        usage = dict(usage or {})
+        self._put_memory(key, stored_at, result, usage)
+        if self.directory:
+            self._writer.submit(self._put_disk, self.directory, key, stored_at, result, usage)
+
+    def _put_disk(self, directory, key, stored_at, result, usage):
+        path = os.path.join(directory, f'{key}.json')
+        # instances can share the directory: write a file of our own, then rename it into place,
+        # so a concurrent reader never sees half a file
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'stored_at': stored_at, 'result': result, 'usage': usage}, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"result cache: could not write {path}: {e}")
+
+    def flush(self):
+        """Wait for the disk writes queued so far."""
+        self._writer.submit(lambda: None).result()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._items),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'directory': self.directory,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+
+result_cache = ResultCache()
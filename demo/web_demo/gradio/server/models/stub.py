@@ -0,0 +1,97 @@
+import json
+import logging
+import time
+
+from .image_cache import load_image_content
+from .video_store import load_video_content
+from .cancellation import cancellations
+from .timing import timings
+
+logger = logging.getLogger(__name__)
+
+
+class ModelStub:
+    """
+    CPU-only stand-in for the MiniCPM wrappers, for exercising the server without a GPU.
+    Answers echo the last user text; `params.stub_token_latency` (seconds, default 0.01)
+    sets the simulated per-token decode time.
+    """
+
+    # params that only change how fast the answer comes, left out of result cache keys
+    delivery_params = ('stub_token_latency',)
+
+    def __init__(self, path=None) -> None:
+        self.path = path
+        logger.info("Using stub model, no weights are loaded")
+
+    def _parse_input(self, input_data):
+        msgs = json.loads(input_data["question"])
+        params = json.loads(input_data.get("params", "{}"))
+        num_images = 0
+        question = ""
+        for msg in msgs:
+            contents = msg.get('content', msg.get('contents', []))
+            for c in contents:
+                if isinstance(c, dict) and c.get('type') == 'text':
+                    if msg.get('role') == 'user':
+                        question = c['pairs']
+                elif isinstance(c, dict) and c.get('type') == 'video_ref':
+                    num_images += len(load_video_content(c))
+                elif isinstance(c, dict):
+                    load_image_content(c)
+                    num_images += 1
+                elif isinstance(c, str) and msg.get('role') == 'user':
+                    question = c
+        return msgs, params, num_images, question
+
+    def _answer(self, num_images, question):
+        return f"stub answer for {num_images} image(s): {question}"
+
+    def _tokens(self, answer):
+        words = answer.split(' ')
+        return [w + ' ' for w in words[:-1]] + words[-1:]
+
+    def __call__(self, input_data):
+        msgs, params, num_images, question = self._parse_input(input_data)
+        answer = self._answer(num_images, question)
+        tokens = self._tokens(answer)
+        latency = params.get('stub_token_latency', 0.01)
+        if params.get('stream', False):
+            return self._stream_chat(tokens, latency)
+        answer = ''.join(self._stream_chat(tokens, latency))
+        return answer, {"output_tokens": len(self._tokens(answer))}
+
+    def _stream_chat(self, tokens, latency):
+        cancel_token = cancellations.current()
+        timing = timings.current()
+        if timing is not None:
+            timing.decode_called_at = time.monotonic()
+        for token in tokens:
+            if cancel_token is not None and cancel_token.is_cancelled():
+                return
+            time.sleep(latency)
+            if cancel_token is not None:
+                cancel_token.generated_tokens += 1
+            if timing is not None:
+                timing.token()
+            yield token
+
+    def batch_call(self, input_datas):
+        parsed = [self._parse_input(d) for d in input_datas]
+        answers = [self._answer(num_images, question) for _, _, num_images, question in parsed]
+        latency = parsed[0][1].get('stub_token_latency', 0.01)
+        cancel_tokens = cancellations.current_batch() or [None] * len(answers)
+        tokens = [self._tokens(a) for a in answers]
+        generated = [[] for _ in answers]
+        # one decode step for all members; a batch costs as long as its longest member, cancelled ones stop
+        for step in range(max(len(t) for t in tokens)):
+            running = [i for i, t in enumerate(tokens) if step < len(t)
+                       and not (cancel_tokens[i] is not None and cancel_tokens[i].is_cancelled())]
+            if not running:
+                break
+            time.sleep(latency)
+            for i in running:
+                generated[i].append(tokens[i][step])
+                if cancel_tokens[i] is not None:
+                    cancel_tokens[i].generated_tokens += 1
+        return [(''.join(g), {"output_tokens": len(g)}) for g in generated]
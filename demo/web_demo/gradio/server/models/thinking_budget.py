@@ -0,0 +1,130 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+from transformers import LogitsProcessor, LogitsProcessorList
+
+logger = logging.getLogger(__name__)
+
+THINK_OPEN, THINK_CLOSE = '<think>', '</think>'
+
+_BEFORE, _THINKING, _ANSWER = range(3)
+
+
+class _Row:
+    __slots__ = ('state', 'thinking_tokens', 'answer_tokens', 'forced')
+
+    def __init__(self):
+        self.state = _BEFORE
+        self.thinking_tokens = 0  # `<think>` ... `</think>`, tags included
+        self.answer_tokens = 0
+        self.forced = False
+
+
+class ThinkingBudgetProcessor(LogitsProcessor):
+    """
+    Once a row has generated `budget` tokens after `<think>`, only `</think>` may come next, and the
+    model goes on with the answer. Counts thinking and answer tokens per row on the way.
+
+    generate() passes the whole sequence every step; the processor only looks at the tokens added
+    since its last call, and everything before its first call is the prompt.
+    """
+
+    def __init__(self, budget, think_open_id, think_close_id):
+        self.budget = budget
+        self.think_open_id = think_open_id
+        self.think_close_id = think_close_id
+        self.rows = []
+        self._seen = None
+
+    def _count(self, row, token):
+        if row.state == _THINKING:
+            row.thinking_tokens += 1
+            if token == self.think_close_id:
+                row.state = _ANSWER
+        elif token == self.think_open_id and row.state == _BEFORE:
+            row.state = _THINKING
+            row.thinking_tokens += 1
+        else:
+            row.answer_tokens += 1
+
+    def __call__(self, input_ids, scores):
+        if self._seen is None:
+            self._seen = input_ids.shape[1]
+            self.rows = [_Row() for _ in range(input_ids.shape[0])]
+        new_tokens = input_ids[:, self._seen:].tolist()
+        self._seen = input_ids.shape[1]
+        for i, (row, tokens) in enumerate(zip(self.rows, new_tokens)):
+            for token in tokens:
+                self._count(row, token)
+            # thinking_tokens includes `<think>`
+            if row.state == _THINKING and row.thinking_tokens > self.budget:
+                scores[i, :] = -float('inf')
+                scores[i, self.think_close_id] = 0.0
+                row.forced = True
+        return scores
+
+    def usage(self, row=0, output_tokens=None):
+        """
+        Usage fields for one row. The processor never sees the last token, and in a batch it also
+        counts the padding after a row finished, so given the row's `output_tokens` the answer gets
+        the remainder.
+        """
+        if row >= len(self.rows):
+            return {}
+        r = self.rows[row]
+        answer_tokens = max(output_tokens - r.thinking_tokens, 0) if output_tokens else r.answer_tokens
+        return {
+            "thinking_tokens": r.thinking_tokens,
+            "answer_tokens": answer_tokens,
+            "thinking_budget_tokens": self.budget,
+            "thinking_budget_exhausted": r.forced,
+        }
+
+
+class ThinkingBudget:
+    """
+    Adds a ThinkingBudgetProcessor to MiniCPM's `_decode` / `_decode_stream` while enabled on the
+    calling thread. `chat()` drops generate kwargs it does not know, so the processor cannot be
+    passed through it.
+    """
+
+    def __init__(self, model, tokenizer):
+        self._local = threading.local()
+        vocab = tokenizer.get_vocab()
+        self.think_open_id = vocab.get(THINK_OPEN)
+        self.think_close_id = vocab.get(THINK_CLOSE)
+        self.supported = (hasattr(model, '_decode') and hasattr(model, '_decode_stream')
+                          and self.think_open_id is not None and self.think_close_id is not None)
+        if not self.supported:
+            logger.warning("Thinking budget unavailable: model has no _decode/_decode_stream or no think tokens")
+            return
+        model._decode = self._wrap_decode(model._decode)
+        model._decode_stream = self._wrap_decode(model._decode_stream)
+
+    def _wrap_decode(self, decode):
+        local = self._local
+
+        def decode_with_budget(*args, **kwargs):
+            processor = getattr(local, 'processor', None)
+            if processor is None:
+                return decode(*args, **kwargs)
+            processors = LogitsProcessorList(kwargs.get('logits_processor') or [])
+            processors.append(processor)
+            kwargs['logits_processor'] = processors
+            return decode(*args, **kwargs)
+
+        return decode_with_budget
+
+    @contextmanager
+    def enabled(self, budget):
+        """Yields the request's processor, whose usage() is complete once generation has finished."""
+        if not self.supported or budget is None:
+            yield None
+            return
+        processor = ThinkingBudgetProcessor(int(budget), self.think_open_id, self.think_close_id)
+        self._local.processor = processor
+        try:
+            yield processor
+        finally:
+            self._local.processor = None
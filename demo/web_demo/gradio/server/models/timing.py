@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTiming:
+    """Per-request timestamps and counts, filled in by the model wrappers while a request runs."""
+
+    def __init__(self, enqueued_at=None):
+        self.enqueued_at = enqueued_at if enqueued_at is not None else time.monotonic()
+        self.images = 0
+        self.image_decode_seconds = 0.0
+        self.decode_called_at = None
+        self.first_token_at = None
+        self.last_token_at = None
+        self.output_tokens = 0
+        # model-specific fields for a stream's usage summary, e.g. thinking tokens
+        self.usage = {}
+
+    def image(self, decode_seconds=0.0):
+        self.images += 1
+        self.image_decode_seconds += decode_seconds
+
+    def token(self, count=1):
+        now = time.monotonic()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.last_token_at = now
+        self.output_tokens += count
+
+    @property
+    def prefill_seconds(self):
+        if self.decode_called_at is None or self.first_token_at is None:
+            return None
+        return self.first_token_at - self.decode_called_at
+
+    @property
+    def time_to_first_token(self):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.enqueued_at
+
+    @property
+    def decode_tokens_per_second(self):
+        # the first token comes out of prefill, the rate covers the ones after it
+        if self.output_tokens < 2 or self.last_token_at <= self.first_token_at:
+            return None
+        return (self.output_tokens - 1) / (self.last_token_at - self.first_token_at)
+
+
+class _TimingContext:
+    """Thread-local current RequestTiming, set by the scheduler around the model call."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @contextmanager
+    def active(self, timing):
+        self._local.timing = timing
+        try:
+            yield timing
+        finally:
+            self._local.timing = None
+
+    def current(self):
+        return getattr(self._local, 'timing', None)
+
+
+timings = _TimingContext()
+
+
+class TokenTimer(StoppingCriteria):
+    """Never stops generation; records when tokens come out of generate()."""
+
+    def __init__(self, timing):
+        self.timing = timing
+        self._length = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # input_ids may or may not include the prompt, and prompt lookup adds several tokens per step
+        length = input_ids.shape[1]
+        self.timing.token(1 if self._length is None else length - self._length)
+        self._length = length
+        return torch.zeros((input_ids.shape[0],), dtype=torch.bool, device=input_ids.device)
+
+
+class GenerationTiming:
+    """
+    Adds a TokenTimer for the current request to MiniCPM's `_decode` / `_decode_stream`.
+    Prefill is timed from the `_decode` call, once the vision encoder and embedding are done,
+    to the first generated token.
+    """
+
+    def __init__(self, model, context=timings):
+        self.context = context
+        self.supported = hasattr(model, '_decode') and hasattr(model, '_decode_stream')
+        if not self.supported:
+            logger.warning("Generation timing unavailable: model has no _decode/_decode_stream")
+            return
+        model._decode = self._wrap_decode(model._decode)
+        model._decode_stream = self._wrap_decode(model._decode_stream)
+
+    def _wrap_decode(self, decode):
+        context = self.context
+
+        def decode_with_timer(*args, **kwargs):
+            timing = context.current()
+            if timing is None:
+                return decode(*args, **kwargs)
+            timing.decode_called_at = time.monotonic()
+            criteria = StoppingCriteriaList(kwargs.get('stopping_criteria') or [])
+            criteria.append(TokenTimer(timing))
+            kwargs['stopping_criteria'] = criteria
+            return decode(*args, **kwargs)
+
+        return decode_with_timer
@@ -0,0 +1,235 @@
+import hashlib
+import logging
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+VIDEO_STORE_MAX_BYTES = 4 * 1024 ** 3
+
+# sampling constants, kept in line with the clients' frame_sampler
+DOUBLE_FRAME_DURATION = 30
+MAX_NUM_FRAMES = 180
+MAX_NUM_PACKING = 3
+TIME_SCALE = 0.1
+ONE_FPS_MAX_FRAMES = 64
+# frames are encoded with max_slice_nums=1, so the model sees roughly 448x448 per frame
+VIDEO_MAX_SIDE = 448 * 4
+# frames per decord get_batch call
+FRAME_CHUNK = 16
+
+
+class VideoNotCached(Exception):
+    """Raised for `video_ref` contents whose frames are not (or no longer) in the store."""
+
+    def __init__(self, video_ids):
+        self.video_ids = list(video_ids)
+        super().__init__(f"videos not cached: {', '.join(self.video_ids)}")
+
+
+def uniform_sample(l, n):
+    gap = len(l) / n
+    idxs = [int(i * gap + gap / 2) for i in range(n)]
+    return [l[i] for i in idxs]
+
+
+def packing_plan(num_frames, fps, choose_fps=None):
+    """MiniCPM-V 4.5: sample at `choose_fps` (doubled for short clips) and pack up to MAX_NUM_PACKING frames."""
+    video_duration = num_frames / fps
+    effective_fps = choose_fps if choose_fps else 1
+
+    if video_duration < DOUBLE_FRAME_DURATION and effective_fps <= 5:
+        effective_fps = effective_fps * 2
+        packing_nums = 2
+        choose_frames = round(min(effective_fps, round(fps)) * min(MAX_NUM_FRAMES, video_duration))
+    elif effective_fps * int(video_duration) <= MAX_NUM_FRAMES:
+        packing_nums = 1
+        choose_frames = round(min(effective_fps, round(fps)) * min(MAX_NUM_FRAMES, video_duration))
+    else:
+        packing_size = math.ceil(video_duration * effective_fps / MAX_NUM_FRAMES)
+        if packing_size <= MAX_NUM_PACKING:
+            choose_frames = round(video_duration * effective_fps)
+            packing_nums = packing_size
+        else:
+            choose_frames = round(MAX_NUM_FRAMES * MAX_NUM_PACKING)
+            packing_nums = MAX_NUM_PACKING
+
+    frame_idx = np.array(uniform_sample(list(range(num_frames)), choose_frames))
+    return frame_idx, packing_nums
+
+
+def one_fps_plan(num_frames, fps, choose_fps=None):
+    """MiniCPM-o 4.5 / MiniCPM-V 4.0: 1 fps, at most ONE_FPS_MAX_FRAMES - 1 frames, no temporal ids."""
+    sample_fps = round(fps / 1)
+    frame_idx = list(range(0, num_frames, sample_fps))
+    if len(frame_idx) >= ONE_FPS_MAX_FRAMES:
+        frame_idx = uniform_sample(frame_idx, ONE_FPS_MAX_FRAMES - 1)
+    return np.array(frame_idx), 1
+
+
+PLANS = {'packing': packing_plan, 'one_fps': one_fps_plan}
+
+
+def decode_size(width, height, max_side):
+    """Target (width, height) for decord, or (-1, -1) to keep the native size."""
+    if max(width, height) <= max_side:
+        return -1, -1
+    scale = max_side / max(width, height)
+    return max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+
+
+def temporal_grid_ids(timestamps, duration):
+    """
+    Snap timestamps to the nearest point of the TIME_SCALE grid over [0, duration) and return
+    grid value / TIME_SCALE truncated to int, exactly like the clients' frame_sampler
+    (float error included, the model was trained on these ids).
+    """
+    scale = np.arange(0, duration, TIME_SCALE)
+    right = np.clip(np.searchsorted(scale, timestamps), 0, len(scale) - 1)
+    left = np.maximum(right - 1, 0)
+    nearest = np.where(np.abs(timestamps - scale[left]) <= np.abs(scale[right] - timestamps), left, right)
+    return (scale[nearest] / TIME_SCALE).astype(np.int32)
+
+
+class StoredVideo:
+    def __init__(self, video_id, frames, temporal_ids, packing_nums, fps, duration):
+        self.video_id = video_id
+        self.frames = frames  # PIL images
+        self.temporal_ids = temporal_ids  # grouped per packing window, None for the one_fps plan
+        self.packing_nums = packing_nums
+        self.fps = fps
+        self.duration = duration
+        self.bytes = sum(frame.width * frame.height * 3 for frame in frames)
+
+    def info(self):
+        return {
+            'video_id': self.video_id,
+            'num_frames': len(self.frames),
+            'temporal_ids': self.temporal_ids,
+            'packing_nums': self.packing_nums,
+            'fps': round(self.fps, 3),
+            'duration': round(self.duration, 3),
+        }
+
+
+def video_id(file_hash, plan, choose_fps):
+    return hashlib.sha256(f'{file_hash}:{plan}:{choose_fps}'.encode()).hexdigest()
+
+
+def decode_video(path, vid, plan='packing', choose_fps=None, max_side=VIDEO_MAX_SIDE, chunk_size=FRAME_CHUNK):
+    """
+    Sample frames from the file at `path` the way the clients used to before uploading them as images.
+    Frames are decoded `chunk_size` at a time, so besides the kept frames only one chunk of decoder
+    output is in memory.
+    """
+    from decord import VideoReader, cpu
+
+    vr = VideoReader(path, ctx=cpu(0))
+    fps = vr.get_avg_fps()
+    num_frames = len(vr)
+    height, width = vr[0].shape[:2]
+    frame_idx, packing_nums = PLANS[plan](num_frames, fps, choose_fps)
+
+    target_w, target_h = decode_size(width, height, max_side)
+    if target_w > 0:
+        # decord scales inside the decoder, so full-resolution frames never reach numpy
+        vr = VideoReader(path, ctx=cpu(0), width=target_w, height=target_h)
+    frames = []
+    for start in range(0, len(frame_idx), chunk_size):
+        chunk = vr.get_batch(frame_idx[start:start + chunk_size].tolist()).asnumpy()
+        for array in chunk:
+            frame = Image.fromarray(array)
+            # per-frame content keys let the KV cache match follow-up turns about the same video
+            frame.info['sha256'] = f'{vid}:{len(frames)}'
+            frames.append(frame)
+        del chunk
+
+    duration = num_frames / fps
+    temporal_ids = None
+    if plan == 'packing':
+        frame_ts_id = temporal_grid_ids(frame_idx / fps, duration).tolist()
+        temporal_ids = [frame_ts_id[i:i + packing_nums] for i in range(0, len(frame_ts_id), packing_nums)]
+    logger.info(f"decoded {len(frames)} frames at {frames[0].width}x{frames[0].height} "
+                f"(source {width}x{height}), plan {plan}, packing {packing_nums}")
+    return StoredVideo(vid, frames, temporal_ids, packing_nums, fps, duration)
+
+
+class VideoStore:
+    """Thread-safe LRU of uploaded, sampled videos keyed by video id, bounded by decoded frame bytes."""
+
+    def __init__(self, max_bytes=VIDEO_STORE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, vid):
+        with self._lock:
+            video = self._items.get(vid)
+            if video is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(vid)
+            self.hits += 1
+            return video
+
+    def contains(self, vid):
+        with self._lock:
+            return vid in self._items
+
+    def put(self, video):
+        if video.bytes > self.max_bytes:
+            logger.warning(f"video {video.video_id} ({video.bytes} bytes of frames) exceeds the store budget")
+            return
+        with self._lock:
+            old = self._items.pop(video.video_id, None)
+            if old is not None:
+                self.bytes -= old.bytes
+            self._items[video.video_id] = video
+            self.bytes += video.bytes
+            self.uploads += 1
+            while self.bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.bytes -= evicted.bytes
+
+    def resolve(self, vid):
+        video = self.get(vid)
+        if video is None:
+            raise VideoNotCached([vid])
+        return video
+
+    def missing(self, msgs):
+        """Ids of `video_ref` contents in `msgs` that are not stored."""
+        missing = []
+        for msg in msgs:
+            for c in msg.get('content', msg.get('contents', [])):
+                if isinstance(c, dict) and c.get('type') == 'video_ref' and not self.contains(c['video_id']):
+                    missing.append(c['video_id'])
+        return missing
+
+    def stats(self):
+        with self._lock:
+            return {
+                'videos': len(self._items),
+                'frames': sum(len(v.frames) for v in self._items.values()),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'uploads': self.uploads,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+video_store = VideoStore()
+
+
+def load_video_content(c):
+    """Frames of a `video_ref` content item, in place of the per-frame images clients used to send."""
+    return video_store.resolve(c['video_id']).frames
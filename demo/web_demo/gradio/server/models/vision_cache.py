@@ -0,0 +1,162 @@
+import inspect
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+from PIL import Image
+
+from .image_cache import image_key
+
+logger = logging.getLogger(__name__)
+
+VISION_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+
+class VisionEmbeddingCache:
+    """
+    Thread-safe LRU of resampler outputs keyed by (session_id, image hash, max_slice_nums),
+    bounded by tensor bytes across all sessions.
+    """
+
+    def __init__(self, max_bytes=VISION_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped_encodes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(tensor):
+        return tensor.numel() * tensor.element_size()
+
+    def get(self, key):
+        with self._lock:
+            tensor = self._items.get(key)
+            if tensor is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return tensor
+
+    def put(self, key, tensor):
+        size = self._size(tensor)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._size(self._items.pop(key))
+            self._items[key] = tensor
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.bytes -= self._size(evicted)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._items),
+                'sessions': len({key[0] for key in self._items}),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'skipped_encodes': self.skipped_encodes,
+            }
+
+
+vision_cache = VisionEmbeddingCache()
+
+
+class SessionVisionCache:
+    """
+    Reuses vision encoder outputs across the turns of a session.
+
+    When every image of a conversation is cached, the concatenated embeddings are passed to
+    `chat(vision_hidden_states=...)` and the vision encoder is skipped. Otherwise `chat` runs as
+    usual and the embeddings it computes are captured in `get_vllm_embedding`, split per image
+    and cached. Video requests with temporal ids are not cached, the resampler packs their frames.
+    """
+
+    def __init__(self, model, image_processor, cache=vision_cache):
+        self.model = model
+        self.image_processor = image_processor
+        self.cache = cache
+        self.supported = (
+            image_processor is not None
+            and hasattr(model, 'get_vllm_embedding')
+            and 'vision_hidden_states' in inspect.signature(model.chat).parameters
+        )
+        self._local = threading.local()
+        if not self.supported:
+            logger.warning("Vision embedding cache unavailable for this model")
+            return
+
+        local = self._local
+        get_vllm_embedding = model.get_vllm_embedding
+
+        def capture_vision_hidden_states(data, *args, **kwargs):
+            result = get_vllm_embedding(data, *args, **kwargs)
+            pending = getattr(local, 'pending', None)
+            if pending is None or 'vision_hidden_states' in data or not isinstance(result, tuple):
+                return result
+            local.pending = None
+            keys, counts = pending
+            states = result[1]
+            if len(states) != 1 or not torch.is_tensor(states[0]) or states[0].shape[0] != sum(counts):
+                logger.warning(f"vision cache: unexpected embedding layout, expected {sum(counts)} slices")
+                return result
+            for key, part in zip(keys, torch.split(states[0], counts)):
+                # clone so a cached image does not pin the whole conversation's tensor
+                cache.put(key, part.detach().clone())
+            return result
+
+        model.get_vllm_embedding = capture_vision_hidden_states
+
+    def _slice_count(self, image, max_slice_nums):
+        processor = self.image_processor
+        if not getattr(processor, 'slice_mode', True):
+            return 1
+        if not hasattr(processor, 'get_sliced_grid'):
+            return None
+        grid = processor.get_sliced_grid(image.size, max_slice_nums)
+        # source image plus one slice per grid cell
+        return 1 if grid is None else 1 + grid[0] * grid[1]
+
+    @contextmanager
+    def use(self, session_id, msgs, chat_kwargs):
+        """Fill `chat_kwargs['vision_hidden_states']` on a full hit, else cache what `chat` computes."""
+        if (not self.supported or not session_id or chat_kwargs.get('image') is not None
+                or chat_kwargs.get('temporal_ids') is not None):
+            yield
+            return
+        images = [c for msg in msgs for c in msg['content'] if isinstance(c, Image.Image)]
+        max_slice_nums = chat_kwargs.get('max_slice_nums') or getattr(self.image_processor, 'max_slice_nums', None)
+        hashes = [image_key(image) for image in images]
+        if not images or None in hashes:
+            yield
+            return
+
+        keys = [(session_id, h, max_slice_nums) for h in hashes]
+        cached = [self.cache.get(key) for key in keys]
+        if all(tensor is not None for tensor in cached):
+            self.cache.skipped_encodes += len(images)
+            chat_kwargs['vision_hidden_states'] = [torch.cat(cached)]
+            yield
+            return
+
+        counts = [self._slice_count(image, max_slice_nums) for image in images]
+        if None in counts:
+            yield
+            return
+        self._local.pending = (keys, counts)
+        try:
+            yield
+        finally:
+            self._local.pending = None
@@ -0,0 +1,159 @@
+import asyncio
+import base64
+import concurrent.futures
+import functools
+import json
+import logging
+import multiprocessing as mp
+import os
+import threading
+import time
+from io import BytesIO
+from multiprocessing import resource_tracker, shared_memory
+
+from PIL import Image
+from starlette.concurrency import run_in_threadpool
+
+from models import image_cache
+from models.image_cache import image_hash
+
+logger = logging.getLogger(__name__)
+
+PREPROCESS_WORKERS = 2
+
+
+def _decode_image(b64):
+    """Worker: base64 -> RGB pixels in a new shared memory block, left for the server to unlink."""
+    start = time.monotonic()
+    data = base64.b64decode(b64)
+    key = image_hash(data)
+    image = Image.open(BytesIO(data)).convert('RGB')
+    pixels = image.tobytes()
+    shm = shared_memory.SharedMemory(create=True, size=max(len(pixels), 1))
+    try:
+        shm.buf[:len(pixels)] = pixels
+    finally:
+        shm.close()
+    return key, shm.name, image.size, time.monotonic() - start
+
+
+def _take_image(key, shm_name, size):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        with shm.buf[:size[0] * size[1] * 3] as pixels:
+            image = Image.frombytes('RGB', size, pixels)
+    finally:
+        shm.close()
+        shm.unlink()
+    image.info['sha256'] = key
+    return image
+
+
+class Preprocessor:
+    """
+    Decodes a request's base64 images in worker processes before it is queued, so the scheduler
+    thread that owns the model finds them in the image cache instead of decoding them itself.
+    The pixels come back through shared memory. Decoded images go into the image cache, and their
+    `image` contents get the `hash` to find them by, the top-level image its `image_hash`. The base64
+    stays, in case the image was evicted by the time the model reads it. The workers' decode time goes
+    into `image_decode_seconds`, counted with the request's timing. Parsing and re-serializing the
+    question runs in the threadpool. The model's processor (slicing, normalisation) still runs inside chat().
+
+    The workers are forked before the model is loaded, so they carry neither the weights nor CUDA
+    state. With 0 processes the model decodes the images itself, as before.
+    """
+
+    def __init__(self, processes=PREPROCESS_WORKERS):
+        self.processes = processes
+        self.images = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._pool is not None
+
+    def start(self):
+        if self.processes > 0 and self._pool is None:
+            if os.name == 'posix':
+                # one tracker for the server and the workers, so blocks created there and unlinked
+                # here are not reported as leaked
+                resource_tracker.ensure_running()
+            context = mp.get_context('fork') if os.name == 'posix' else mp.get_context()
+            self._pool = context.Pool(self.processes)
+        return self
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _submit(self, b64):
+        """
+        Decode in a worker; the Future resolves to the image's hash, or None if it did not fit in the
+        cache, and the decode seconds.
+        """
+        future = concurrent.futures.Future()
+
+        def done(result):
+            # runs on the pool's result thread, which also unlinks blocks of abandoned requests
+            try:
+                key, shm_name, size, seconds = result
+                image = _take_image(key, shm_name, size)
+                if not image_cache.contains(key):
+                    image_cache.put(key, image)
+                future.set_result((key if image_cache.contains(key) else None, seconds))
+            except Exception as e:
+                future.set_exception(e)
+
+        self._pool.apply_async(_decode_image, (b64,), callback=done, error_callback=future.set_exception)
+        return future
+
+    async def run(self, query):
+        """Decode the images of `query` and add their hashes to it."""
+        if not self.enabled:
+            return
+        start = time.monotonic()
+        # the question can be megabytes of base64, keep parsing it off the event loop
+        msgs = await run_in_threadpool(json.loads, query["question"])
+        items = [c for msg in msgs for c in msg.get('content', msg.get('contents', []))
+                 if isinstance(c, dict) and c.get('type') == 'image']
+        b64s = [c['pairs'] for c in items]
+        top_level = len(query.get("image") or "") > 10
+        if top_level:
+            b64s.append(query["image"])
+        if not b64s:
+            return
+        results = await asyncio.gather(*(asyncio.wrap_future(self._submit(b64)) for b64 in b64s),
+                                       return_exceptions=True)
+        decoded = [r for r in results if not isinstance(r, Exception)]
+        for c, result in zip(items, results):
+            if not isinstance(result, Exception) and result[0]:
+                c['hash'] = result[0]
+        if top_level and not isinstance(results[-1], Exception) and results[-1][0]:
+            query["image_hash"] = results[-1][0]
+        if any('hash' in c for c in items):
+            query["question"] = await run_in_threadpool(functools.partial(json.dumps, msgs, ensure_ascii=True))
+        query["image_decode_seconds"] = sum(seconds for _, seconds in decoded)
+        # left to the model, which fails the request as it always did
+        failed = len(results) - len(decoded)
+        with self._lock:
+            self.images += len(decoded)
+            self.failed += failed
+            self.seconds += time.monotonic() - start
+        if failed:
+            logger.warning(f"preprocessing workers could not decode {failed} image(s) of request")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'processes': self.processes if self.enabled else 0,
+                'images': self.images,
+                'failed': self.failed,
+                'seconds': round(self.seconds, 3),
+            }
+
+
+preprocessor = Preprocessor()
@@ -0,0 +1,533 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import re
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import fastapi
+import httpx
+import uvicorn
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from logging_util import setup_root_logger
+
+logger = logging.getLogger(__name__)
+
+# hop-by-hop and length headers are recomputed by whichever side sends the body
+_SKIP_HEADERS = {'host', 'content-length', 'connection', 'keep-alive', 'transfer-encoding', 'accept-encoding'}
+_VIDEO_ID = re.compile(r'"video_id"\s*:\s*"([^"]+)"')
+
+
+class NoInstanceAvailable(Exception):
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Instance:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.healthy = True
+        self.failures = 0
+        self.last_error = None
+        self.last_check = None
+        self.model_type = None
+        self.in_flight = 0
+        self.in_flight_tokens = 0
+        self.requests = 0
+        self.busy_until = 0.0  # monotonic; set from the Retry-After of a 503
+        self.rejections = 0
+
+    def load(self, balance):
+        if balance == 'tokens':
+            return (self.in_flight_tokens, self.in_flight)
+        return (self.in_flight, self.in_flight_tokens)
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'model_type': self.model_type,
+            'in_flight': self.in_flight,
+            'in_flight_tokens': self.in_flight_tokens,
+            'requests': self.requests,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'rejections': self.rejections,
+            'busy_for': round(max(self.busy_until - time.monotonic(), 0.0), 3),
+        }
+
+
+class InstancePool:
+    """
+    Registry of gradio_server instances. Requests go to the healthy instance with the least
+    in-flight work (requests, or requested tokens with `balance='tokens'`). A session sticks to
+    the instance that served it, where its image, vision and KV caches are, until that instance
+    goes unhealthy. Requests with `video_ref` contents go to the instance the video was uploaded to,
+    which holds its frames. An instance that answered 503 (queue full, warming up) gets no new
+    sessions until its Retry-After has passed. Runs on the event loop only, so no locking.
+    """
+
+    def __init__(self, urls=(), balance='requests', max_sessions=10000, unhealthy_after=2):
+        self.balance = balance
+        self.max_sessions = max_sessions
+        self.unhealthy_after = unhealthy_after
+        self.instances = OrderedDict()
+        self.sessions = OrderedDict()  # session_id -> instance url, LRU
+        self.videos = OrderedDict()  # video_id -> instance url of the upload, LRU
+        self.requests = {}  # request_id -> instance url, while in flight
+        self.pinned_hits = 0
+        for url in urls:
+            self.add(url)
+
+    def add(self, url):
+        instance = Instance(url)
+        self.instances.setdefault(instance.url, instance)
+        return self.instances[instance.url]
+
+    def remove(self, url):
+        instance = self.instances.pop(url.rstrip('/'), None)
+        if instance is not None:
+            for pins in (self.sessions, self.videos):
+                for key in [k for k, u in pins.items() if u == instance.url]:
+                    del pins[key]
+        return instance
+
+    def _pin(self, pins, key, instance):
+        pins[key] = instance.url
+        pins.move_to_end(key)
+        while len(pins) > self.max_sessions:
+            pins.popitem(last=False)
+
+    def pinned(self, session_id=None, video_ids=(), exclude=()):
+        """The healthy instance the session is pinned to, else the one holding one of the videos, or None."""
+        urls = [self.sessions.get(session_id)] if session_id else []
+        urls += [self.videos.get(vid) for vid in video_ids]
+        for url in urls:
+            instance = self.instances.get(url)
+            if instance is not None and instance.healthy and instance.url not in exclude:
+                return instance
+        return None
+
+    def add_video(self, video_id, instance):
+        self._pin(self.videos, video_id, instance)
+
+    def pick(self, session_id=None, exclude=(), video_ids=()):
+        instance = self.pinned(session_id, video_ids, exclude)
+        # a pinned session goes to its instance even while it is busy, the instance answers for itself
+        if instance is not None:
+            if session_id:
+                self._pin(self.sessions, session_id, instance)
+            self.pinned_hits += 1
+            return instance
+        healthy = [i for i in self.instances.values() if i.healthy and i.url not in exclude]
+        now = time.monotonic()
+        candidates = [i for i in healthy if i.busy_until <= now]
+        if not candidates:
+            if healthy:
+                wait = min(i.busy_until for i in healthy) - now
+                raise NoInstanceAvailable("all instances are busy", max(1, math.ceil(wait)))
+            raise NoInstanceAvailable("no healthy instance available")
+        instance = min(candidates, key=lambda i: i.load(self.balance))
+        if session_id:
+            self._pin(self.sessions, session_id, instance)
+        return instance
+
+    def acquire(self, instance, request_id, tokens):
+        instance.in_flight += 1
+        instance.in_flight_tokens += tokens
+        instance.requests += 1
+        self.requests[request_id] = instance.url
+
+    def release(self, instance, request_id, tokens):
+        instance.in_flight -= 1
+        instance.in_flight_tokens -= tokens
+        self.requests.pop(request_id, None)
+
+    def mark_failed(self, instance, error, down=False):
+        """Forwarding errors take `unhealthy_after` in a row; a failed health check (`down`) takes one."""
+        instance.failures += 1
+        instance.last_error = str(error) or type(error).__name__
+        if instance.healthy and (down or instance.failures >= self.unhealthy_after):
+            instance.healthy = False
+            logger.warning(f"instance {instance.url} marked unhealthy: {instance.last_error}")
+
+    def back_off(self, instance, seconds):
+        instance.busy_until = max(instance.busy_until, time.monotonic() + seconds)
+
+    def mark_ok(self, instance):
+        if not instance.healthy:
+            logger.info(f"instance {instance.url} is healthy again")
+        instance.healthy = True
+        instance.failures = 0
+        instance.last_error = None
+
+    def stats(self):
+        return {
+            'balance': self.balance,
+            'instances': [i.stats() for i in self.instances.values()],
+            'sessions': len(self.sessions),
+            'videos': len(self.videos),
+            'pinned_hits': self.pinned_hits,
+            'in_flight': len(self.requests),
+        }
+
+
+pool = None
+client = None
+args = None
+
+
+async def health_check(instance):
+    try:
+        response = await client.get(instance.url + '/', timeout=args.health_timeout)
+        response.raise_for_status()
+        instance.model_type = response.json().get('model_type')
+        pool.mark_ok(instance)
+    except (httpx.HTTPError, ValueError) as e:
+        pool.mark_failed(instance, e, down=True)
+    instance.last_check = time.time()
+
+
+async def health_loop():
+    while True:
+        await asyncio.gather(*(health_check(i) for i in list(pool.instances.values())))
+        await asyncio.sleep(args.health_interval)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global client
+    # no read timeout: generations and streams can legitimately be silent for a long time
+    client = httpx.AsyncClient(timeout=httpx.Timeout(args.connect_timeout, read=None),
+                               limits=httpx.Limits(max_connections=None, max_keepalive_connections=64))
+    checker = asyncio.create_task(health_loop())
+    try:
+        yield
+    finally:
+        checker.cancel()
+        await client.aclose()
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
+
+
+def parse_body(body):
+    """Parsed /api request body and its token cost for balancing. Bodies can be megabytes of base64, run it in the threadpool."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        raise fastapi.HTTPException(status_code=400, detail="request body is not JSON")
+    if not isinstance(data, dict):
+        raise fastapi.HTTPException(status_code=400, detail="request body is not a JSON object")
+    params = data.get('params') or '{}'
+    if not isinstance(params, str):
+        raise fastapi.HTTPException(status_code=400, detail="params is not a JSON string")
+    try:
+        params = json.loads(params)
+    except ValueError:
+        # left for the instance to reject
+        params = {}
+    if not isinstance(params, dict):
+        raise fastapi.HTTPException(status_code=400, detail="params is not a JSON object")
+    tokens = params.get('max_new_tokens')
+    if not isinstance(tokens, int) or isinstance(tokens, bool) or tokens <= 0:
+        tokens = args.default_tokens
+    return data, tokens
+
+
+def encode_body(data):
+    return json.dumps(data).encode()
+
+
+def forward_headers(headers):
+    return {k: v for k, v in headers.items() if k.lower() not in _SKIP_HEADERS}
+
+
+def video_ids(data):
+    """Ids of the `video_ref` contents in a request, found without parsing the whole question."""
+    question = data.get('question') or ''
+    return _VIDEO_ID.findall(question) if '"video_ref"' in question else []
+
+
+def retry_after(response):
+    """Seconds from a Retry-After header in delta-seconds form, 1 when missing or a date."""
+    try:
+        return max(float(response.headers.get('retry-after', 1)), 0.0)
+    except ValueError:
+        return 1.0
+
+
+async def send(request, path, stream):
+    """
+    Forward to the chosen instance, moving on to the next one when an instance cannot be reached,
+    or turns the request away (429: it would wait past its deadline, 503: queue full or warming up).
+    Requests of a session pinned to an instance are not moved on a rejection, its caches are there;
+    the client gets the rejection with its Retry-After. When every instance rejects, the client
+    gets the rejection with the shortest Retry-After. Returns (instance, request_id, tokens, upstream response).
+    """
+    body = await request.body()
+    data, tokens = await run_in_threadpool(parse_body, body)
+    # the router needs the id to route /api/cancel, so it fills one in like the server would
+    request_id = data.get('request_id')
+    if not request_id:
+        request_id = data['request_id'] = uuid.uuid4().hex
+        body = await run_in_threadpool(encode_body, data)
+    headers = forward_headers(request.headers)
+
+    videos = video_ids(data)
+    pinned = pool.pinned(data.get('session_id'), videos)
+    tried = set()
+    rejected = None  # (Retry-After, response) of the best rejection so far
+    while True:
+        try:
+            instance = pool.pick(data.get('session_id'), exclude=tried, video_ids=videos)
+        except NoInstanceAvailable as e:
+            if rejected is not None:
+                return None, request_id, tokens, rejected[1]
+            raise fastapi.HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+        tried.add(instance.url)
+        pool.acquire(instance, request_id, tokens)
+        try:
+            upstream = await client.send(
+                client.build_request('POST', instance.url + path, content=body, headers=headers), stream=stream)
+        except httpx.TransportError as e:
+            pool.release(instance, request_id, tokens)
+            pool.mark_failed(instance, e)
+            logger.warning(f"forwarding {request_id} to {instance.url} failed: {e}")
+            continue
+        pool.mark_ok(instance)
+        if upstream.status_code in (429, 503):
+            instance.rejections += 1
+            wait = retry_after(upstream)
+            if upstream.status_code == 503:
+                # the instance is turning everyone away, not just this request
+                pool.back_off(instance, wait)
+            if pinned is None or instance is not pinned:
+                pool.release(instance, request_id, tokens)
+                if rejected is None or wait < rejected[0]:
+                    if rejected is not None:
+                        await rejected[1].aclose()
+                    rejected = (wait, upstream)
+                else:
+                    await upstream.aclose()
+                logger.info(f"{instance.url} rejected {request_id} ({upstream.status_code}), trying another instance")
+                continue
+        if rejected is not None:
+            await rejected[1].aclose()
+        return instance, request_id, tokens, upstream
+
+
+def response_headers(upstream):
+    return {k: v for k, v in upstream.headers.items() if k.lower() not in _SKIP_HEADERS | {'content-encoding'}}
+
+
+async def forward(request, path):
+    instance, request_id, tokens, upstream = await send(request, path, stream=False)
+    await upstream.aclose()
+    if instance is not None:
+        pool.release(instance, request_id, tokens)
+    return Response(content=upstream.content, status_code=upstream.status_code, headers=response_headers(upstream))
+
+
+@app.post("/api")
+async def api(request: fastapi.Request):
+    return await forward(request, '/api')
+
+
+@app.post("/api/session/turns")
+async def session_turns(request: fastapi.Request):
+    # pinned by session_id like the requests that continue from these turns
+    return await forward(request, '/api/session/turns')
+
+
+@app.post("/api/video")
+async def video_api(request: fastapi.Request, session_id: str = None):
+    """
+    Stream a video upload through to the instance that serves `session_id` (a query parameter, pinned
+    like /api), or the least loaded one. Later requests with the returned `video_ref` are routed to
+    that instance, where the sampled frames are. The body is not buffered, so a failed upload is not retried.
+    """
+    try:
+        instance = pool.pick(session_id)
+    except NoInstanceAvailable as e:
+        raise fastapi.HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    request_id = uuid.uuid4().hex
+    pool.acquire(instance, request_id, 0)
+    try:
+        upstream = await client.send(client.build_request(
+            'POST', instance.url + '/api/video', params=request.query_params, content=request.stream(),
+            headers=forward_headers(request.headers)))
+    except httpx.TransportError as e:
+        pool.mark_failed(instance, e)
+        logger.warning(f"uploading a video to {instance.url} failed: {e}")
+        raise fastapi.HTTPException(status_code=502, detail=f"upload to {instance.url} failed: {e}")
+    finally:
+        pool.release(instance, request_id, 0)
+    pool.mark_ok(instance)
+    if upstream.status_code == 200:
+        try:
+            pool.add_video(upstream.json()['video_id'], instance)
+        except (ValueError, KeyError):
+            logger.warning(f"unexpected /api/video response from {instance.url}")
+    return Response(content=upstream.content, status_code=upstream.status_code, headers=response_headers(upstream))
+
+
+@app.post("/api/stream")
+async def stream_api(request: fastapi.Request):
+    instance, request_id, tokens, upstream = await send(request, '/api/stream', stream=True)
+
+    async def relay():
+        # the server sends events as they are generated; pass the raw bytes on without buffering.
+        # Closing the upstream response when the client goes away lets the instance cancel the generation.
+        try:
+            async for chunk in upstream.aiter_raw():
+                yield chunk
+        finally:
+            await upstream.aclose()
+            if instance is not None:
+                pool.release(instance, request_id, tokens)
+
+    return StreamingResponse(relay(), status_code=upstream.status_code, headers=response_headers(upstream))
+
+
+class CancelItem(BaseModel):
+    request_id: str
+
+
+@app.post("/api/cancel")
+async def cancel_api(item: CancelItem):
+    url = pool.requests.get(item.request_id)
+    # an unknown id may still be queued somewhere if the router restarted, ask everyone
+    targets = [url] if url else [i.url for i in pool.instances.values() if i.healthy]
+    cancelled = False
+    for target in targets:
+        try:
+            response = await client.post(target + '/api/cancel', json=item.dict())
+            cancelled = cancelled or response.json().get('cancelled', False)
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning(f"cancel {item.request_id} on {target} failed: {e}")
+    return {"request_id": item.request_id, "cancelled": cancelled}
+
+
+@app.delete("/api/session/{session_id}")
+async def delete_session(session_id: str):
+    url = pool.sessions.pop(session_id, None)
+    deleted = False
+    if url:
+        try:
+            response = await client.delete(f'{url}/api/session/{session_id}')
+            deleted = response.json().get('deleted', False)
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning(f"deleting session {session_id} on {url} failed: {e}")
+    return {"session_id": session_id, "deleted": deleted}
+
+
+class InstanceItem(BaseModel):
+    url: str
+
+
+@app.post("/router/instances")
+async def add_instance(item: InstanceItem):
+    instance = pool.add(item.url)
+    await health_check(instance)
+    logger.info(f"registered instance {instance.url} (healthy={instance.healthy})")
+    return instance.stats()
+
+
+@app.delete("/router/instances")
+async def remove_instance(item: InstanceItem):
+    instance = pool.remove(item.url)
+    if instance is None:
+        raise fastapi.HTTPException(status_code=404, detail=f"unknown instance {item.url}")
+    logger.info(f"removed instance {instance.url}")
+    return instance.stats()
+
+
+def merge_metrics(texts):
+    """Join Prometheus expositions, with one HELP and TYPE per family so the result stays valid."""
+    families = OrderedDict()  # name -> ({'HELP': line, 'TYPE': line}, [sample lines])
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith(('# HELP ', '# TYPE ')):
+                _, kind, name = line.split(' ', 3)[:3]
+                family = families.setdefault(name, ({}, []))
+                family[0].setdefault(kind, line)
+            elif line and not line.startswith('#') and family is not None:
+                family[1].append(line)
+    lines = []
+    for header, samples in families.values():
+        lines += [header[kind] for kind in ('HELP', 'TYPE') if kind in header] + samples
+    return '\n'.join(lines) + '\n'
+
+
+@app.get("/metrics")
+async def metrics_api():
+    """
+    The healthy instances' /metrics in one exposition, for a single scrape target. Their samples are
+    told apart by the instance_id label, so give every instance its own --instance_id.
+    """
+    healthy = [i for i in pool.instances.values() if i.healthy]
+    responses = await asyncio.gather(*(client.get(i.url + '/metrics', timeout=args.health_timeout) for i in healthy),
+                                     return_exceptions=True)
+    texts = []
+    for instance, response in zip(healthy, responses):
+        if isinstance(response, httpx.Response) and response.status_code == 200:
+            texts.append(response.text)
+        else:
+            logger.warning(f"scraping {instance.url}/metrics failed: {response}")
+    return PlainTextResponse(merge_metrics(texts), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/router/stats")
+def router_stats():
+    return pool.stats()
+
+
+@app.get("/")
+def read_root():
+    healthy = sum(i.healthy for i in pool.instances.values())
+    return {"message": "MiniCPM-V router", "status": "running" if healthy else "no healthy instance",
+            "instances": len(pool.instances), "healthy": healthy}
+
+
+def initialize_router(argv=None):
+    global pool, args
+    parser = argparse.ArgumentParser(description='Router for multiple MiniCPM-V server instances')
+    parser.add_argument('--port', type=int, default=9990,
+                        help='Port to run the router on')
+    parser.add_argument('--log_dir', type=str, default='logs_router',
+                        help='Directory for log files')
+    parser.add_argument('--instances', type=str, default='',
+                        help='Comma-separated instance base URLs, e.g. http://localhost:9999,http://localhost:10000')
+    parser.add_argument('--balance', type=str, default='requests', choices=['requests', 'tokens'],
+                        help='Pick the instance with the fewest in-flight requests, or requested tokens')
+    parser.add_argument('--default_tokens', type=int, default=2048,
+                        help='Token cost assumed for requests without max_new_tokens')
+    parser.add_argument('--max_sessions', type=int, default=10000,
+                        help='Session-to-instance pins kept, least recently used dropped first')
+    parser.add_argument('--health_interval', type=float, default=5,
+                        help='Seconds between background health checks')
+    parser.add_argument('--health_timeout', type=float, default=2,
+                        help='Timeout of a health check request')
+    parser.add_argument('--connect_timeout', type=float, default=5,
+                        help='Timeout for connecting to an instance')
+    args = parser.parse_args(argv)
+
+    setup_root_logger(local_dir=args.log_dir)
+    urls = [url.strip() for url in args.instances.split(',') if url.strip()]
+    pool = InstancePool(urls, balance=args.balance, max_sessions=args.max_sessions)
+    logger.info(f"router on port {args.port}, instances: {urls}, balance: {args.balance}")
+
+
+if __name__ == "__main__":
+    initialize_router()
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
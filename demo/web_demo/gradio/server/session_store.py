@@ -0,0 +1,225 @@
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from models import image_cache
+
+logger = logging.getLogger(__name__)
+
+# parent_turn_id of a conversation's first messages
+ROOT = 'root'
+SESSION_STORE_MAX_BYTES = 256 * 1024 ** 2
+SESSION_MAX_BYTES = 32 * 1024 ** 2
+SESSION_TTL = 3600
+
+_THINK = re.compile(r'<think>.*?</think>', re.DOTALL)
+
+
+class TurnNotFound(Exception):
+    """The session expired or was evicted, or never had this turn; the client resends the full history."""
+
+    def __init__(self, session_id, turn_id):
+        self.session_id = session_id
+        self.turn_id = turn_id
+        super().__init__(f"turn {turn_id} not found in session {session_id}")
+
+
+class SessionTooLarge(Exception):
+    """The conversation up to the new turns alone is over the per-session budget."""
+
+    def __init__(self, session_id, size, max_bytes):
+        self.session_id = session_id
+        self.size = size
+        self.max_bytes = max_bytes
+        super().__init__(f"session {session_id} would hold {size} bytes, over its budget of {max_bytes}")
+
+
+def history_text(answer):
+    """What a generated answer contributes to later turns: the clients keep it without the thinking part."""
+    formal = _THINK.sub('', answer).strip()
+    return formal if formal else answer.strip()
+
+
+def _compact(msg):
+    """
+    Copy of a message with base64 images replaced by image_ref. The pixels live in the image cache
+    (put there now, in case the message was never sent to the model), the session only keeps the hash.
+    """
+    key = 'content' if 'content' in msg else 'contents'
+    contents = []
+    for c in msg.get(key, []):
+        if isinstance(c, dict) and c.get('type') == 'image':
+            c = {'type': 'image_ref', 'hash': image_cache.decode(c['pairs']).info['sha256']}
+        contents.append(c)
+    return {'role': msg.get('role'), key: contents}
+
+
+class Turn:
+    __slots__ = ('turn_id', 'parent_id', 'message', 'size')
+
+    def __init__(self, turn_id, parent_id, message):
+        self.turn_id = turn_id
+        self.parent_id = parent_id
+        self.message = message
+        self.size = len(json.dumps(message, ensure_ascii=True))
+
+
+class Session:
+    def __init__(self):
+        self.turns = {}
+        self.bytes = 0
+        self.last_used = time.time()
+
+
+class SessionStore:
+    """
+    Conversation trees per session_id. Every message is a turn whose parent is the turn before it,
+    so a request only sends its new messages plus the id of the turn they follow, and regenerate or
+    edits branch off any earlier turn. Sessions idle for `ttl` seconds expire; beyond `max_bytes`
+    of stored messages the least recently used sessions are dropped. A session over `max_session_bytes`
+    loses its oldest branches that do not lead to the new turns, and an append whose own conversation
+    is still over it is rejected. Disabled while `max_bytes` is 0.
+    """
+
+    def __init__(self, max_bytes=SESSION_STORE_MAX_BYTES, ttl=SESSION_TTL, max_session_bytes=SESSION_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_session_bytes = max_session_bytes
+        self.bytes = 0
+        self.evicted = 0
+        self.expired = 0
+        self.pruned_turns = 0
+        self.rejected = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _drop(self, session_id):
+        session = self._sessions.pop(session_id)
+        self.bytes -= session.bytes
+
+    def _expire(self, now):
+        # least recently used first, so expired sessions are all at the front
+        while self._sessions and self.ttl:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_used <= self.ttl:
+                break
+            self._drop(session_id)
+            self.expired += 1
+
+    def _session(self, session_id, create=False):
+        now = time.time()
+        self._expire(now)
+        session = self._sessions.get(session_id)
+        if session is None and create:
+            session = self._sessions[session_id] = Session()
+        if session is not None:
+            session.last_used = now
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def _remove_turns(self, session, turn_ids):
+        for turn_id in turn_ids:
+            turn = session.turns.pop(turn_id)
+            session.bytes -= turn.size
+            self.bytes -= turn.size
+
+    def _prune(self, session, leaf_id):
+        """Drop the oldest branches off the path to `leaf_id`, whole subtrees at a time, until under budget."""
+        path = set()
+        turn_id = leaf_id
+        while turn_id != ROOT:
+            path.add(turn_id)
+            turn_id = session.turns[turn_id].parent_id
+        children = {}
+        for turn in session.turns.values():
+            children.setdefault(turn.parent_id, []).append(turn.turn_id)
+        # turns are kept in insertion order, so the first ones are the oldest
+        for turn_id in list(session.turns):
+            if session.bytes <= self.max_session_bytes:
+                break
+            if turn_id in path or turn_id not in session.turns:
+                continue
+            subtree, stack = [], [turn_id]
+            while stack:
+                subtree.append(stack.pop())
+                stack.extend(children.get(subtree[-1], []))
+            self._remove_turns(session, subtree)
+            self.pruned_turns += len(subtree)
+
+    def history(self, session_id, turn_id):
+        """Messages from the start of the conversation up to and including `turn_id`."""
+        if turn_id == ROOT:
+            return []
+        with self._lock:
+            session = self._session(session_id)
+            if session is None or turn_id not in session.turns:
+                raise TurnNotFound(session_id, turn_id)
+            msgs = []
+            while turn_id != ROOT:
+                turn = session.turns[turn_id]
+                msgs.append(turn.message)
+                turn_id = turn.parent_id
+        return json.loads(json.dumps(msgs[::-1]))
+
+    def append(self, session_id, parent_id, msgs):
+        """Add `msgs` as a chain of turns after `parent_id`; returns their turn ids."""
+        turns = []
+        for msg in msgs:
+            turn = Turn(uuid.uuid4().hex[:16], turns[-1].turn_id if turns else parent_id, _compact(msg))
+            turns.append(turn)
+        with self._lock:
+            session = self._session(session_id, create=True)
+            if parent_id != ROOT and parent_id not in session.turns:
+                raise TurnNotFound(session_id, parent_id)
+            for turn in turns:
+                session.turns[turn.turn_id] = turn
+                session.bytes += turn.size
+                self.bytes += turn.size
+            if turns and session.bytes > self.max_session_bytes:
+                self._prune(session, turns[-1].turn_id)
+                if session.bytes > self.max_session_bytes:
+                    size = session.bytes
+                    self._remove_turns(session, [turn.turn_id for turn in turns])
+                    self.rejected += 1
+                    raise SessionTooLarge(session_id, size, self.max_session_bytes)
+            while self.bytes > self.max_bytes and len(self._sessions) > 1:
+                oldest = next(iter(self._sessions))
+                if oldest == session_id:
+                    break
+                self._drop(oldest)
+                self.evicted += 1
+        return [turn.turn_id for turn in turns]
+
+    def delete(self, session_id):
+        with self._lock:
+            if session_id not in self._sessions:
+                return False
+            self._drop(session_id)
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'sessions': len(self._sessions),
+                'turns': sum(len(s.turns) for s in self._sessions.values()),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'max_session_bytes': self.max_session_bytes,
+                'pruned_turns': self.pruned_turns,
+                'rejected': self.rejected,
+                'ttl': self.ttl,
+                'evicted': self.evicted,
+                'expired': self.expired,
+            }
+
+
+session_store = SessionStore()
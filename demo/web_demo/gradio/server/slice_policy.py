@@ -0,0 +1,101 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# vision budget per degradation level; level 0 keeps what the request asked for
+LEVELS = (
+    {'max_slice_nums': None, 'max_image_side': None},
+    {'max_slice_nums': 4, 'max_image_side': 1344},
+    {'max_slice_nums': 2, 'max_image_side': 1024},
+    {'max_slice_nums': 1, 'max_image_side': 896},
+)
+
+# OCR needs the detail: never fewer slices or a smaller side than this
+OCR_FLOOR = {'max_slice_nums': 6, 'max_image_side': 1792}
+
+# level offset per QoS class; None means never degraded
+QOS_CLASSES = {
+    'premium': None,
+    'standard': 0,
+    'best_effort': 1,
+}
+
+
+def parse_tenant_qos(spec):
+    """`tenant=class,tenant=class` -> dict"""
+    mapping = {}
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        tenant, _, qos = item.partition('=')
+        if qos not in QOS_CLASSES:
+            raise ValueError(f"unknown QoS class {qos!r} for tenant {tenant!r}, expected one of {list(QOS_CLASSES)}")
+        mapping[tenant] = qos
+    return mapping
+
+
+class SlicePolicy:
+    """
+    Picks `max_slice_nums` and the max image side for each request from the scheduler's queue depth:
+    every threshold in `queue_depths` that the depth reaches is one level down in LEVELS. A tenant's
+    QoS class shifts the level, and OCR requests (`params.task == "ocr"` or prompt lookup) keep
+    OCR_FLOOR. The policy only ever lowers what the request asked for, and without thresholds
+    it never degrades.
+    """
+
+    def __init__(self, queue_depths=(), tenant_qos=None, default_qos='standard'):
+        self.queue_depths = tuple(sorted(queue_depths))
+        self.tenant_qos = tenant_qos or {}
+        self.default_qos = default_qos
+        self.decisions = [0] * len(LEVELS)
+
+    def qos_class(self, tenant):
+        return self.tenant_qos.get(tenant, self.default_qos)
+
+    def level(self, queue_depth, qos):
+        offset = QOS_CLASSES[qos]
+        if offset is None:
+            return 0
+        level = sum(queue_depth >= depth for depth in self.queue_depths)
+        if level == 0:
+            return 0
+        return min(level + offset, len(LEVELS) - 1)
+
+    def apply(self, query, queue_depth, tenant=None):
+        """
+        Rewrite `query["params"]` for the current load; returns the decision for the response usage,
+        or None when the request runs as asked.
+        """
+        params = json.loads(query.get("params") or "{}")
+        ocr = params.pop("task", None) == "ocr" or bool(params.get("prompt_lookup"))
+        qos = self.qos_class(tenant)
+        level = self.level(queue_depth, qos)
+        self.decisions[level] += 1
+        if level == 0:
+            query["params"] = json.dumps(params)
+            return None
+
+        decision = {"level": level, "queue_depth": queue_depth, "qos": qos, "ocr": ocr}
+        changed = False
+        for name, limit in LEVELS[level].items():
+            if ocr:
+                limit = max(limit, OCR_FLOOR[name])
+            requested = params.get(name)
+            if requested is not None and requested <= limit:
+                continue
+            params[name] = limit
+            decision[name] = limit
+            # None: the request left it to the model default
+            decision[f"requested_{name}"] = requested
+            changed = True
+        query["params"] = json.dumps(params)
+        if not changed:
+            # the request already asked for no more than the level allows
+            return None
+        logger.info(f"degraded request {query.get('request_id')} to level {level}: {decision}")
+        return decision
+
+    def stats(self):
+        return {
+            "queue_depths": list(self.queue_depths),
+            "decisions_by_level": list(self.decisions),
+        }
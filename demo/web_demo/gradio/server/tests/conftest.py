@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+# the server modules import each other as top-level modules (`from models import ...`)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    """The gradio server app on the stub model, ready without warmup, decoding images in-process."""
+    import gradio_server
+    gradio_server.initialize_server([
+        '--model_type', 'stub', '--skip_warmup', '--preprocess_workers', '0',
+        '--log_dir', str(tmp_path_factory.mktemp('logs')),
+    ])
+    return gradio_server
+
+
+@pytest.fixture(scope='session')
+def client(server):
+    return TestClient(server.app)
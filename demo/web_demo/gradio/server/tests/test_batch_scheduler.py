@@ -0,0 +1,187 @@
+import contextlib
+import json
+import threading
+import time
+
+import pytest
+import torch
+
+import metrics
+from batch_scheduler import BatchScheduler, QueueFullError
+from gradio_server import Model
+from models import cancellations
+from models.cancellation import BatchCancelCriteria
+
+
+def query(text, **params):
+    params.setdefault('stub_token_latency', 0.001)
+    return {
+        'image': '',
+        'question': json.dumps([{'role': 'user', 'contents': [{'type': 'text', 'pairs': text}]}]),
+        'params': json.dumps(params),
+    }
+
+
+def answer(text):
+    return f"stub answer for 0 image(s): {text}"
+
+
+@pytest.fixture
+def model():
+    return Model(None, 'stub')
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out waiting for the scheduler'
+        time.sleep(0.001)
+
+
+def submit_together(scheduler, queries):
+    # a stream runs alone; holding the worker in one makes sure all of these are queued before it takes a batch
+    gate = threading.Event()
+    stream_handler = scheduler.model.stream_handler
+
+    def blocking_stream_handler(q):
+        gate.wait(5)
+        return stream_handler(q)
+
+    scheduler.model.stream_handler = blocking_stream_handler
+    started, chunks = scheduler.submit_stream(query('blocker'))
+    started.result(timeout=5)
+    futures = [scheduler.submit(q) for q in queries]
+    gate.set()
+    assert ''.join(chunks) == answer('blocker')
+    scheduler.model.stream_handler = stream_handler
+    return [f.result(timeout=5) for f in futures]
+
+
+def test_compatible_requests_share_one_batch(model):
+    scheduler = BatchScheduler(model, max_batch_size=4, max_wait_ms=50)
+    calls = []
+    batch_handler = model.batch_handler
+    model.batch_handler = lambda queries: calls.append(len(queries)) or batch_handler(queries)
+
+    results = submit_together(scheduler, [query(f'q{i}') for i in range(3)])
+
+    assert [r['result'] for r in results] == [answer(f'q{i}') for i in range(3)]
+    assert calls == [3]
+
+
+def test_batches_group_by_key(model):
+    scheduler = BatchScheduler(model, max_batch_size=4, max_wait_ms=50)
+    calls = []
+    batch_handler = model.batch_handler
+
+    def record(queries):
+        calls.append(sorted(json.loads(q['params'])['max_new_tokens'] for q in queries))
+        return batch_handler(queries)
+    model.batch_handler = record
+
+    queries = [query('a0', max_new_tokens=8), query('b0', max_new_tokens=16),
+               query('a1', max_new_tokens=8), query('b1', max_new_tokens=16)]
+    results = submit_together(scheduler, queries)
+
+    assert [r['result'] for r in results] == [answer(t) for t in ('a0', 'b0', 'a1', 'b1')]
+    assert calls == [[8, 8], [16, 16]]
+
+
+def test_streams_and_keyless_requests_run_alone(model):
+    scheduler = BatchScheduler(model, max_batch_size=4, max_wait_ms=50)
+    assert model.batch_key({**query('q'), 'params': json.dumps({'prompt_lookup': True})}) is None
+    assert model.batch_key({**query('q'), 'image': 'x' * 64}) is None
+
+    started, chunks = scheduler.submit_stream(query('streamed'))
+    assert started.result(timeout=5)
+    assert ''.join(chunks) == answer('streamed')
+
+
+def test_failed_batch_falls_back_to_single_requests(model):
+    scheduler = BatchScheduler(model, max_batch_size=4, max_wait_ms=50)
+
+    def fail(input_datas):
+        raise RuntimeError('out of memory')
+    model.model.batch_call = fail
+    singles = []
+    handler = model.handler
+    model.handler = lambda q: singles.append(q) or handler(q)
+
+    queries = [query(f'q{i}', max_new_tokens=8) for i in range(3)]
+    results = submit_together(scheduler, queries)
+
+    assert [r['result'] for r in results] == [answer(f'q{i}') for i in range(3)]
+    assert len(singles) == 3
+
+
+def test_fallback_keeps_the_adapter(model):
+    scheduler = BatchScheduler(model, max_batch_size=4, max_wait_ms=50)
+    active = []
+
+    @contextlib.contextmanager
+    def use(name):
+        active.append(name)
+        yield
+    model.adapters.use = use
+
+    def fail(input_datas):
+        assert all('adapter' not in json.loads(d['params']) for d in input_datas)
+        raise RuntimeError('out of memory')
+    model.model.batch_call = fail
+
+    queries = [query(f'q{i}', adapter='task') for i in range(3)]
+    results = submit_together(scheduler, queries)
+
+    assert [r['result'] for r in results] == [answer(f'q{i}') for i in range(3)]
+    # the blocker stream, the failed batch, then every request on its own, all with their adapter
+    assert active == [None] + ['task'] * 4
+    assert all(json.loads(q['params'])['adapter'] == 'task' for q in queries)
+
+
+def test_cancelled_batch_members_stop(model):
+    scheduler = BatchScheduler(model, max_batch_size=4, max_wait_ms=50)
+    queries = [{**query(f'q{i}'), 'request_id': f'batch-cancel-{i}'} for i in range(3)]
+    for q in queries:
+        cancellations.register(q['request_id'])
+    batch_call = model.model.batch_call
+
+    def cancel_first(input_datas):
+        cancellations.cancel('batch-cancel-0')
+        return batch_call(input_datas)
+    model.model.batch_call = cancel_first
+    cancelled_before = metrics.requests_total['cancelled'].value()
+
+    results = submit_together(scheduler, queries)
+
+    assert results[0] == {'result': '', 'usage': {'output_tokens': 0}}
+    assert [r['result'] for r in results[1:]] == [answer('q1'), answer('q2')]
+    assert metrics.requests_total['cancelled'].value() - cancelled_before == 1
+    assert cancellations.stats()['in_flight'] == 0
+
+
+def test_batch_cancel_criteria_stops_the_member_rows():
+    tokens = [cancellations.register(f'criteria-{i}') for i in range(2)]
+    criteria = BatchCancelCriteria(tokens)
+    input_ids = torch.zeros((4, 3), dtype=torch.long)
+    assert criteria(input_ids, None).tolist() == [False] * 4
+    tokens[1].cancel()
+    # two beams per member
+    assert criteria(input_ids, None).tolist() == [False, False, True, True]
+    assert [t.generated_tokens for t in tokens] == [2, 1]
+    for i in range(2):
+        cancellations.release(f'criteria-{i}')
+
+
+def test_full_queue_is_rejected(model):
+    scheduler = BatchScheduler(model, max_queue_size=1)
+    gate = threading.Event()
+    handler = model.handler
+    model.handler = lambda q: gate.wait(5) and handler(q)
+    running = scheduler.submit(query('running'))
+    wait_until(lambda: scheduler.queue_depth() == 0)
+    queued = scheduler.submit(query('queued'))
+    with pytest.raises(QueueFullError):
+        scheduler.submit(query('rejected'))
+    gate.set()
+    assert running.result(timeout=5)['result'] == answer('running')
+    assert queued.result(timeout=5)['result'] == answer('queued')
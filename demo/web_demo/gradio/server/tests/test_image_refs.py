@@ -0,0 +1,59 @@
+import base64
+import io
+import json
+
+from PIL import Image
+
+from models import image_cache
+from models.image_cache import image_hash
+
+
+def png(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (32, 32), color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def query(*contents):
+    return {
+        'image': '',
+        'question': json.dumps([{'role': 'user', 'contents': [*contents, {'type': 'text', 'pairs': 'what is it'}]}]),
+        'params': json.dumps({'stub_token_latency': 0.001}),
+    }
+
+
+def test_image_refs_hit_after_the_full_image(client):
+    data = png('green')
+    image = {'type': 'image', 'pairs': base64.b64encode(data).decode()}
+    ref = {'type': 'image_ref', 'hash': image_hash(data)}
+
+    response = client.post('/api', json=query(image))
+    assert response.json()['data']['result'] == 'stub answer for 1 image(s): what is it'
+    assert image_cache.contains(ref['hash'])
+    hits = image_cache.stats()['hits']
+
+    response = client.post('/api', json=query(ref))
+    assert response.status_code == 200
+    assert response.json()['data']['result'] == 'stub answer for 1 image(s): what is it'
+    assert image_cache.stats()['hits'] > hits
+
+
+def test_unknown_refs_get_409_before_queueing(client):
+    missing = 'f' * 64
+    for path in ('/api', '/api/stream'):
+        response = client.post(path, json=query({'type': 'image_ref', 'hash': missing}))
+        assert response.status_code == 409
+        assert response.json()['detail']['missing_images'] == [missing]
+
+
+def test_refs_evicted_while_queued_get_409(client, server, monkeypatch):
+    # the image is gone by the time the model reads it, after the admission check passed
+    monkeypatch.setattr(server, 'check_image_refs', lambda q: None)
+    missing = 'e' * 64
+    response = client.post('/api', json=query({'type': 'image_ref', 'hash': missing}))
+    assert response.status_code == 409
+    assert response.json()['detail']['missing_images'] == [missing]
+
+    # a stream has already started: the miss comes as its error event
+    final = client.post('/api/stream', json=query({'type': 'image_ref', 'hash': missing})).text.strip().split('\n\n')[-1]
+    assert json.loads(final[len('data: '):])['missing_images'] == [missing]
@@ -0,0 +1,86 @@
+import torch
+from PIL import Image
+from transformers import Qwen3Config, Qwen3ForCausalLM
+
+from models.kv_cache import PrefixKVStore, SessionKVReuse
+
+
+class FakeMiniCPM:
+    """The parts of MiniCPM `chat` KV reuse hooks into: prompt ids embedded, then `_decode` on the LLM."""
+
+    def __init__(self):
+        torch.manual_seed(0)
+        config = Qwen3Config(vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                             num_attention_heads=4, num_key_value_heads=2, head_dim=8)
+        self.llm = Qwen3ForCausalLM(config).eval()
+        self.prefilled = []
+
+    def get_vllm_embedding(self, data):
+        return self.llm.model.embed_tokens(data['input_ids']), None
+
+    def _decode(self, inputs_embeds, attention_mask, **kwargs):
+        cache = kwargs.get('past_key_values')
+        self.prefilled.append(inputs_embeds.shape[1] - (cache.get_seq_length() if cache is not None else 0))
+        return self.llm.generate(inputs_embeds=inputs_embeds, attention_mask=attention_mask, do_sample=False,
+                                 pad_token_id=0, eos_token_id=[2], max_new_tokens=6, min_new_tokens=6, **kwargs)
+
+    def _decode_stream(self, *args, **kwargs):
+        yield from self._decode(*args, **kwargs)[0].tolist()
+
+    @torch.no_grad()
+    def chat(self, prompt, stream=False):
+        input_ids = torch.tensor([prompt])
+        embeds, _ = self.get_vllm_embedding({'input_ids': input_ids})
+        decode = self._decode_stream if stream else self._decode
+        output = decode(embeds, torch.ones_like(input_ids))
+        return list(output) if stream else output[0].tolist()
+
+
+def image(color):
+    img = Image.new('RGB', (16, 16), color)
+    img.info['sha256'] = color * 8
+    return img
+
+
+def run(reuse, model, session_id, prompt, images, stream=False):
+    msgs = [{'role': 'user', 'content': [*images, 'describe']}]
+    with reuse.use(session_id, msgs, {}):
+        return model.chat(prompt, stream=stream)
+
+
+TURN_1 = [1, 3, 3, 3, 10, 11, 12]
+TURN_2 = TURN_1 + [20, 21, 22, 23]
+
+
+def test_follow_up_turns_only_prefill_the_new_tokens():
+    model, store = FakeMiniCPM(), PrefixKVStore()
+    expected = model.chat(TURN_2)
+    reuse = SessionKVReuse(model, store)
+    red = image('red')
+
+    run(reuse, model, 's', TURN_1, [red])
+    assert run(reuse, model, 's', TURN_2, [red]) == expected
+    assert model.prefilled[-2:] == [len(TURN_1), len(TURN_2) - len(TURN_1)]
+    # streams reuse and store the cache too
+    assert run(reuse, model, 's', TURN_2 + [30], [red], stream=True) == model.chat(TURN_2 + [30])
+    assert model.prefilled[-2] == 1
+    stats = store.stats()
+    assert (stats['hits'], stats['misses'], stats['saved_prefill_tokens']) == (2, 1, len(TURN_1) + len(TURN_2))
+
+
+def test_a_changed_image_invalidates_the_prefix():
+    model, store = FakeMiniCPM(), PrefixKVStore()
+    reuse = SessionKVReuse(model, store)
+
+    run(reuse, model, 's', TURN_1, [image('red')])
+    # the image placeholders tokenize alike, but the image behind them changed
+    assert run(reuse, model, 's', TURN_2, [image('blue')]) == model.chat(TURN_2)
+    assert model.prefilled[1] == len(TURN_2)
+    # a prompt that diverges early only reuses the common prefix
+    run(reuse, model, 's', TURN_1[:2] + [40, 41], [image('blue')])
+    assert model.prefilled[-1] == 2
+    # other sessions and requests without one start from scratch
+    run(reuse, model, 'other', TURN_2, [image('blue')])
+    run(reuse, model, None, TURN_2, [image('blue')])
+    assert model.prefilled[-2:] == [len(TURN_2), len(TURN_2)]
+    assert store.stats()['hits'] == 1
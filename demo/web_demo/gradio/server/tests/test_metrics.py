@@ -0,0 +1,165 @@
+import json
+import re
+import threading
+
+import metrics
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"(?:,|$)')
+
+
+def parse_prometheus(text):
+    """
+    Parse the text exposition format, asserting it is well formed: every sample belongs to the family
+    declared right before it, families are declared once, and histogram buckets are cumulative up to
+    +Inf == _count. Returns {(name, frozenset(labels)): value}.
+    """
+    assert text.endswith('\n')
+    samples = {}
+    families = set()
+    family, kind = None, None
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            continue
+        if line.startswith('# TYPE '):
+            _, _, family, kind = line.split(' ')
+            assert kind in ('counter', 'gauge', 'histogram')
+            assert family not in families, f'{family} declared twice'
+            families.add(family)
+            continue
+        match = SAMPLE.match(line)
+        assert match, f'malformed sample: {line!r}'
+        name, label_text, value = match.groups()
+        suffixes = ('_bucket', '_sum', '_count') if kind == 'histogram' else ('',)
+        assert name in {family + suffix for suffix in suffixes}, f'{name} outside its family {family}'
+        labels = LABEL.findall(label_text or '')
+        assert ','.join(f'{k}="{v}"' for k, v in labels) == (label_text or '')
+        key = (name, frozenset(labels))
+        assert key not in samples, f'duplicate sample: {line!r}'
+        samples[key] = float(value)
+
+    for (name, labels), count in samples.items():
+        if not name.endswith('_count'):
+            continue
+        base = name[:-len('_count')]
+        buckets = sorted(((float(le), value) for (n, l), value in samples.items()
+                          if n == base + '_bucket' for k, le in l if k == 'le' and l - {(k, le)} == labels))
+        values = [value for _, value in buckets]
+        assert values == sorted(values), f'{base} buckets are not cumulative'
+        assert buckets[-1] == (float('inf'), count)
+    return samples
+
+
+def sample(samples, name, **labels):
+    """Value of the sample whose labels include `labels`."""
+    matches = [value for (n, l), value in samples.items() if n == name and set(labels.items()) <= l]
+    assert len(matches) == 1, (name, labels, matches)
+    return matches[0]
+
+
+def scrape(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    return parse_prometheus(response.text)
+
+
+def query(text):
+    return {
+        'image': '',
+        'question': json.dumps([{'role': 'user', 'contents': [{'type': 'text', 'pairs': text}]}]),
+        'params': json.dumps({'stub_token_latency': 0.001}),
+    }
+
+
+def test_requests_are_counted(client):
+    before = scrape(client)
+    # "stub answer for 0 image(s): hi" is six stub tokens
+    response = client.post('/api', json=query('hi'))
+    assert response.status_code == 200
+    response = client.post('/api/stream', json=query('hi'))
+    assert response.status_code == 200 and '"finished": true' in response.text
+    after = scrape(client)
+
+    def delta(name, **labels):
+        return sample(after, name, **labels) - sample(before, name, **labels)
+
+    assert delta('minicpm_requests_total', outcome='ok') == 2
+    assert delta('minicpm_requests_total', outcome='error') == 0
+    assert delta('minicpm_output_tokens_count') == 2
+    assert delta('minicpm_output_tokens_sum') == 12
+    # 6 tokens fall in the le="8" bucket, not in le="1"
+    assert delta('minicpm_output_tokens_bucket', le='1') == 0
+    assert delta('minicpm_output_tokens_bucket', le='8') == 2
+    assert delta('minicpm_images_per_request_bucket', le='0') == 2
+    assert delta('minicpm_queue_wait_seconds_count') == 2
+    assert delta('minicpm_time_to_first_token_seconds_count') == 2
+    assert sample(after, 'minicpm_requests_total', outcome='ok', model_type='stub', instance_id='0') >= 2
+
+
+def test_rejected_requests_are_counted(client, server):
+    before = scrape(client)
+    max_queue_size = server.scheduler.max_queue_size
+    server.scheduler.max_queue_size = 0
+    try:
+        response = client.post('/api', json=query('rejected'))
+    finally:
+        server.scheduler.max_queue_size = max_queue_size
+    assert response.status_code == 503
+    assert int(response.headers['retry-after']) >= 1
+    after = scrape(client)
+
+    reason = dict(reason='queue_full')
+    assert sample(after, 'minicpm_rejected_requests_total', **reason) - \
+        sample(before, 'minicpm_rejected_requests_total', **reason) == 1
+    assert sample(after, 'minicpm_requests_total', outcome='ok') == sample(before, 'minicpm_requests_total', outcome='ok')
+    # the queue depth was observed on arrival, before the rejection
+    assert sample(after, 'minicpm_queue_depth_on_arrival_count') - \
+        sample(before, 'minicpm_queue_depth_on_arrival_count') == 1
+
+
+def test_sharded_metrics_sum_across_threads():
+    counter = metrics.Counter()
+    histogram = metrics.Histogram((1, 10))
+    start = threading.Barrier(8)
+
+    def work(i):
+        start.wait()
+        for _ in range(1000):
+            counter.inc()
+            histogram.observe(i)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counter.value() == 8000
+    cumulative, total, count = histogram.snapshot()
+    # values 0 and 1 fall in le=1, 2..7 in le=10
+    assert cumulative == [2000, 8000, 8000]
+    assert total == 1000 * sum(range(8))
+    assert count == 8000
+
+
+def test_shards_of_finished_threads_are_folded():
+    counter = metrics.Counter()
+    histogram = metrics.Histogram((1, 10))
+    for i in range(20):
+        thread = threading.Thread(target=lambda: (counter.inc(), histogram.observe(5)))
+        thread.start()
+        thread.join()
+    counter.inc()
+
+    assert len(counter._shards) == 1 and not histogram._shards
+    assert counter.value() == 21
+    assert histogram.snapshot() == ([0, 20, 20], 100, 20)
+
+
+def test_label_values_are_escaped():
+    registry = metrics.MetricsRegistry()
+    registry.labels = {'model_type': 'a"b\\c\nd'}
+    registry.counter('test_total', 'Test counter', outcome='ok').inc(3)
+    samples = parse_prometheus(registry.render())
+    assert sample(samples, 'test_total', outcome='ok') == 3
@@ -0,0 +1,50 @@
+import random
+
+import pytest
+
+from models.postprocess import TagFilter, clean_answer
+
+ANSWERS = [
+    'The <ref>plane</ref><box>120 40 560 300</box> is on the runway.',
+    'Two boxes <box>1 2 3 4</box> and <box>5 6 7 8</box> on one line.',
+    '<think>look for the cat</think>The cat <box>10 20 30 40</box>.',
+    'Unclosed <box>1 2 3\nnext line < 5 and a <boxy> word, </bo',
+]
+
+
+def stream(answer, cuts, enable_thinking=True):
+    tag_filter = TagFilter(enable_thinking)
+    bounds = [0] + sorted(cuts) + [len(answer)]
+    out = [tag_filter.feed(answer[a:b]) for a, b in zip(bounds, bounds[1:])]
+    return ''.join(out) + tag_filter.flush()
+
+
+@pytest.mark.parametrize('answer', ANSWERS)
+@pytest.mark.parametrize('enable_thinking', [True, False])
+def test_every_split_matches_the_non_stream_answer(answer, enable_thinking):
+    expected = clean_answer(answer, enable_thinking)
+    for cut in range(1, len(answer)):
+        assert stream(answer, [cut], enable_thinking) == expected, cut
+
+
+@pytest.mark.parametrize('answer', ANSWERS)
+def test_random_chunks_match_the_non_stream_answer(answer):
+    rng = random.Random(0)
+    expected = clean_answer(answer)
+    for _ in range(200):
+        cuts = rng.sample(range(1, len(answer)), rng.randint(1, min(8, len(answer) - 1)))
+        assert stream(answer, cuts) == expected
+    # one character at a time
+    assert stream(answer, list(range(1, len(answer)))) == expected
+
+
+def test_tags_are_removed():
+    assert clean_answer(ANSWERS[0]) == 'The plane is on the runway.'
+    # each box goes on its own; the old greedy regex also dropped " and " between them
+    assert clean_answer(ANSWERS[1]) == 'Two boxes  and  on one line.'
+    assert clean_answer(ANSWERS[2]) == '<think>look for the cat</think>The cat .'
+    assert clean_answer(ANSWERS[2], enable_thinking=False) == '<think>look for the catThe cat .'
+
+
+def test_unclosed_boxes_and_other_angle_brackets_pass_through():
+    assert clean_answer(ANSWERS[3]) == 'Unclosed 1 2 3\nnext line < 5 and a <boxy> word, </bo'
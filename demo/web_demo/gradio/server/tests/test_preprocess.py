@@ -0,0 +1,59 @@
+import asyncio
+import base64
+import io
+import json
+
+import pytest
+from PIL import Image
+
+from gradio_server import Model
+from models import image_cache, timings, RequestTiming
+from models.image_cache import load_image_content
+from preprocess import Preprocessor
+
+
+def png(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), color).save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+@pytest.fixture
+def preprocessor():
+    preprocessor = Preprocessor(processes=1)
+    preprocessor.start()
+    yield preprocessor
+    preprocessor.close()
+
+
+def test_images_are_decoded_in_the_workers(preprocessor):
+    question = [{'role': 'user', 'contents': [{'type': 'image', 'pairs': png('red')},
+                                              {'type': 'text', 'pairs': 'what is this?'}]}]
+    query = {'image': png('blue'), 'question': json.dumps(question), 'params': '{}'}
+    asyncio.run(preprocessor.run(query))
+
+    content = json.loads(query['question'])[0]['contents'][0]
+    assert image_cache.contains(content['hash'])
+    assert image_cache.contains(query['image_hash'])
+    assert query['image_decode_seconds'] > 0
+    assert preprocessor.stats()['images'] == 2
+
+    # the model thread finds the top-level image by its hash instead of decoding the base64 again
+    timing = RequestTiming()
+    with timings.active(timing):
+        image = load_image_content({'type': 'image', 'pairs': 'not base64', 'hash': query['image_hash']})
+    assert image.getpixel((0, 0)) == (0, 0, 255)
+    assert (timing.images, timing.image_decode_seconds) == (1, 0)
+
+    # the workers' decode time is counted with the request
+    timing = RequestTiming()
+    with timings.active(timing):
+        Model(None, 'stub').handler({**query, 'image': ''})
+    assert timing.image_decode_seconds == query['image_decode_seconds']
+
+
+def test_questions_without_images_are_left_alone(preprocessor):
+    question = json.dumps([{'role': 'user', 'contents': [{'type': 'text', 'pairs': 'hi'}]}])
+    query = {'image': '', 'question': question, 'params': '{}'}
+    asyncio.run(preprocessor.run(query))
+    assert query == {'image': '', 'question': question, 'params': '{}'}
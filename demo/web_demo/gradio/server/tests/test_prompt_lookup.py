@@ -0,0 +1,59 @@
+import torch
+from transformers import Qwen3Config, Qwen3ForCausalLM
+
+from models.prompt_lookup import PromptLookupDecoding
+
+IMAGE_TOKEN = 3
+IMAGE_TOKENS = 8
+
+
+class TinyMiniCPM(torch.nn.Module):
+    """The parts of MiniCPM `chat` prompt lookup hooks into: image features scattered into the embeddings."""
+
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        config = Qwen3Config(vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                             num_attention_heads=4, num_key_value_heads=2, head_dim=8)
+        self.llm = Qwen3ForCausalLM(config).eval()
+        self.image_features = torch.randn(IMAGE_TOKENS, config.hidden_size) * 4
+
+    def get_vllm_embedding(self, data):
+        input_ids = data['input_ids']
+        embeds = self.llm.model.embed_tokens(input_ids).clone()
+        embeds[input_ids == IMAGE_TOKEN] = self.image_features
+        return embeds, None
+
+    @torch.no_grad()
+    def chat(self, input_ids, max_new_tokens=24):
+        embeds, _ = self.get_vllm_embedding({'input_ids': input_ids})
+        return self.llm.generate(inputs_embeds=embeds, attention_mask=torch.ones_like(input_ids),
+                                 max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=0, eos_token_id=[2])
+
+
+def image_prompt():
+    # repeated text, so the trailing n-gram recurs in the prompt and lookup drafts from the first step
+    text = [10, 11, 12, 13, 14, 15] * 4
+    return torch.tensor([[1] + [IMAGE_TOKEN] * IMAGE_TOKENS + text + [10, 11]])
+
+
+def test_prompt_lookup_matches_greedy_on_image_prompt():
+    model = TinyMiniCPM()
+    input_ids = image_prompt()
+    greedy = model.chat(input_ids)
+
+    lookup = PromptLookupDecoding(model)
+    with lookup.enabled(num_tokens=4) as stats:
+        output = model.chat(input_ids)
+
+    assert stats.draft_tokens > 0
+    assert output.tolist() == greedy.tolist()
+
+
+def test_image_features_change_the_answer():
+    # guards the test above: with the image features lost, greedy output would differ
+    model = TinyMiniCPM()
+    input_ids = image_prompt()
+    greedy = model.chat(input_ids)
+    model.image_features.zero_()
+    assert model.chat(input_ids).tolist() != greedy.tolist()
@@ -0,0 +1,72 @@
+import base64
+import json
+import threading
+
+from models import result_cache
+from models.image_cache import image_hash
+from models.result_cache import ResultCache, request_key
+
+
+def query(image_content, **params):
+    return {
+        'image': '',
+        'question': json.dumps([{'role': 'user', 'contents': [image_content, {'type': 'text', 'pairs': 'ocr'}]}]),
+        'params': json.dumps(params),
+    }
+
+
+def test_image_and_image_ref_share_a_key():
+    data = b'not really a png'
+    image = {'type': 'image', 'pairs': base64.b64encode(data).decode()}
+    ref = {'type': 'image_ref', 'hash': image_hash(data)}
+    key = request_key('stub:', query(image, sampling=False))
+    assert key is not None
+    assert request_key('stub:', query(ref, sampling=False, stream=True)) == key
+    assert request_key('stub:', query(image)) is None
+
+
+def test_model_delivery_params_are_left_out_of_the_key():
+    image = {'type': 'image_ref', 'hash': 'a' * 64}
+    key = request_key('stub:', query(image, sampling=False), ('stub_token_latency',))
+    assert request_key('stub:', query(image, sampling=False, stub_token_latency=0.1), ('stub_token_latency',)) == key
+    # only the model that declares a param as delivery-only drops it
+    assert request_key('other:', query(image, sampling=False, stub_token_latency=0.1)) != \
+        request_key('other:', query(image, sampling=False))
+
+
+def test_stream_and_api_hits_report_the_cached_usage(client):
+    max_bytes = result_cache.max_bytes
+    result_cache.max_bytes = 1024 ** 2
+    try:
+        q = {
+            'image': '',
+            'question': json.dumps([{'role': 'user', 'contents': [{'type': 'text', 'pairs': 'cache me'}]}]),
+            'params': json.dumps({'sampling': False, 'stub_token_latency': 0.001}),
+        }
+        first = client.post('/api', json=q).json()['data']
+        assert 'cached' not in first['usage']
+        hit = client.post('/api', json=q).json()['data']
+        stream = client.post('/api/stream', json=q).text
+    finally:
+        result_cache.max_bytes = max_bytes
+    final = json.loads(stream.strip().split('\n\n')[-1][len('data: '):])
+    assert hit['usage'] == {**first['usage'], 'cached': True}
+    assert final['usage']['cached'] is True
+    assert final['usage']['output_tokens'] == first['usage']['output_tokens']
+
+
+def test_disk_writes_do_not_block_put(tmp_path):
+    cache = ResultCache(max_bytes=1024 ** 2, directory=str(tmp_path))
+    gate = threading.Event()
+    cache._writer.submit(gate.wait, 5)
+    # the writer is busy: put still returns, and the memory tier answers right away
+    cache.put('k', 'answer', {'output_tokens': 1})
+    assert cache.get('k') == ('answer', {'output_tokens': 1})
+    assert not (tmp_path / 'k.json').exists()
+    gate.set()
+    cache.flush()
+
+    restarted = ResultCache(max_bytes=1024 ** 2, directory=str(tmp_path))
+    assert restarted.get('k') == ('answer', {'output_tokens': 1})
+    assert restarted.stats()['disk_hits'] == 1
+    assert [p.name for p in tmp_path.iterdir()] == ['k.json']
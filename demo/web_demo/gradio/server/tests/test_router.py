@@ -0,0 +1,209 @@
+import asyncio
+import json
+
+import fastapi
+import httpx
+import pytest
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+import router
+
+
+class StubInstance:
+    """A gradio_server stand-in: answers with its name, or rejects with `status` and `retry_after`."""
+
+    def __init__(self, name):
+        self.name = name
+        self.status = 200
+        self.retry_after = 1
+        self.requests = []
+        self.bodies = []
+        self.app = fastapi.FastAPI()
+        self.app.get('/')(self.root)
+        self.app.post('/api')(self.api)
+        self.app.post('/api/stream')(self.stream)
+        self.app.post('/api/video')(self.video)
+        self.app.get('/metrics')(self.metrics)
+
+    def root(self):
+        return {'model_type': 'stub'}
+
+    def _rejection(self):
+        if self.status == 200:
+            return None
+        return JSONResponse({'detail': {'error': 'busy'}}, status_code=self.status,
+                            headers={'Retry-After': str(self.retry_after)})
+
+    async def api(self, request: fastapi.Request):
+        self.bodies.append(await request.body())
+        body = await request.json()
+        self.requests.append(body)
+        return self._rejection() or {'data': {'result': self.name, 'request_id': body['request_id']}}
+
+    async def stream(self, request: fastapi.Request):
+        body = await request.json()
+        self.requests.append(body)
+
+        def events():
+            yield f"data: {json.dumps({'seq': 0, 'delta': self.name})}\n\n"
+            yield f"data: {json.dumps({'seq': 1, 'finished': True})}\n\n"
+        return self._rejection() or StreamingResponse(events(), media_type='text/plain')
+
+    async def video(self, request: fastapi.Request):
+        size = sum([len(chunk) async for chunk in request.stream()])
+        self.requests.append({'video_bytes': size, **request.query_params})
+        return {'video_id': f'{self.name}-video', 'num_frames': 2, 'temporal_ids': None}
+
+    def metrics(self):
+        return PlainTextResponse(
+            '# HELP minicpm_requests_total Finished requests by outcome\n'
+            '# TYPE minicpm_requests_total counter\n'
+            f'minicpm_requests_total{{instance_id="{self.name}",outcome="ok"}} {len(self.requests)}\n')
+
+
+class Unreachable(httpx.AsyncBaseTransport):
+    async def handle_async_request(self, request):
+        raise httpx.ConnectError('connection refused', request=request)
+
+
+@pytest.fixture
+def instances(tmp_path):
+    stubs = {name: StubInstance(name) for name in ('a', 'b')}
+    router.initialize_router(['--instances', 'http://a,http://b,http://down', '--log_dir', str(tmp_path)])
+    router.pool.remove('http://down')
+    mounts = {f'http://{name}': httpx.ASGITransport(stub.app) for name, stub in stubs.items()}
+    mounts['http://down'] = Unreachable()
+    router.client = httpx.AsyncClient(mounts=mounts)
+    return stubs
+
+
+def request(method, path, **kwargs):
+    async def send():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(router.app), base_url='http://router') as c:
+            return await c.request(method, path, **kwargs)
+    return asyncio.run(send())
+
+
+def call(path='/api', session_id=None, question='[]', **params):
+    """POST to the router; returns (status, name of the answering instance or None, headers)."""
+    body = {'image': '', 'question': question, 'params': json.dumps(params)}
+    if session_id:
+        body['session_id'] = session_id
+    response = request('POST', path, json=body)
+    if response.status_code != 200:
+        return response.status_code, None, response.headers
+    if path == '/api/stream':
+        return 200, json.loads(response.text.split('\n\n')[0][len('data: '):])['delta'], response.headers
+    return 200, response.json()['data']['result'], response.headers
+
+
+def test_requests_go_to_the_least_loaded_instance(instances):
+    pool = router.pool
+    assert call()[1] == 'a'
+    pool.acquire(pool.instances['http://a'], 'busy', 0)
+    assert call()[1] == 'b'
+    assert call('/api/stream')[1] == 'b'
+    assert pool.stats()['in_flight'] == 1
+
+
+def test_sessions_stay_on_their_instance(instances):
+    pool = router.pool
+    assert call(session_id='s1')[1] == 'a'
+    pool.acquire(pool.instances['http://a'], 'busy', 0)
+    assert call(session_id='s1')[1] == 'a'
+    assert call(session_id='s2')[1] == 'b'
+    assert pool.pinned_hits == 1
+
+
+def test_unreachable_instance_fails_over(instances):
+    pool = router.pool
+    down = pool.add('http://down')
+    # least loaded first: make the unreachable instance the preferred one
+    for stub in instances.values():
+        pool.acquire(pool.instances[f'http://{stub.name}'], stub.name, 0)
+    assert call(session_id='s1')[1] == 'a'
+    assert call()[1] == 'a'
+    assert not down.healthy
+    # the session moved with the failover
+    assert pool.sessions['s1'] == 'http://a'
+
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_rejections_are_retried_on_another_instance(instances, status):
+    instances['a'].status = status
+    instances['a'].retry_after = 30
+    assert call()[1] == 'b'
+    assert call('/api/stream')[1] == 'b'
+    a = router.pool.instances['http://a']
+    assert a.rejections >= 1
+    if status == 503:
+        # backed off for its Retry-After: the stream went straight to b
+        assert a.rejections == 1 and router.pool.stats()['instances'][0]['busy_for'] > 0
+    else:
+        # a 429 is about one request's deadline, the instance still gets new requests
+        assert a.rejections == 2
+
+
+def test_pinned_sessions_get_the_rejection(instances):
+    assert call(session_id='s1')[1] == 'a'
+    instances['a'].status = 429
+    instances['a'].retry_after = 7
+    status, _, headers = call(session_id='s1')
+    assert (status, headers['retry-after']) == (429, '7')
+    assert not instances['b'].requests
+
+
+def test_all_rejected_returns_the_shortest_retry_after(instances):
+    instances['a'].status, instances['a'].retry_after = 503, 20
+    instances['b'].status, instances['b'].retry_after = 503, 3
+    status, _, headers = call()
+    assert (status, headers['retry-after']) == (503, '3')
+    # both are backed off now: the router answers itself, without forwarding
+    requests = sum(len(stub.requests) for stub in instances.values())
+    status, _, headers = call()
+    assert status == 503 and 1 <= int(headers['retry-after']) <= 3
+    assert sum(len(stub.requests) for stub in instances.values()) == requests
+
+
+def test_video_uploads_are_pinned_with_their_session(instances):
+    pool = router.pool
+    pool.acquire(pool.instances['http://a'], 'busy', 0)
+    response = request('POST', '/api/video', params={'session_id': 's1', 'fps': '2'}, content=b'x' * 100000)
+    assert response.json()['video_id'] == 'b-video'
+    assert instances['b'].requests == [{'video_bytes': 100000, 'session_id': 's1', 'fps': '2'}]
+    # the turn about the video goes where its frames are
+    assert call(session_id='s1')[1] == 'b'
+
+
+def test_video_refs_go_to_the_uploading_instance(instances):
+    pool = router.pool
+    pool.acquire(pool.instances['http://a'], 'busy', 0)
+    assert request('POST', '/api/video', content=b'video').json()['video_id'] == 'b-video'
+    pool.release(pool.instances['http://a'], 'busy', 0)
+    pool.acquire(pool.instances['http://b'], 'busy', 0)
+    question = json.dumps([{'role': 'user', 'contents': [{'type': 'video_ref', 'video_id': 'b-video'}]}])
+    assert call(question=question)[1] == 'b'
+    assert call()[1] == 'a'
+
+
+def test_metrics_are_merged(instances):
+    call()
+    call('/api/stream')
+    text = request('GET', '/metrics').text
+    assert text.count('# TYPE minicpm_requests_total counter') == 1
+    assert 'minicpm_requests_total{instance_id="a",outcome="ok"} 2' in text
+    assert 'minicpm_requests_total{instance_id="b",outcome="ok"} 0' in text
+
+
+@pytest.mark.parametrize('body', [b'[1, 2]', b'"text"', b'{"params": "[1]"}', b'{"params": {"max_new_tokens": 8}}'])
+def test_malformed_bodies_are_rejected(instances, body):
+    response = request('POST', '/api', content=body, headers={'content-type': 'application/json'})
+    assert response.status_code == 400
+    assert not any(stub.requests for stub in instances.values())
+
+
+def test_bodies_with_a_request_id_are_forwarded_unchanged(instances):
+    body = b'{"image": "",  "question": "[]", "params": "{}", "request_id": "mine"}'
+    assert request('POST', '/api', content=body).json()['data']['request_id'] == 'mine'
+    # the router does not re-serialize a body that already has an id
+    assert instances['a'].bodies == [body]
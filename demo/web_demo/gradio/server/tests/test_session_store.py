@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from session_store import SessionStore, SessionTooLarge, ROOT, session_store
+
+
+def text(role, words):
+    return {'role': role, 'contents': [{'type': 'text', 'pairs': ' '.join(['word'] * words)}]}
+
+
+def test_old_branches_are_pruned_past_the_session_budget():
+    store = SessionStore(max_bytes=10 ** 6, max_session_bytes=2000)
+    question, = store.append('s', ROOT, [text('user', 10)])
+    first, = store.append('s', question, [text('assistant', 100)])
+    # regenerate: a second branch off the question
+    second, = store.append('s', question, [text('assistant', 100)])
+    followup, = store.append('s', second, [text('user', 150)])
+
+    # the first answer was the oldest turn off the new turn's path
+    assert len(store.history('s', followup)) == 3
+    assert first not in store._sessions['s'].turns
+    assert store.stats()['pruned_turns'] == 1
+    assert store._sessions['s'].bytes == store.bytes <= 2000
+
+
+def test_pruning_drops_whole_branches():
+    store = SessionStore(max_bytes=10 ** 6, max_session_bytes=3000)
+    question, = store.append('s', ROOT, [text('user', 10)])
+    old = store.append('s', question, [text('assistant', 100), text('user', 100), text('assistant', 100)])
+    store.append('s', question, [text('assistant', 300)])
+    # no turn is left without its parent
+    turns = store._sessions['s'].turns
+    assert not set(old) & set(turns)
+    assert all(turn.parent_id == ROOT or turn.parent_id in turns for turn in turns.values())
+
+
+def test_a_conversation_over_the_budget_is_rejected():
+    store = SessionStore(max_bytes=10 ** 6, max_session_bytes=1000)
+    question, = store.append('s', ROOT, [text('user', 10)])
+    before = store.stats()
+    with pytest.raises(SessionTooLarge):
+        store.append('s', question, [text('assistant', 500)])
+    assert store.stats()['bytes'] == before['bytes']
+    assert store.stats()['rejected'] == 1
+    assert store.history('s', question) == [text('user', 10)]
+
+
+def test_append_endpoint_returns_413(client):
+    max_session_bytes = session_store.max_session_bytes
+    session_store.max_session_bytes = 1000
+    try:
+        response = client.post('/api/session/turns', json={
+            'session_id': 'too-large', 'parent_turn_id': ROOT, 'messages': json.dumps([text('user', 500)]),
+        })
+    finally:
+        session_store.max_session_bytes = max_session_bytes
+    assert response.status_code == 413
+    assert response.json()['detail']['max_session_bytes'] == 1000
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from slice_policy import SlicePolicy, parse_tenant_qos
+
+
+def apply(policy, queue_depth, tenant=None, **params):
+    query = {'params': json.dumps(params)}
+    decision = policy.apply(query, queue_depth, tenant)
+    return decision, json.loads(query['params'])
+
+
+def test_levels_follow_the_queue_depth():
+    policy = SlicePolicy((4, 16, 32))
+    assert apply(policy, 3) == (None, {})
+    expected = {1: (4, 1344), 2: (2, 1024), 3: (1, 896)}
+    for depth, level in ((4, 1), (16, 2), (32, 3), (500, 3)):
+        decision, params = apply(policy, depth)
+        assert decision['level'] == level
+        assert (params['max_slice_nums'], params['max_image_side']) == expected[level]
+        assert decision['requested_max_slice_nums'] is None
+    assert policy.stats()['decisions_by_level'] == [1, 1, 1, 2]
+    # without thresholds nothing is degraded
+    assert apply(SlicePolicy(), 10 ** 6) == (None, {})
+
+
+def test_qos_classes_shift_the_level():
+    policy = SlicePolicy((4, 16), tenant_qos={'vip': 'premium', 'batch': 'best_effort'})
+    assert apply(policy, 100, 'vip') == (None, {})
+    assert apply(policy, 4, 'batch')[0]['level'] == 2
+    assert apply(policy, 16, 'batch')[0]['level'] == 3
+    # no extra level below the first threshold
+    assert apply(policy, 3, 'batch')[0] is None
+    assert apply(policy, 4, 'someone')[0]['qos'] == 'standard'
+
+
+def test_ocr_keeps_its_floor():
+    policy = SlicePolicy((1,), default_qos='best_effort')
+    decision, params = apply(policy, 100, task='ocr')
+    assert decision['ocr'] and decision['level'] == 2
+    assert (params['max_slice_nums'], params['max_image_side']) == (6, 1792)
+    # the task hint is the server's, the model never sees it
+    assert 'task' not in params
+    assert apply(policy, 100, prompt_lookup=True)[1]['max_slice_nums'] == 6
+    # the floor is not a minimum: a request asking for less keeps it
+    decision, params = apply(policy, 100, task='ocr', max_slice_nums=2, max_image_side=800)
+    assert decision is None and (params['max_slice_nums'], params['max_image_side']) == (2, 800)
+
+
+def test_only_lowers_what_the_request_asked_for():
+    policy = SlicePolicy((1,))
+    decision, params = apply(policy, 5, max_slice_nums=1)
+    assert params['max_slice_nums'] == 1 and 'max_slice_nums' not in decision
+    assert decision['max_image_side'] == 1344
+
+
+def test_tenant_qos_parsing():
+    assert parse_tenant_qos(' a=premium, b=best_effort,') == {'a': 'premium', 'b': 'best_effort'}
+    with pytest.raises(ValueError):
+        parse_tenant_qos('a=gold')
+
+
+def test_degraded_requests_report_the_decision(client, server, monkeypatch):
+    monkeypatch.setattr(server, 'slice_policy', SlicePolicy((0,)))
+    response = client.post('/api', json={
+        'image': '',
+        'question': json.dumps([{'role': 'user', 'contents': [{'type': 'text', 'pairs': 'busy'}]}]),
+        'params': json.dumps({'stub_token_latency': 0.001, 'task': 'ocr'}),
+    })
+    degradation = response.json()['data']['usage']['degradation']
+    assert degradation['level'] == 1 and degradation['ocr']
+    assert degradation['max_slice_nums'] == 6
@@ -0,0 +1,61 @@
+import json
+
+
+def query(text, **params):
+    params.setdefault('stub_token_latency', 0.001)
+    return {
+        'image': '',
+        'question': json.dumps([{'role': 'user', 'contents': [{'type': 'text', 'pairs': text}]}]),
+        'params': json.dumps(params),
+    }
+
+
+def read_stream(text):
+    """(data events, number of keepalive comments) of a /api/stream body."""
+    events, keepalives = [], 0
+    for block in text.split('\n\n'):
+        if not block:
+            continue
+        if block.startswith(':'):
+            keepalives += 1
+            continue
+        assert block.startswith('data: ')
+        events.append(json.loads(block[len('data: '):]))
+    return events, keepalives
+
+
+def reassemble(events):
+    """What a v2 client shows: the deltas in seq order, checked for gaps; returns (answer, final event)."""
+    *deltas, final = events
+    assert [e['seq'] for e in deltas] == list(range(len(deltas)))
+    assert final['finished'] and final['seq'] == len(deltas)
+    return ''.join(e['delta'] for e in deltas), final
+
+
+def test_deltas_reassemble_the_answer(client):
+    answer = client.post('/api', json=query('how are the deltas joined')).json()['data']['result']
+    response = client.post('/api/stream', json=query('how are the deltas joined'))
+    assert response.headers['x-request-id']
+    events, _ = read_stream(response.text)
+    text, final = reassemble(events)
+    assert text == answer
+    assert len(events) > 2
+    assert final['usage']['chunks'] == len(events) - 1
+    assert final['usage']['output_chars'] == len(answer)
+
+
+def test_keepalives_while_the_model_is_silent(client, server, monkeypatch):
+    monkeypatch.setattr(server.args, 'keepalive_interval', 0.02)
+    response = client.post('/api/stream', json=query('slow answer', stub_token_latency=0.1))
+    events, keepalives = read_stream(response.text)
+    assert keepalives > 0
+    assert reassemble(events)[0] == 'stub answer for 0 image(s): slow answer'
+
+
+def test_v1_sends_the_full_response(client, server, monkeypatch):
+    monkeypatch.setattr(server.args, 'stream_format', 'v1')
+    events, keepalives = read_stream(client.post('/api/stream', json=query('legacy')).text)
+    assert keepalives == 0
+    responses = [e['full_response'] for e in events]
+    assert all(b.startswith(a) for a, b in zip(responses, responses[1:]))
+    assert events[-1]['finished'] and responses[-1] == 'stub answer for 0 image(s): legacy'
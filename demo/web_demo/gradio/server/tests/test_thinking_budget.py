@@ -0,0 +1,81 @@
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, Qwen3Config, Qwen3ForCausalLM
+
+from models.thinking_budget import ThinkingBudget
+
+THINK_OPEN, THINK_CLOSE, EOS, WORD = 5, 6, 2, 10
+
+
+class Tokenizer:
+    def get_vocab(self):
+        return {'<think>': THINK_OPEN, '</think>': THINK_CLOSE}
+
+
+class Script(LogitsProcessor):
+    """Makes the LM write `<think>`, `thinking` words and `</think>`, then words, ending with EOS at `length` tokens."""
+
+    def __init__(self, prompt_len, thinking, length):
+        self.prompt_len = prompt_len
+        self.thinking = thinking
+        self.length = length
+
+    def __call__(self, input_ids, scores):
+        step = input_ids.shape[1] - self.prompt_len
+        script = [THINK_OPEN] + [WORD] * self.thinking + [THINK_CLOSE]
+        if step >= self.length - 1:
+            token = EOS
+        else:
+            token = script[step] if step < len(script) else WORD
+        scores[:, :] = -float('inf')
+        scores[:, token] = 0.0
+        return scores
+
+
+class FakeMiniCPM:
+    """MiniCPM's `_decode`: generate() on the LLM with the caller's logits processors."""
+
+    def __init__(self):
+        config = Qwen3Config(vocab_size=32, hidden_size=16, intermediate_size=32, num_hidden_layers=1,
+                             num_attention_heads=2, num_key_value_heads=1, head_dim=8)
+        self.llm = Qwen3ForCausalLM(config).eval()
+
+    def _decode(self, input_ids, thinking, length, logits_processor=None):
+        processors = LogitsProcessorList([Script(input_ids.shape[1], thinking, length)] + list(logits_processor or []))
+        with torch.no_grad():
+            return self.llm.generate(input_ids, logits_processor=processors, do_sample=False, max_new_tokens=length,
+                                     pad_token_id=0, eos_token_id=[EOS])[0, input_ids.shape[1]:].tolist()
+
+    def _decode_stream(self, *args, **kwargs):
+        yield from self._decode(*args, **kwargs)
+
+
+def generate(budget_tokens, thinking, length=12, stream=False):
+    model = FakeMiniCPM()
+    budget = ThinkingBudget(model, Tokenizer())
+    assert budget.supported
+    with budget.enabled(budget_tokens) as processor:
+        decode = model._decode_stream if stream else model._decode
+        tokens = list(decode(torch.tensor([[1, 7, 8]]), thinking, length))
+    return tokens, processor
+
+
+def test_budget_forces_the_end_of_thinking():
+    tokens, processor = generate(budget_tokens=4, thinking=20)
+    # `<think>` and four words, then `</think>` is forced and the answer follows
+    assert tokens[:6] == [THINK_OPEN] + [WORD] * 4 + [THINK_CLOSE]
+    assert tokens[6:] == [WORD] * 5 + [EOS]
+    usage = processor.usage(output_tokens=len(tokens))
+    assert usage == {'thinking_tokens': 6, 'answer_tokens': 6, 'thinking_budget_tokens': 4,
+                     'thinking_budget_exhausted': True}
+
+
+def test_short_thinking_is_left_alone():
+    tokens, processor = generate(budget_tokens=4, thinking=2, stream=True)
+    assert tokens[:4] == [THINK_OPEN, WORD, WORD, THINK_CLOSE]
+    assert processor.usage(output_tokens=len(tokens))['thinking_budget_exhausted'] is False
+
+
+def test_requests_without_a_budget_are_not_touched():
+    tokens, processor = generate(budget_tokens=None, thinking=20, length=30)
+    assert processor is None
+    assert THINK_CLOSE in tokens and tokens.index(THINK_CLOSE) == 21
@@ -0,0 +1,49 @@
+import sys
+import types
+
+import numpy as np
+import pytest
+
+from models.video_store import decode_video
+
+
+class FakeVideoReader:
+    """decord.VideoReader over a synthetic clip whose pixels encode the frame index."""
+
+    batches = []
+
+    def __init__(self, path, ctx=None, width=-1, height=-1):
+        self.size = (height if height > 0 else 64, width if width > 0 else 96)
+
+    def __len__(self):
+        return 600  # 20 s at 30 fps
+
+    def get_avg_fps(self):
+        return 30.0
+
+    def __getitem__(self, i):
+        return np.full(self.size + (3,), i % 256, dtype=np.uint8)
+
+    def get_batch(self, indices):
+        FakeVideoReader.batches.append(len(indices))
+        array = np.stack([self[i] for i in indices])
+        return types.SimpleNamespace(asnumpy=lambda: array)
+
+
+@pytest.fixture
+def decord(monkeypatch):
+    module = types.SimpleNamespace(VideoReader=FakeVideoReader, cpu=lambda i: None)
+    monkeypatch.setitem(sys.modules, 'decord', module)
+    FakeVideoReader.batches = []
+    return module
+
+
+def test_frames_are_decoded_in_chunks(decord):
+    video = decode_video('clip.mp4', 'vid', plan='packing', chunk_size=16)
+    # a 20 s clip is short: 1 fps doubled to 2, packed by 2
+    assert len(video.frames) == 40
+    assert FakeVideoReader.batches == [16, 16, 8]
+    whole = decode_video('clip.mp4', 'vid', plan='packing', chunk_size=1000)
+    assert [np.asarray(f).tolist() for f in video.frames] == [np.asarray(f).tolist() for f in whole.frames]
+    assert [f.info['sha256'] for f in video.frames] == [f'vid:{i}' for i in range(40)]
+    assert video.temporal_ids == whole.temporal_ids and len(video.temporal_ids) == 20
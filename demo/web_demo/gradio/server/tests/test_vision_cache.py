@@ -0,0 +1,86 @@
+import torch
+from PIL import Image
+
+from models.vision_cache import SessionVisionCache, VisionEmbeddingCache
+
+
+def image(color):
+    img = Image.new('RGB', (16, 16), color)
+    # what the image cache adds to every image it decodes
+    img.info['sha256'] = color * 8
+    return img
+
+
+class ImageProcessor:
+    slice_mode = True
+    max_slice_nums = 9
+
+    def get_sliced_grid(self, size, max_slice_nums):
+        # a 1x2 grid when slicing is allowed: three slices per image
+        return [1, 2] if max_slice_nums > 1 else None
+
+
+class FakeMiniCPM:
+    """The parts of MiniCPM `chat` the vision cache hooks into; counts vision encoder runs."""
+
+    def __init__(self):
+        self.encoded_images = 0
+
+    def get_vllm_embedding(self, data):
+        if 'vision_hidden_states' in data:
+            return None, data['vision_hidden_states']
+        states = []
+        for img, slices in zip(data['images'], data['slices']):
+            self.encoded_images += 1
+            states.append(torch.tensor(img.getpixel((0, 0)), dtype=torch.float).repeat(slices, 1))
+        return None, [torch.cat(states)]
+
+    def chat(self, msgs, vision_hidden_states=None, max_slice_nums=9, **kwargs):
+        images = [c for msg in msgs for c in msg['content'] if isinstance(c, Image.Image)]
+        data = {'images': images, 'slices': [3 if max_slice_nums > 1 else 1] * len(images)}
+        if vision_hidden_states is not None:
+            data['vision_hidden_states'] = vision_hidden_states
+        return self.get_vllm_embedding(data)[1][0]
+
+
+def run(vision, model, session_id, images, **chat_kwargs):
+    msgs = [{'role': 'user', 'content': [*images, 'describe']}]
+    with vision.use(session_id, msgs, chat_kwargs):
+        return model.chat(msgs, **chat_kwargs)
+
+
+def test_follow_up_turns_skip_the_vision_encoder():
+    model, cache = FakeMiniCPM(), VisionEmbeddingCache()
+    vision = SessionVisionCache(model, ImageProcessor(), cache)
+    red, blue = image('red'), image('blue')
+
+    first = run(vision, model, 's', [red])
+    assert model.encoded_images == 1
+    # same image in the next turn: nothing is encoded, and the embeddings are the same
+    assert torch.equal(run(vision, model, 's', [red]), first)
+    assert model.encoded_images == 1
+    # a new image means a full encode, after which both are cached
+    run(vision, model, 's', [red, blue])
+    assert model.encoded_images == 3
+    run(vision, model, 's', [blue, red])
+    assert model.encoded_images == 3
+    assert cache.stats()['skipped_encodes'] == 3
+
+
+def test_changed_images_and_settings_miss():
+    model, cache = FakeMiniCPM(), VisionEmbeddingCache()
+    vision = SessionVisionCache(model, ImageProcessor(), cache)
+    red, green = image('red'), image('green')
+
+    run(vision, model, 's', [red])
+    # the first image of the conversation changed: the old embeddings do not apply
+    assert run(vision, model, 's', [green])[0].tolist() == [0, 128, 0]
+    # embeddings are per session and per slice setting
+    run(vision, model, 'other', [red])
+    run(vision, model, 's', [red], max_slice_nums=1)
+    assert model.encoded_images == 4
+    # without a session, or for images that did not come through the image cache, nothing is cached
+    run(vision, model, None, [red])
+    run(vision, model, 's', [Image.new('RGB', (16, 16))])
+    assert model.encoded_images == 6
+    assert cache.stats()['entries'] == 4
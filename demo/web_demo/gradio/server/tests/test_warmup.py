@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+from gradio_server import Model
+import warmup as warmup_module
+from warmup import Warmup, warmup_queries
+
+
+@pytest.fixture
+def model(monkeypatch):
+    # the stub echoes the 1024-word prompt token by token
+    monkeypatch.setitem(warmup_module.WARMUP_PARAMS, 'stub_token_latency', 0)
+    return Model(None, 'stub')
+
+
+def test_warmup_samples_like_the_clients():
+    for _, query in warmup_queries():
+        params = json.loads(query['params'])
+        assert params['sampling'] is True
+        assert 'num_beams' not in params
+
+
+def test_warmup_runs_every_query(model):
+    warmup = Warmup(model)
+    warmup.run()
+    assert warmup.ready and warmup.state == 'done'
+    assert list(warmup.seconds) == [label for label, _ in warmup_queries()]
+
+
+def test_stream_errors_fail_the_warmup(model):
+    # the wrappers catch generation errors in streams and yield them as the answer
+    model.stream_handler = lambda query: iter(['Error: beam search is not supported when streaming'])
+    warmup = Warmup(model)
+    warmup.run()
+    assert warmup.ready and warmup.state == 'failed'
+    assert 'beam search' in warmup.error
+    assert not any(label.endswith('stream') for label in warmup.seconds)
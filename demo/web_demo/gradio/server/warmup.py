@@ -0,0 +1,165 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+import torch
+from PIL import Image
+
+from models import timings, RequestTiming
+
+logger = logging.getLogger(__name__)
+
+# one slice, a 2x2 grid and the 3x3 grid of the default max_slice_nums=9
+WARMUP_IMAGE_SIZES = ((448, 448), (896, 896), (1344, 1344))
+# short chat turns and a long document-style prompt
+WARMUP_PROMPT_WORDS = (16, 1024)
+WARMUP_MAX_NEW_TOKENS = 16
+# the clients' default sampling settings: greedy decoding in chat() means beam search, which streams reject
+WARMUP_PARAMS = {
+    'sampling': True,
+    'top_p': 0.8,
+    'top_k': 100,
+    'temperature': 0.7,
+    'repetition_penalty': 1.05,
+    'max_new_tokens': WARMUP_MAX_NEW_TOKENS,
+    'enable_thinking': False,
+}
+WARMUP_SEED = 0
+
+
+def enable_compile(torch_model, cache_dir=None):
+    """
+    torch.compile the language model's forward, with dynamic shapes since prompt and cache lengths vary.
+    With `cache_dir`, inductor and triton keep compiled kernels there, so restarts skip most of the
+    compilation. Returns False when the model has no `llm` to compile.
+    """
+    llm = getattr(torch_model, 'llm', None)
+    if llm is None:
+        logger.warning("torch.compile unavailable: model has no llm")
+        return False
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+        os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(cache_dir, 'triton'))
+        os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+        os.environ.setdefault('TORCHINDUCTOR_AUTOGRAD_CACHE', '1')
+    llm.forward = torch.compile(llm.forward, dynamic=True)
+    return True
+
+
+def _image_b64(width, height, seed):
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    buffered = BytesIO()
+    Image.fromarray(pixels).save(buffered, format='png')
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
+def _prompt(words):
+    text = ' '.join(['Describe the image in detail, including every object and any text.'] * (words // 12 + 1))
+    return ' '.join(text.split()[:words])
+
+
+def warmup_queries():
+    """(label, query) pairs: every image size with a short prompt, the middle size with a long one, one stream."""
+    params = json.dumps(WARMUP_PARAMS)
+    short, long = WARMUP_PROMPT_WORDS[0], WARMUP_PROMPT_WORDS[-1]
+    cases = [(size, short) for size in WARMUP_IMAGE_SIZES]
+    cases.append((WARMUP_IMAGE_SIZES[len(WARMUP_IMAGE_SIZES) // 2], long))
+    queries = []
+    for i, ((width, height), words) in enumerate(cases):
+        msgs = [{'role': 'user', 'contents': [
+            {'type': 'image', 'pairs': _image_b64(width, height, i)},
+            {'type': 'text', 'pairs': _prompt(words)},
+        ]}]
+        queries.append((f'{width}x{height}, {words} words', {
+            'image': '', 'question': json.dumps(msgs), 'params': params, 'stream': False,
+        }))
+    label, query = queries[0]
+    queries.append((f'{label}, stream', {**query, 'stream': True}))
+    return queries
+
+
+class Warmup:
+    """
+    Runs synthetic requests through the model after it is loaded: lazy CUDA context setup, kernel
+    autotuning, torch.compile and allocator growth happen here instead of in the first users'
+    requests. The server is not ready, and rejects generation requests, until this completes.
+    A failed warmup is logged and the server becomes ready anyway, as it would have been without one.
+    The model wrappers report generation errors as an "Error: ..." answer, which fails the warmup too.
+    """
+
+    def __init__(self, model, timer=None):
+        self.model = model
+        self.timer = timer
+        self.state = 'pending'
+        self.seconds = {}
+        self.error = None
+        self._ready = threading.Event()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def skip(self):
+        self.state = 'skipped'
+        self._ready.set()
+
+    def _run_query(self, query):
+        query = {**query}
+        stream = query.pop('stream')
+        # sampling, but the same tokens on every start
+        torch.manual_seed(WARMUP_SEED)
+        # the generation hooks record into the current timing, as for real requests
+        with timings.active(RequestTiming()):
+            if stream:
+                chunks = list(self.model.stream_handler(query))
+            else:
+                chunks = [self.model.handler(query)["result"]]
+        for chunk in chunks:
+            if isinstance(chunk, str) and chunk.startswith('Error:'):
+                raise RuntimeError(chunk)
+
+    def _run_all(self):
+        for label, query in warmup_queries():
+            start = time.perf_counter()
+            self._run_query(query)
+            self.seconds[label] = round(time.perf_counter() - start, 3)
+            logger.info(f"[warmup] {label:<28s} {self.seconds[label]:8.2f}s")
+
+    def run(self):
+        self.state = 'running'
+        try:
+            if self.timer is not None:
+                # reported next to the loading phases; includes torch.compile, which compiles lazily
+                with self.timer.phase('warmup'):
+                    self._run_all()
+            else:
+                self._run_all()
+            self.state = 'done'
+        except Exception as e:
+            logger.error(f"[warmup] failed, serving without it: {e}")
+            self.state = 'failed'
+            self.error = str(e)
+        finally:
+            if self.timer is not None:
+                self.timer.report()
+            self._ready.set()
+
+    def start(self):
+        threading.Thread(target=self.run, name='warmup', daemon=True).start()
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'ready': self.ready,
+            'seconds': self.seconds,
+            'error': self.error,
+            # loading phases and the warmup itself, in seconds
+            'startup': self.timer.as_dict() if self.timer is not None else {},
+        }
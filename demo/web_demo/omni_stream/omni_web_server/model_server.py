@@ -92,12 +92,22 @@ class StreamManager:
         
         self.minicpmo_model_path = args.model #"openbmb/MiniCPM-o-2_6"
         self.model_version = "2.6"
+        # Omni streaming uses the vision, audio and TTS modules, so unlike the gradio server's vision-only
+        # MiniCPM-o wrapper there is nothing to skip; from_pretrained with low_cpu_mem_usage and a
+        # device_map already builds on the meta device and copies the mmap'd shards straight to the GPU.
+        load_start = time.time()
         with torch.no_grad():
-            self.minicpmo_model = AutoModel.from_pretrained(self.minicpmo_model_path, trust_remote_code=True, torch_dtype=self.target_dtype, attn_implementation='sdpa')
+            self.minicpmo_model = AutoModel.from_pretrained(self.minicpmo_model_path, trust_remote_code=True, torch_dtype=self.target_dtype, attn_implementation='sdpa',
+                                                            low_cpu_mem_usage=True, device_map={'': self.device})
+        weights_done = time.time()
         self.minicpmo_tokenizer = AutoTokenizer.from_pretrained(self.minicpmo_model_path, trust_remote_code=True)
+        tokenizer_done = time.time()
         self.minicpmo_model.init_tts()
         # self.minicpmo_model.tts.float()
         self.minicpmo_model.to(self.device).eval()
+        tts_done = time.time()
+        logger.info(f"startup timing: weights {weights_done - load_start:.2f}s, tokenizer {tokenizer_done - weights_done:.2f}s, "
+                    f"init_tts {tts_done - tokenizer_done:.2f}s, total {tts_done - load_start:.2f}s")
 
         self.ref_path_video_default = "assets/ref_audios/video_default.wav"
         self.ref_path_default = "assets/ref_audios/default.wav"
@@ -0,0 +1,237 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import torch
+from PIL import Image, ImageDraw
+from transformers import AutoModel, AutoTokenizer
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
+DEFAULT_QUESTION = 'Please provide the bounding box coordinate of the region this sentence describes: <ref>{ref}</ref>'
+
+
+def setup_model_and_tokenizer(model_path):
+    model = AutoModel.from_pretrained(model_path, trust_remote_code=True,
+                                      attn_implementation='sdpa', torch_dtype=torch.bfloat16)
+    model = model.eval().cuda()
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    return model, tokenizer
+
+
+def read_manifest(args):
+    """Yield {'id', 'image', 'question'} records from a JSONL manifest or an image directory."""
+    if args.manifest:
+        with open(args.manifest) as f:
+            for line_no, line in enumerate(f):
+                line = line.strip()
+                if not line:
+                    continue
+                item = json.loads(line)
+                question = item.get('question') or DEFAULT_QUESTION.format(ref=item.get('ref', args.ref))
+                yield {'id': str(item.get('id', line_no)), 'image': item['image'], 'question': question}
+    else:
+        question = args.question or DEFAULT_QUESTION.format(ref=args.ref)
+        for root, _, files in sorted(os.walk(args.image_dir)):
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    path = os.path.join(root, name)
+                    yield {'id': os.path.relpath(path, args.image_dir), 'image': path, 'question': question}
+
+
+def load_done_ids(output_path):
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a crash can leave a truncated last line; that item is redone
+                continue
+            # failures written to the output by earlier versions are retried
+            if 'id' in record and 'error' not in record:
+                done.add(record['id'])
+    return done
+
+
+def error_log_path(output_path):
+    root, ext = os.path.splitext(output_path)
+    return f"{root}.errors{ext or '.jsonl'}"
+
+
+def render_path(render_dir, item_id):
+    """Where to draw the boxes of `item_id`, always inside `render_dir`."""
+    parts = [p for p in re.split(r'[\\/]+', os.path.splitext(item_id)[0]) if p not in ('', '.', '..')]
+    name = os.path.join(*parts) if parts else ''
+    if name != os.path.splitext(item_id)[0]:
+        # ids that had to be rewritten get a hash so they can't collide with each other or plain ids
+        name = f"{name or 'item'}-{hashlib.sha1(item_id.encode()).hexdigest()[:12]}"
+    return os.path.join(render_dir, name + '.jpg')
+
+
+def load_image(item):
+    try:
+        item['pil'] = Image.open(item['image']).convert('RGB')
+    except Exception as e:
+        item['error'] = f"load failed: {e}"
+    return item
+
+
+def prefetch(items, pool, depth):
+    """Decode images on `pool`, keeping at most `depth` decodes in flight, in manifest order."""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(load_image, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def extract_bboxes_from_response(response):
+    return [list(map(int, m.split())) for m in re.findall(r"<box>\s*(\d+\s+\d+\s+\d+\s+\d+)\s*</box>", response)]
+
+
+def to_pixel_boxes(boxes, width, height):
+    return [[int(b[0] / 1000 * width), int(b[1] / 1000 * height),
+             int(b[2] / 1000 * width), int(b[3] / 1000 * height)] for b in boxes]
+
+
+def render_boxes(image_path, boxes_px, out_path):
+    image = Image.open(image_path).convert('RGB')
+    draw = ImageDraw.Draw(image)
+    for box in boxes_px:
+        draw.rectangle(box, outline="red", width=4)
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    image.save(out_path)
+    return out_path
+
+
+def generate(model, tokenizer, batch, args):
+    """One response per item; in the one-at-a-time fallback, a failed item gets its exception instead."""
+    msgs_list = [[{'role': 'user', 'content': [item['question'], item['pil']]}] for item in batch]
+    chat_kwargs = dict(image=None, tokenizer=tokenizer, sampling=args.sampling,
+                       max_new_tokens=args.max_new_tokens, max_inp_length=8192, use_image_id=True)
+    with torch.inference_mode():
+        if len(batch) > 1:
+            try:
+                return model.chat(msgs=msgs_list, **chat_kwargs)
+            except Exception as e:
+                print(f"Batched chat failed ({e}), falling back to one image at a time")
+        responses = []
+        for msgs in msgs_list:
+            try:
+                responses.append(model.chat(msgs=msgs, **chat_kwargs))
+            except Exception as e:
+                if isinstance(e, torch.cuda.OutOfMemoryError):
+                    torch.cuda.empty_cache()
+                responses.append(e)
+        return responses
+
+
+def log_error(errors, item, error):
+    # kept out of the output so a resumed run tries the image again
+    errors.write(json.dumps({'id': item['id'], 'image': item['image'], 'error': str(error)},
+                            ensure_ascii=False) + '\n')
+    errors.flush()
+
+
+def report_renders(render_futures):
+    """Print the failures of finished renders and return the ones still running."""
+    for f in render_futures:
+        if f.done() and f.exception():
+            print(f"render failed: {f.exception()}")
+    return [f for f in render_futures if not f.done()]
+
+
+def build_record(item, response):
+    width, height = item['pil'].size
+    boxes = extract_bboxes_from_response(response)
+    return {
+        'id': item['id'],
+        'image': item['image'],
+        'question': item['question'],
+        'response': response,
+        'width': width,
+        'height': height,
+        'boxes_norm': [[round(v / 1000, 4) for v in b] for b in boxes],
+        'boxes_px': to_pixel_boxes(boxes, width, height),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch grounding with MiniCPM-V 4.5')
+    parser.add_argument('--model_path', type=str, default='openbmb/MiniCPM-V-4_5')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='JSONL with {"id", "image", "question"} (or "ref") per line')
+    parser.add_argument('--image_dir', type=str, default=None,
+                        help='Directory of images, used when no manifest is given')
+    parser.add_argument('--question', type=str, default=None, help='Question for --image_dir mode')
+    parser.add_argument('--ref', type=str, default='airplane', help='Referring expression for the default question')
+    parser.add_argument('--output', type=str, required=True, help='Output JSONL, appended to and resumed from')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_workers', type=int, default=8, help='Image decode threads')
+    parser.add_argument('--sampling', action='store_true', help='Sample instead of beam search')
+    parser.add_argument('--max_new_tokens', type=int, default=1024)
+    parser.add_argument('--render_dir', type=str, default=None, help='Draw boxes into this directory')
+    parser.add_argument('--render_workers', type=int, default=4)
+    args = parser.parse_args()
+    if not args.manifest and not args.image_dir:
+        parser.error('one of --manifest or --image_dir is required')
+
+    done = load_done_ids(args.output)
+    todo = (item for item in read_manifest(args) if item['id'] not in done)
+    print(f"Resuming with {len(done)} items already done")
+
+    model, tokenizer = setup_model_and_tokenizer(args.model_path)
+    render_pool = ProcessPoolExecutor(args.render_workers) if args.render_dir else None
+    render_futures = []
+    processed, start = 0, time.time()
+
+    with ThreadPoolExecutor(args.num_workers) as decode_pool, open(args.output, 'a') as out, \
+            open(error_log_path(args.output), 'a') as errors:
+        batch = []
+        stream = prefetch(todo, decode_pool, depth=args.batch_size * 4)
+        while True:
+            item = next(stream, None)
+            if item is not None:
+                if 'error' in item:
+                    log_error(errors, item, item['error'])
+                    continue
+                batch.append(item)
+                if len(batch) < args.batch_size:
+                    continue
+            if not batch:
+                break
+
+            responses = generate(model, tokenizer, batch, args)
+            for item, response in zip(batch, responses):
+                if isinstance(response, Exception):
+                    print(f"generation failed for {item['id']}: {response}")
+                    log_error(errors, item, response)
+                    continue
+                record = build_record(item, response)
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                if render_pool and record['boxes_px']:
+                    out_path = render_path(args.render_dir, item['id'])
+                    render_futures.append(render_pool.submit(render_boxes, item['image'], record['boxes_px'], out_path))
+            # flush per batch so a restart loses at most one batch
+            out.flush()
+            processed += len(batch)
+            batch = []
+            render_futures = report_renders(render_futures)
+            print(f"processed {processed} images, {processed / (time.time() - start):.2f} img/s")
+
+    if render_pool:
+        render_pool.shutdown(wait=True)
+        report_renders(render_futures)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#! need to install poppler-utils
+# sudo apt-get update
+# sudo apt-get install poppler-utils
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+from pdf2image import convert_from_path, pdfinfo_from_path
+from transformers import AutoModel, AutoTokenizer
+
+PROMPT = """
+You are an OCR assistant. Your task is to identify and extract all visible text from the image provided. Preserve the original formatting as closely as possible, including:
+
+- Line breaks and paragraphs
+- Headings and subheadings
+- Any tables, lists, bullet points, or numbered items
+- Special characters, spacing, and alignment
+
+Output strictly the extracted text in Markdown format, reflecting the layout and structure of the original image. Do not add commentary, interpretation, or summarization—only return the raw text content with its formatting.
+"""
+
+PROBE_DPI = 36
+# (max ink density, dpi, max_slice_nums); the first matching row wins.
+# Pages below BLANK_DENSITY are not sent to the model at all.
+BLANK_DENSITY = 0.002
+DPI_POLICY = [
+    (0.02, 100, 1),
+    (0.08, 150, 4),
+    (1.01, 200, 9),
+]
+
+
+def setup_model_and_tokenizer(model_path):
+    model = AutoModel.from_pretrained(model_path, trust_remote_code=True,
+                                      attn_implementation='sdpa', torch_dtype=torch.bfloat16)
+    model = model.eval().cuda()
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    return model, tokenizer
+
+
+def choose_resolution(density):
+    if density < BLANK_DENSITY:
+        return None, 0
+    for max_density, dpi, max_slice_nums in DPI_POLICY:
+        if density < max_density:
+            return dpi, max_slice_nums
+    return DPI_POLICY[-1][1:]
+
+
+def rasterize_page(pdf_path, page_no):
+    """Probe the page at low DPI for ink density, then render it at the DPI the policy picks."""
+    probe = convert_from_path(pdf_path, dpi=PROBE_DPI, first_page=page_no, last_page=page_no, grayscale=True)[0]
+    density = float((np.asarray(probe) < 200).mean())
+    dpi, max_slice_nums = choose_resolution(density)
+    image = None
+    if dpi is not None:
+        image = convert_from_path(pdf_path, dpi=dpi, first_page=page_no, last_page=page_no)[0].convert('RGB')
+    return {'page': page_no, 'image': image, 'density': density, 'dpi': dpi, 'max_slice_nums': max_slice_nums}
+
+
+def page_path(out_dir, page_no):
+    return os.path.join(out_dir, f'page_{page_no:04d}.md')
+
+
+def write_atomic(path, text):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def parse_page(model, tokenizer, page):
+    msgs = [{'role': 'user', 'content': [page['image'], PROMPT]}]
+    with torch.inference_mode():
+        return model.chat(msgs=msgs, image=None, tokenizer=tokenizer, max_slice_nums=page['max_slice_nums'])
+
+
+def run(args):
+    num_pages = pdfinfo_from_path(args.pdf)['Pages']
+    os.makedirs(args.out_dir, exist_ok=True)
+    # every finished page is its own checkpoint file
+    todo = [p for p in range(1, num_pages + 1) if not os.path.exists(page_path(args.out_dir, p))]
+    print(f"{num_pages} pages, {num_pages - len(todo)} already parsed", file=sys.stderr)
+
+    model, tokenizer = setup_model_and_tokenizer(args.model_path) if todo else (None, None)
+    start = time.time()
+    with ProcessPoolExecutor(args.num_workers) as pool:
+        # Rasterization runs ahead of the model by at most `queue_size` pages,
+        # which bounds memory held in rendered pages.
+        in_flight = deque()
+        pages = iter(todo)
+        for page_no in pages:
+            in_flight.append(pool.submit(rasterize_page, args.pdf, page_no))
+            if len(in_flight) >= args.queue_size:
+                break
+        while in_flight:
+            page = in_flight.popleft().result()
+            next_page = next(pages, None)
+            if next_page is not None:
+                in_flight.append(pool.submit(rasterize_page, args.pdf, next_page))
+
+            page_start = time.time()
+            text = parse_page(model, tokenizer, page) if page['image'] is not None else ''
+            write_atomic(page_path(args.out_dir, page['page']), text)
+            print(f"<!-- page {page['page']} -->\n{text}\n", flush=True)
+            print(f"[page {page['page']}/{num_pages}] density={page['density']:.4f} dpi={page['dpi']} "
+                  f"slices={page['max_slice_nums']} {time.time() - page_start:.2f}s", file=sys.stderr)
+    print(f"parsed {len(todo)} pages in {time.time() - start:.2f}s", file=sys.stderr)
+
+    output = os.path.join(args.out_dir, os.path.splitext(os.path.basename(args.pdf))[0] + '.md')
+    with open(output, 'w', encoding='utf-8') as f:
+        for page_no in range(1, num_pages + 1):
+            with open(page_path(args.out_dir, page_no), encoding='utf-8') as page_file:
+                f.write(page_file.read().rstrip() + '\n\n')
+    print(f"markdown written to {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Page-parallel streaming PDF parsing with MiniCPM-V 4.5')
+    parser.add_argument('pdf', type=str)
+    parser.add_argument('--model_path', type=str, default='openbmb/MiniCPM-V-4_5')
+    parser.add_argument('--out_dir', type=str, default=None,
+                        help='Per-page markdown checkpoints and the merged document (default: <pdf name>_parsed)')
+    parser.add_argument('--num_workers', type=int, default=4, help='Rasterization processes')
+    parser.add_argument('--queue_size', type=int, default=8, help='Max pages rendered ahead of the model')
+    args = parser.parse_args()
+    if args.out_dir is None:
+        args.out_dir = os.path.splitext(args.pdf)[0] + '_parsed'
+    run(args)